@@ -75,6 +75,26 @@ class extractProfileConfig(config.Config):
                                    optional=True)
     write_result = config.Field("Write primitive output to disk?", bool, False,
                                 optional=True)
+    n_workers = config.Field("Number of processes to extract orders with",
+                             int, 1, optional=True)
+    cr_snoise = config.Field("Fractional noise for cosmic ray search",
+                             float, 0.1, optional=True)
+    cr_nsigma = config.Field("Cosmic ray rejection threshold (sigma)",
+                             float, 6., optional=True)
+    cr_max_iter = config.Field("Maximum passes of the cosmic ray search",
+                               int, 1, optional=True)
+    dtype = config.ChoiceField("Floating-point precision of the extraction",
+                               str, {
+        'float64': 'Double precision',
+        'float32': 'Single precision (half the memory)'
+    }, default='float64', optional=True)
+    memory_budget = config.Field("Memory limit for 1D extraction (MB)",
+                                 float, None, optional=True)
+    orders = config.ListField("Order numbers to extract", int, None,
+                              optional=True)
+    wavelength_range = config.ListField(
+        "Wavelength range to extract (Angstroms)", float, None,
+        minLength=2, maxLength=2, optional=True)
 
 
 class interpolateAndCombineConfig(config.Config):
@@ -99,6 +119,8 @@ class findAperturesConfig(config.Config):
                             optional=True, single=True)
     skip_pixel_model = config.Field('Skip adding a pixel model to the '
                                     'flat field?', bool, False)
+    store_geometry = config.Field('Store the spectral format with the '
+                                  'flat field?', bool, True)
 
 
 class fitWavelengthConfig(config.Config):
@@ -168,6 +190,12 @@ class responseCorrectConfig(config.Config):
                                 optional=True)
 
 
+class storeProcessedFlatConfig(config.Config):
+    suffix = config.Field("Filename suffix", str, "_flat", optional=True)
+    store_geometry = config.Field('Store the spectral format with the '
+                                  'flat field?', bool, True)
+
+
 class tileArraysConfig(parameters_visualize.tileArraysConfig):
     def setDefaults(self):
         self.suffix = "_arraysTiled"
@@ -11,6 +11,6 @@ __version__ = "1.0"
 
 from .ghost import GhostArm
 from .slitview import SlitView
-from .extract import Extractor
+from .extract import Extractor, ExtractionWeights
 
 
@@ -0,0 +1,305 @@
+"""
+On-disk cache of extraction results.
+
+Re-running a reduction after changing a later step repeats every
+extraction, although its inputs have not changed. An
+:class:`ExtractionCache` keeps the results of recent extractions, keyed on
+a :any:`cache_key` of everything the extraction depends on (the data,
+variance and mask, the calibration files and the extraction parameters),
+so that a repeated extraction can be restored rather than recomputed.
+
+The cache is a directory of ``.npz`` files, one per extraction, and is
+limited in size by evicting the least recently used extractions. It is
+disabled unless the ``GHOSTDR_EXTRACTION_CACHE`` environment variable is
+set, either to the cache directory or to ``on`` (or ``1``, ``yes``,
+``true``) for :any:`DEFAULT_CACHE_DIR`. Its size limit, in MB, may be set
+by ``GHOSTDR_EXTRACTION_CACHE_SIZE``.
+
+Every key includes a :any:`code_fingerprint` of the ghostdr version and
+of the sources of the extraction, so that a cached extraction is not
+restored once the code that computed it has changed.
+"""
+
+from __future__ import division, print_function
+import os
+import hashlib
+import tempfile
+import glob
+import numpy as np
+
+from .extract import ExtractionWeights
+
+CACHE_ENV = 'GHOSTDR_EXTRACTION_CACHE'
+CACHE_SIZE_ENV = 'GHOSTDR_EXTRACTION_CACHE_SIZE'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'ghostdr', 'extractions')
+DEFAULT_CACHE_SIZE = 2048.
+
+# Values of the environment variable that enable the cache in its default
+# directory, or disable it
+_ON_VALUES = ('1', 'on', 'yes', 'true')
+_OFF_VALUES = ('', '0', 'off', 'no', 'false', 'none')
+
+# Bump to invalidate every cached extraction when the file format changes.
+# Changes to the extraction code are picked up by code_fingerprint.
+_CACHE_VERSION = 2
+
+# File checksums, keyed on (path, size, modification time)
+_CHECKSUMS = {}
+
+# The code fingerprint, once computed
+_FINGERPRINT = None
+
+
+def file_checksum(filename):
+    """
+    Compute the checksum of a file's contents.
+
+    The checksum is remembered for as long as the file's size and
+    modification time are unchanged.
+
+    Parameters
+    ----------
+    filename: str
+        The file.
+
+    Returns
+    -------
+    str
+        The SHA-1 checksum of the file.
+    """
+    stat = os.stat(filename)
+    ident = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if ident not in _CHECKSUMS:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(chunk)
+        _CHECKSUMS[ident] = digest.hexdigest()
+    return _CHECKSUMS[ident]
+
+
+def _ghostdr_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:  # Python 2
+        try:
+            import pkg_resources
+            return pkg_resources.get_distribution('ghostdr').version
+        except Exception:
+            return 'unknown'
+    try:
+        return version('ghostdr')
+    except Exception:
+        return 'unknown'
+
+
+def code_fingerprint():
+    """
+    Compute a checksum of the code an extraction is computed by.
+
+    This covers the installed ghostdr version, and the sources of the
+    ``polyfit`` package and of the spectroscopy primitives, which prepare
+    the data for extraction.
+
+    Returns
+    -------
+    str
+        The SHA-1 checksum of the version and the sources.
+    """
+    global _FINGERPRINT
+    if _FINGERPRINT is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        sources = sorted(glob.glob(os.path.join(here, '*.py')))
+        sources.append(os.path.join(os.path.dirname(here),
+                                    'primitives_ghost_spect.py'))
+        digest = hashlib.sha1(_ghostdr_version().encode())
+        for filename in sources:
+            if os.path.exists(filename):
+                digest.update(file_checksum(filename).encode())
+        _FINGERPRINT = digest.hexdigest()
+    return _FINGERPRINT
+
+
+def cache_key(arrays=(), files=(), params=None):
+    """
+    Compute the key of an extraction.
+
+    Parameters
+    ----------
+    arrays: list of :obj:`numpy.ndarray`
+        Arrays whose contents the extraction depends on, e.g. the data,
+        variance and mask. Entries may be None.
+    files: list of str
+        Files whose contents the extraction depends on, e.g. the
+        calibrations and polyfit models.
+    params: dict, optional
+        Parameters of the extraction. Their ``repr`` is hashed.
+
+    Returns
+    -------
+    str
+        A checksum of all the inputs.
+    """
+    digest = hashlib.sha1()
+    digest.update('v{0:d}_{1}'.format(_CACHE_VERSION,
+                                      code_fingerprint()).encode())
+    for arr in arrays:
+        if arr is None:
+            digest.update(b'None')
+            continue
+        arr = np.ascontiguousarray(arr)
+        digest.update('{0}{1}'.format(arr.shape, arr.dtype.str).encode())
+        digest.update(arr.view(np.uint8))
+    for filename in files:
+        digest.update(file_checksum(filename).encode())
+    for name, value in sorted((params or {}).items()):
+        digest.update('{0}={1!r};'.format(name, value).encode())
+    return digest.hexdigest()
+
+
+class ExtractionCache(object):
+    """
+    A size-limited directory of extraction results.
+
+    Parameters
+    ----------
+    directory: str, optional
+        The cache directory. Defaults to the ``GHOSTDR_EXTRACTION_CACHE``
+        environment variable, or :any:`DEFAULT_CACHE_DIR` if it is ``on``,
+        ``1``, ``yes`` or ``true``. If the environment variable is not set,
+        or is ``none``, ``off``, ``0`` or empty, the cache is disabled.
+    max_size: float, optional
+        The size limit of the cache, in MB. Defaults to the
+        ``GHOSTDR_EXTRACTION_CACHE_SIZE`` environment variable, or
+        :any:`DEFAULT_CACHE_SIZE`.
+    """
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = os.environ.get(CACHE_ENV, '').strip()
+            if directory.lower() in _OFF_VALUES:
+                directory = None
+            elif directory.lower() in _ON_VALUES:
+                directory = DEFAULT_CACHE_DIR
+        if max_size is None:
+            max_size = float(os.environ.get(CACHE_SIZE_ENV,
+                                            DEFAULT_CACHE_SIZE))
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        """Is the cache in use?"""
+        return self.directory is not None
+
+    def _filename(self, key):
+        return os.path.join(self.directory, '{0}.npz'.format(key))
+
+    def get(self, key):
+        """
+        Look up an extraction.
+
+        Parameters
+        ----------
+        key: str
+            The :any:`cache_key` of the extraction.
+
+        Returns
+        -------
+        results: list of tuple, or None
+            ``(extracted_flux, extracted_var, extraction_weights)`` for
+            each extracted configuration, as returned by
+            :meth:`Extractor.extract_configurations
+            <polyfit.extract.Extractor.extract_configurations>`, or None if
+            the extraction is not in the cache.
+        info: dict
+            The arrays stored with the results by :meth:`put`.
+        """
+        if not self.enabled:
+            return None, {}
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as npz:
+                results = []
+                for k in range(int(npz['nresults'])):
+                    weights = ExtractionWeights(
+                        npz['rows{0:d}'.format(k)],
+                        npz['rowindex{0:d}'.format(k)],
+                        npz['xstart{0:d}'.format(k)], int(npz['nx']),
+                        x_range=npz['xrange{0:d}'.format(k)])
+                    results.append((npz['flux{0:d}'.format(k)],
+                                    npz['var{0:d}'.format(k)], weights))
+                info = dict((name[5:], npz[name]) for name in npz.files
+                            if name.startswith('info_'))
+        except (IOError, OSError, ValueError, KeyError):
+            return None, {}
+        # Mark the extraction as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return results, info
+
+    def put(self, key, results, **info):
+        """
+        Store an extraction, and evict the least recently used extractions
+        beyond the size limit.
+
+        Failures to write to the cache are ignored.
+
+        Parameters
+        ----------
+        key: str
+            The :any:`cache_key` of the extraction.
+        results: list of tuple
+            The extraction results, as for :meth:`get`.
+        info: :obj:`numpy.ndarray`
+            Any further arrays to store with the results.
+        """
+        if not self.enabled:
+            return
+        arrays = dict(nresults=len(results))
+        for k, (flux, var, weights) in enumerate(results):
+            arrays['flux{0:d}'.format(k)] = flux
+            arrays['var{0:d}'.format(k)] = var
+            arrays['rows{0:d}'.format(k)] = weights.rows
+            arrays['rowindex{0:d}'.format(k)] = weights.row_index
+            arrays['xstart{0:d}'.format(k)] = weights.x_start
+            arrays['xrange{0:d}'.format(k)] = weights.x_range
+            arrays['nx'] = weights.nx
+        for name, value in info.items():
+            arrays['info_' + name] = value
+
+        # Write to a temporary file first, so that an interrupted write
+        # never leaves a truncated extraction in the cache
+        tmp = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            getattr(os, 'replace', os.rename)(tmp, self._filename(key))
+            tmp = None
+            self._evict()
+        except (IOError, OSError):
+            pass
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _evict(self):
+        """Remove the least recently used extractions beyond the limit."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_size * 2 ** 20
+        for _, size, name in entries:
+            if total <= limit:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
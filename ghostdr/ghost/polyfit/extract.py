@@ -6,10 +6,118 @@ from __future__ import division, print_function
 import numpy as np
 import matplotlib.pyplot as plt
 import astropy.io.fits as pyfits
-from astropy.modeling import models, fitting
+from astropy.table import Table
 import matplotlib.cm as cm
-import warnings
+import hashlib
+import collections
 import scipy.ndimage as ndimage
+import scipy.sparse
+
+from .orderstrip import OrderStripCube, TiltedStripGather
+from .orderpool import OrderPool, shared
+from . import geometry
+from .linelist import LineCatalogue
+from .plan import bin_arm_models
+
+# Recently used 2D extraction gathers, by a digest of their geometry, so that
+# frames sharing calibrations (and extractions of several sets of weights
+# from the same frame) only compute them once.
+_TILTED_GATHERS = collections.OrderedDict()
+_TILTED_GATHERS_SIZE = 2
+
+
+def find_order_crs(phi, slitim_offsets, col_data, col_inv_var,
+                   snoise=0.1, nsigma=6, max_iter=1, debug=False):
+    """
+    Search every column of an order for additional cosmic rays at once.
+
+    This is the batched form of :any:`find_additional_crs`: the linear
+    regression model is fitted to all columns with a single set of stacked
+    least-squares solves, and pixels are flagged as cosmic rays if their
+    value exceeds
+
+    .. math::
+        \\hat{y} + n_\\sigma \\times \\sqrt{var}\\textrm{.}
+
+    If ``max_iter`` is greater than 1, the model is re-fitted without the
+    pixels flagged so far and the search repeated, until no new cosmic rays
+    are found or ``max_iter`` passes have been made.
+
+    Parameters
+    ----------
+    phi: :obj:`numpy.ndarray`
+        A (ncols :math:`\\times` npix :math:`\\times` nobj) model PSF array.
+    slitim_offsets: :obj:`numpy.ndarray`
+        A (ncols :math:`\\times` 2 :math:`\\times` nobj) array of object
+        offsets, in pixels.
+    col_data: :obj:`numpy.ndarray`
+        A (ncols :math:`\\times` npix) data array
+    col_inv_var: :obj:`numpy.ndarray`
+        A (ncols :math:`\\times` npix) data inverse variance array
+    snoise : float
+        A noise factor to be used in the cosmic ray detection calculation.
+    nsigma : float
+        Number of standard deviations permitted before a pixel is flagged as
+        bad.
+    max_iter : int
+        Maximum number of fit and search passes.
+    debug : bool, default False
+        If True, plot the model, data and limit of every column with new
+        cosmic rays.
+
+    Returns
+    -------
+    crs: :obj:`numpy.ndarray`
+        (ncols :math:`\\times` npix) boolean array, True for cosmic rays.
+    """
+    n_cols, n_x, n_o = phi.shape
+
+    var_use = np.inf * np.ones_like(col_inv_var)
+    good = col_inv_var > 0
+    var_use[good] = 1 / col_inv_var[good] + (snoise * col_data[good]) ** 2
+    limit = nsigma * np.sqrt(var_use)
+
+    # Create a model matrix for linear regression: each object's profile,
+    # and its gradient across the slit.
+    obj_centers = slitim_offsets[:, 1] + n_x // 2
+    x_ix = np.arange(n_x)
+    x_mat = np.concatenate(
+        [phi, phi * (x_ix[None, :, None] - obj_centers[:, None, :])], axis=2)
+
+    crs = np.zeros((n_cols, n_x), dtype=bool)
+    for _ in range(max(max_iter, 1)):
+        # Now we fit a model to the col_data using standard (unweighted)
+        # linear regression, leaving out any cosmic rays found so far.
+        x_use = np.where(crs[:, :, None], 0., x_mat)
+        x_t = x_use.transpose(0, 2, 1)
+        xtx = np.matmul(x_t, x_use)
+        try:
+            xtx_inv = np.linalg.inv(xtx)
+        except np.linalg.LinAlgError:
+            # Some column has a degenerate model (e.g. an object entirely
+            # off the chip). Fall back to the pseudo-inverse there.
+            xtx_inv = np.empty_like(xtx)
+            for c_ix in range(n_cols):
+                try:
+                    xtx_inv[c_ix] = np.linalg.inv(xtx[c_ix])
+                except np.linalg.LinAlgError:
+                    xtx_inv[c_ix] = np.linalg.pinv(xtx[c_ix])
+        beta = np.matmul(np.matmul(xtx_inv, x_t), col_data[:, :, None])
+        y_hat = np.maximum(np.matmul(x_mat, beta)[:, :, 0], 0)
+
+        new_bad = (col_data > y_hat + limit) & ~crs
+        if debug:
+            for c_ix in np.where(np.any(new_bad, axis=1))[0]:
+                plt.clf()
+                plt.plot(y_hat[c_ix], label='exp')
+                plt.plot(col_data[c_ix], label='data')
+                plt.plot(y_hat[c_ix] + limit[c_ix], label='limit')
+                plt.pause(.001)
+        if not np.any(new_bad):
+            break
+        crs |= new_bad
+
+    return crs
 
 
 def find_additional_crs(phi, slitim_offsets, col_data, col_inv_var,
@@ -31,7 +139,10 @@ def find_additional_crs(phi, slitim_offsets, col_data, col_inv_var,
 
       .. math::
           var = \\frac{1}{\\verb+col_inv_var+ + ( \\verb+snoise+ \\times \\verb+coldata+ )^2}
-    
+
+    This searches a single column; see :any:`find_order_crs` to search
+    every column of an order at once.
+
     Parameters
     ----------
     phi: :obj:`numpy.ndarray`
@@ -53,48 +164,10 @@ def find_additional_crs(phi, slitim_offsets, col_data, col_inv_var,
     new_bad: :obj:`numpy.ndarray`
         Array of indices of bad pixels in ``col_data``.
     """
-    n_o = phi.shape[1]  # Number of objects.
-    n_x = len(col_data)
-
-    var_use = np.inf * np.ones_like(col_inv_var)
-    good = col_inv_var > 0
-    var_use[good] = 1 / col_inv_var[good] + (snoise * col_data[good]) ** 2
-
-    # Create a model matrix for linear regression.
-    obj_centers = slitim_offsets[1] + n_x // 2
-    x_ix = np.arange(n_x)
-    x_mat = np.empty((2 * n_o, n_x))
-    for o_ix in range(n_o):
-        x_mat[o_ix] = phi[:, o_ix]
-        x_mat[o_ix + n_o] = phi[:, o_ix] * (x_ix - obj_centers[o_ix])
-
-    # Now we fit a model to the col_data with var_use, using standard
-    # linear regression. FIXME: Surely there is a reasonably scipy helper
-    # function???
-    x_mat = x_mat.T
-    # FIXME: Do we use weights? If so, faster computation is possible as W is
-    # sparse.
-    # performance is improved with no weights.
-    # w_mat = np.diag(1./var_use)
-    # xtw = np.dot(x_mat.T, w_mat) 
-    # beta = np.dot(np.dot(np.linalg.inv(np.dot(xtw, x_mat)), xtw), col_data)
-    try:
-        beta = np.dot(np.dot(np.linalg.inv(np.dot(x_mat.T, x_mat)), x_mat.T),
-                  col_data)
-    except:
-        # import pdb; pdb.set_trace()
-        pass
-    y_hat = np.maximum(np.dot(x_mat, beta), 0)
-
-    new_bad = np.where(col_data > y_hat + nsigma * np.sqrt(var_use))[0]
-    if debug and len(new_bad) > 0:
-        plt.clf()
-        plt.plot(y_hat, label='exp')
-        plt.plot(col_data, label='data')
-        plt.plot(y_hat + nsigma * np.sqrt(var_use), label='limit')
-        plt.pause(.001)
-        
-    return new_bad
+    crs = find_order_crs(phi[None], np.asarray(slitim_offsets)[None],
+                         col_data[None], col_inv_var[None], snoise=snoise,
+                         nsigma=nsigma, debug=debug)
+    return np.where(crs[0])[0]
 
 
 def subtract_scattered_light(data, mask):
@@ -126,6 +199,418 @@ def subtract_scattered_light(data, mask):
     """
     return data
 
+def fit_gaussians(x, y, amplitude=None, mean=None, stddev=None, max_iter=30,
+                  rtol=1e-10):
+    """
+    Fit a Gaussian to each of a batch of line profiles at once.
+
+    Each row of ``y`` is fitted (by unweighted least squares, without a
+    background term) with
+
+    .. math::
+        A \\exp \\left( - \\frac{(x - \\mu)^2}{2 \\sigma^2} \\right)\\textrm{.}
+
+    The initial estimates are taken from the moments of the profiles,
+    unless given. The fit then makes damped Gauss-Newton
+    (Levenberg-Marquardt) iterations on the amplitude, centre and width of
+    every line together, with one batched 3x3 solve per iteration. Each
+    line keeps its own damping factor, and only accepts steps that reduce
+    its residuals.
+
+    Parameters
+    ----------
+    x: :obj:`numpy.ndarray`
+        (nlines, npix) pixel co-ordinates of each profile.
+    y: :obj:`numpy.ndarray`
+        (nlines, npix) profiles to fit.
+    amplitude, mean, stddev: :obj:`numpy.ndarray`, optional
+        (nlines) initial estimates. By default, the peak value, and the
+        first and second moments about the peak.
+    max_iter: int, optional
+        Maximum number of iterations.
+    rtol: float, optional
+        The fit of a line has converged when its residual sum of squares
+        changes by less than this fraction.
+
+    Returns
+    -------
+    amplitude, mean, stddev: :obj:`numpy.ndarray`
+        (nlines) fitted parameters. The standard deviations are positive.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_lines = y.shape[0]
+    guess_amplitude, guess_mean, guess_stddev = _gaussian_moments(x, y)
+    params = np.array([
+        guess_amplitude if amplitude is None else amplitude,
+        guess_mean if mean is None else mean,
+        guess_stddev if stddev is None else stddev,
+    ], dtype=float).T
+
+    def residuals(p, rows=slice(None)):
+        z = (x[rows] - p[:, 1:2]) / p[:, 2:3]
+        g = np.exp(-0.5 * z ** 2)
+        return y[rows] - p[:, 0:1] * g, g, z
+
+    resid, g, z = residuals(params)
+    cost = np.sum(resid ** 2, axis=1)
+    damping = np.full(n_lines, 1e-3)
+    active = np.ones(n_lines, dtype=bool)
+    for _ in range(max_iter):
+        if not np.any(active):
+            break
+        # Jacobian of the model with respect to (amplitude, mean, stddev)
+        p = params[active]
+        a_g = p[:, 0:1] * g[active]
+        jac = np.stack([g[active], a_g * z[active] / p[:, 2:3],
+                        a_g * z[active] ** 2 / p[:, 2:3]], axis=2)
+        jtj = np.matmul(jac.transpose(0, 2, 1), jac)
+        jtr = np.matmul(jac.transpose(0, 2, 1), resid[active][:, :, None])
+        diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-30)
+        lhs = jtj + (damping[active, None] * diag)[:, :, None] * np.eye(3)
+        with np.errstate(all='ignore'):
+            try:
+                step = np.linalg.solve(lhs, jtr)[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.matmul(np.linalg.pinv(lhs), jtr)[:, :, 0]
+
+            trial = p + step
+            trial_resid, trial_g, trial_z = residuals(trial, active)
+            trial_cost = np.sum(trial_resid ** 2, axis=1)
+        better = trial_cost < cost[active]
+
+        # Accept the steps that reduced the residuals, and reduce the
+        # damping for those lines. Increase it for the others.
+        ix = np.where(active)[0]
+        accept = ix[better]
+        change = cost[accept] - trial_cost[better]
+        params[accept] = trial[better]
+        resid[accept] = trial_resid[better]
+        g[accept] = trial_g[better]
+        z[accept] = trial_z[better]
+        cost[accept] = trial_cost[better]
+        damping[accept] /= 10.
+        damping[ix[~better]] *= 10.
+
+        done = np.zeros(n_lines, dtype=bool)
+        done[accept] = change <= rtol * np.maximum(cost[accept], 1e-300)
+        done[ix[~better]] = damping[ix[~better]] > 1e10
+        active &= ~done
+
+    return params[:, 0], params[:, 1], np.abs(params[:, 2])
+
+
+def _gaussian_moments(x, y):
+    """
+    Moment-based initial estimates for :func:`fit_gaussians`.
+
+    The centre and width are the first and second moments of the positive
+    part of each profile, within 3 pixels of its peak.
+    """
+    peak = np.argmax(y, axis=1)
+    amplitude = y[np.arange(y.shape[0]), peak]
+    near = np.abs(np.arange(y.shape[1]) - peak[:, None]) <= 3
+    weights = np.where(near, np.maximum(y, 0), 0.)
+    total = np.sum(weights, axis=1)
+    total[total == 0] = 1.
+    mean = np.sum(weights * x, axis=1) / total
+    var = np.sum(weights * (x - mean[:, None]) ** 2, axis=1) / total
+    stddev = np.clip(np.sqrt(var), 0.5, y.shape[1] / 4.)
+    # Fall back to the peak pixel where there is no positive flux
+    no_flux = np.sum(weights, axis=1) == 0
+    mean[no_flux] = x[no_flux, peak[no_flux]]
+    stddev[no_flux] = 1.5
+    return amplitude, mean, stddev
+
+
+class ExtractionWeights(object):
+    """
+    Optimal extraction weights, stored as one short vector per column.
+
+    The weights from a 1D extraction are only non-zero within the cutout
+    around each order, so rather than a dense ``(nobj, nx, ny)`` array the
+    size of the detector, this stores the ``nx_cutout`` weights of each
+    order and spectral pixel (a "row") along with the spatial pixel they
+    start at. Where the cutouts of two orders overlap, the weight of a pixel
+    is the sum of the weights of both orders, as it is in the dense array
+    returned by :meth:`todense`.
+
+    The rows are only read when the weights of their order are needed, so
+    the rows may be e.g. a column of a memory-mapped FITS table.
+
+    Weights are always indexed as ``(x, y)``, i.e. they are never
+    transposed.
+
+    Parameters
+    ----------
+    rows: :obj:`numpy.ndarray`
+        ``(nrows, nx_cutout, nobj)`` weights of every stored row.
+    row_index: :obj:`numpy.ndarray`
+        ``(norders, ny)`` index into ``rows`` for each order and spectral
+        pixel, or -1 where all weights are zero.
+    x_start: :obj:`numpy.ndarray`
+        ``(norders, ny)`` spatial pixel of the first pixel of every row.
+    nx: int
+        The (binned) size of the detector in the spatial direction.
+    x_range: :obj:`numpy.ndarray`, optional
+        ``(2, norders)`` first and last-plus-one spatial pixel with a
+        non-zero weight in each order. Computed if not given.
+    """
+    def __init__(self, rows, row_index, x_start, nx, x_range=None):
+        self.rows = rows
+        self.row_index = row_index
+        self.x_start = x_start
+        self.nx = int(nx)
+        if x_range is None:
+            nonzero = np.any(rows != 0, axis=(1, 2))
+            active = (row_index >= 0) & nonzero[np.maximum(row_index, 0)]
+            x_range = self._x_range(active, x_start, rows.shape[1], self.nx)
+        self.x_range = x_range
+
+    @staticmethod
+    def _x_range(active, x_start, width, nx):
+        return np.array([np.where(active, x_start, nx).min(axis=1),
+                         np.where(active, x_start + width, 0).max(axis=1)])
+
+    @classmethod
+    def from_cube(cls, weights, x_start, nx):
+        """
+        Create the weights from a cube of per-order weights.
+
+        Parameters
+        ----------
+        weights: :obj:`numpy.ndarray`
+            ``(norders, ny, nx_cutout, nobj)`` weights of every cutout
+            pixel.
+        x_start: :obj:`numpy.ndarray`
+            ``(norders, ny)`` spatial pixel of the first pixel of every
+            cutout.
+        nx: int
+            The (binned) size of the detector in the spatial direction.
+
+        Returns
+        -------
+        :class:`ExtractionWeights`
+        """
+        norders, ny, width, nobj = weights.shape
+        return cls(weights.reshape((norders * ny, width, nobj)),
+                   np.arange(norders * ny).reshape((norders, ny)),
+                   x_start, nx)
+
+    @classmethod
+    def from_strips(cls, weights, strips):
+        """
+        Create the weights from an order strip cube of weights.
+
+        Parameters
+        ----------
+        weights: :obj:`numpy.ndarray`
+            ``strips.shape + (nobj, )`` weights.
+        strips: :class:`~polyfit.orderstrip.OrderStripCube`
+            The order strips the weights were computed on.
+
+        Returns
+        -------
+        :class:`ExtractionWeights`
+        """
+        return cls.from_cube(weights, strips.x_start, strips.nx)
+
+    @property
+    def norders(self):
+        return self.row_index.shape[0]
+
+    @property
+    def nobj(self):
+        return self.rows.shape[2]
+
+    @property
+    def shape(self):
+        """The shape of the equivalent dense array, ``(nobj, nx, ny)``."""
+        return (self.nobj, self.nx, self.row_index.shape[1])
+
+    def _overlapping(self, x_ix):
+        # Orders with non-zero weights in the spatial range of x_ix. Pixel
+        # 0 is special-cased, as it is where edge pixels are read from.
+        on_chip = x_ix[x_ix > 0]
+        x_lo = np.min(on_chip) if on_chip.size else self.nx
+        x_hi = np.max(x_ix)
+        overlap = (self.x_range[0] <= x_hi) & (self.x_range[1] > x_lo)
+        if np.any(x_ix == 0):
+            overlap |= self.x_range[0] <= 0
+        return np.where(overlap)[0]
+
+    def gather(self, obj, x_ix, y_ix):
+        """
+        Look up the weights of one object at arbitrary detector pixels.
+
+        Only the rows of orders that overlap the requested pixels are read.
+
+        Parameters
+        ----------
+        obj: int or None
+            The object index. If None, the weights of all objects are
+            returned, along a new last axis.
+        x_ix, y_ix: :obj:`numpy.ndarray`
+            Spatial and spectral pixel indices, which must broadcast
+            against each other. Both must be on the detector.
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            The weights, equal to ``self.todense()[obj][x_ix, y_ix]``.
+        """
+        x_ix, y_ix = np.broadcast_arrays(x_ix, y_ix)
+        width = self.rows.shape[1]
+        obj = slice(None) if obj is None else obj
+        out = np.zeros(x_ix.shape + self.rows[0, 0, obj].shape)
+        for m in self._overlapping(x_ix):
+            r_ix = self.row_index[m, y_ix]
+            k_ix = x_ix - self.x_start[m, y_ix]
+            valid = (r_ix >= 0) & (k_ix >= 0) & (k_ix < width)
+            values = self.rows[np.maximum(r_ix, 0),
+                               np.clip(k_ix, 0, width - 1), obj]
+            if values.ndim > valid.ndim:
+                valid = valid[..., None]
+            out += np.where(valid, values, 0.)
+        return out
+
+    def update_rows(self, order, y_ix, rows):
+        """
+        Replace the stored rows of some spectral pixels of one order.
+
+        Parameters
+        ----------
+        order: int
+            The order index.
+        y_ix: :obj:`numpy.ndarray`
+            The spectral pixels to replace.
+        rows: :obj:`numpy.ndarray`
+            ``(len(y_ix), nx_cutout, nobj)`` new weights. They start at the
+            same spatial pixel as the rows they replace.
+
+        Raises
+        ------
+        ValueError
+            If any of the rows is not stored (e.g. in weights read from a
+            table, which omits rows with no non-zero weights).
+        """
+        r_ix = self.row_index[order, y_ix]
+        if np.any(r_ix < 0):
+            raise ValueError('Cannot update weights that are not stored')
+        self.rows[r_ix] = rows
+        # Extend the range of the order, if it has grown
+        nonzero = np.any(rows != 0, axis=(1, 2))
+        if np.any(nonzero):
+            x_start = self.x_start[order, y_ix][nonzero]
+            self.x_range[0, order] = min(self.x_range[0, order],
+                                         np.min(x_start))
+            self.x_range[1, order] = max(self.x_range[1, order],
+                                         np.max(x_start) + rows.shape[1])
+
+    def _pixels(self):
+        # Detector pixels of every stored row, order by order
+        width = self.rows.shape[1]
+        for m in range(self.norders):
+            y_ix = np.where(self.row_index[m] >= 0)[0]
+            x_ix = self.x_start[m, y_ix][:, None] + np.arange(width)
+            on_chip = (x_ix >= 0) & (x_ix < self.nx)
+            yield (self.rows[self.row_index[m, y_ix]], on_chip,
+                   x_ix[on_chip],
+                   np.broadcast_to(y_ix[:, None], x_ix.shape)[on_chip])
+
+    def footprint(self):
+        """
+        Return a detector-shaped mask of pixels with a non-zero weight.
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            ``(nx, ny)`` boolean array.
+        """
+        mask = np.zeros(self.shape[1:], dtype=bool)
+        for rows, on_chip, x_ix, y_ix in self._pixels():
+            mask[x_ix, y_ix] |= np.any(rows != 0, axis=2)[on_chip]
+        return mask
+
+    def todense(self):
+        """
+        Materialize the weights as a dense, detector-sized array.
+
+        This is mostly useful for debugging and display.
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            ``(nobj, nx, ny)`` array of weights.
+        """
+        dense = np.zeros(self.shape)
+        # Within a single order, every pixel is unique.
+        for rows, on_chip, x_ix, y_ix in self._pixels():
+            for k in range(self.nobj):
+                dense[k][x_ix, y_ix] += rows[:, :, k][on_chip]
+        return dense
+
+    def to_table(self):
+        """
+        Convert the weights to a compact table, e.g. for the WGT extension.
+
+        There is one row per order and spectral pixel with any non-zero
+        weight.
+
+        Returns
+        -------
+        :obj:`astropy.table.Table`
+            Table with columns ``ORDER``, ``Y``, ``XSTART`` and ``WEIGHTS``
+            (``nx_cutout`` by ``nobj``), and the detector and cube
+            dimensions in its ``meta``.
+        """
+        m_ix, y_ix = np.nonzero(self.row_index >= 0)
+        r_ix = self.row_index[m_ix, y_ix]
+        active = np.any(self.rows[r_ix] != 0, axis=(1, 2))
+        m_ix, y_ix, r_ix = m_ix[active], y_ix[active], r_ix[active]
+        table = Table([m_ix.astype(np.int16), y_ix.astype(np.int16),
+                       self.x_start[m_ix, y_ix].astype(np.int16),
+                       self.rows[r_ix]],
+                      names=('ORDER', 'Y', 'XSTART', 'WEIGHTS'))
+        table.meta.update({'NX': self.nx, 'NY': self.shape[2],
+                           'NORDERS': self.norders})
+        return table
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Create the weights from a table made by :meth:`to_table`.
+
+        The ``WEIGHTS`` column is used as is, and is only read as the
+        weights of each order are needed.
+
+        Parameters
+        ----------
+        table: :obj:`astropy.table.Table`
+            The weights table. The dimensions may be either in its ``meta``
+            or in the FITS header in ``meta['header']``, as they are once
+            read back from disk.
+
+        Returns
+        -------
+        :class:`ExtractionWeights`
+        """
+        meta = table.meta.get('header', table.meta)
+        norders, ny = meta['NORDERS'], meta['NY']
+        m_ix = np.asarray(table['ORDER'], dtype=int)
+        y_ix = np.asarray(table['Y'], dtype=int)
+        row_index = -np.ones((norders, ny), dtype=int)
+        row_index[m_ix, y_ix] = np.arange(len(table))
+        x_start = np.zeros((norders, ny), dtype=int)
+        x_start[m_ix, y_ix] = table['XSTART']
+        rows = table['WEIGHTS']
+        rows = getattr(rows, 'data', rows)
+        # Every row in the table has a non-zero weight, so the extent of
+        # each order does not need the weights themselves.
+        x_range = cls._x_range(row_index >= 0, x_start, rows.shape[1],
+                               meta['NX'])
+        return cls(rows, row_index, x_start, meta['NX'], x_range=x_range)
+
 
 class Extractor(object):
     """
@@ -168,11 +653,77 @@ class Extractor(object):
     cr_flag: integer, optional
         When we flag additional cosmic rays in the badpixmask, what value
         should we use? Default is ``8``.
+
+    n_workers: integer, optional
+        Number of processes to spread the orders over during extraction.
+        The results are identical to a serial extraction. Default is ``1``
+        (no worker processes).
+
+    snoise: float, optional
+        Fractional noise added to the data variance when searching for
+        additional cosmic rays. Default is ``0.1``.
+
+    nsigma: float, optional
+        Number of standard deviations above the model at which a pixel is
+        flagged as a cosmic ray. Default is ``6``.
+
+    cr_max_iter: integer, optional
+        Maximum number of passes of the cosmic ray search, re-fitting the
+        model without the pixels already flagged between passes. Default is
+        ``1`` (a single pass).
+
+    dtype: :obj:`numpy.dtype`, optional
+        Floating-point type of the bulk extraction arrays: the smoothed
+        inverse variance, the gathered order strips, the extraction weights
+        and the extracted spectra. ``numpy.float32`` halves the memory
+        needed to extract a frame. The per-order arithmetic, including the
+        normal-equation solves, is always done in double precision. Default
+        is ``numpy.float64``.
+
+    memory_budget: float, optional
+        Approximate limit, in MB, on the working memory of a 1D extraction.
+        If given, the orders are extracted in bands, and only the detector
+        rows spanned by each band (plus a halo for the spatial smoothing of
+        the variance) are read and processed at a time, so that memory does
+        not scale with the detector size. This excludes the extracted
+        spectra and weights themselves. Default is ``None`` (no limit: the
+        whole frame is processed at once).
+
+    plan: :class:`~polyfit.plan.ExtractionPlan`, optional
+        A precomputed extraction geometry for this arm, mode and binning.
+        If given, the binned models, slit tilt and order strips are taken
+        from the plan rather than computed from the arm, which then does
+        not need :meth:`spectral_format_with_matrix
+        <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` to have
+        been run for extraction.
+
+    orders: list of int, optional
+        The order numbers to extract. If given, every extraction, model and
+        weight array only covers these orders, in increasing order number,
+        and only the detector rows they span are read and processed, so
+        that the extraction time scales with the number of orders. The
+        selected order numbers are kept in :attr:`orders`. Where orders
+        overlap on the detector, the 2D extraction of a selected order does
+        not include the weights of its unselected neighbours. Default is
+        ``None`` (all orders).
+
+    wavelength_range: tuple of float, optional
+        ``(wmin, wmax)``: only extract the orders whose wavelength scale
+        overlaps this range, in the units of the wavelength model. May be
+        combined with ``orders``. Default is ``None`` (all orders).
+
+    progress: callable, optional
+        If given, called as ``progress(i, norders)`` in the calling process
+        once order ``i`` has been extracted, e.g. to log progress. Default
+        is ``None`` (no progress reports).
     """
     def __init__(self, polyspect_instance, slitview_instance,
                  gain=1.0, rnoise=3.0, cr_flag=8,
                  badpixmask=None, transpose=False,
-                 vararray=None):
+                 vararray=None, n_workers=1, snoise=0.1, nsigma=6,
+                 cr_max_iter=1, dtype=np.float64, memory_budget=None,
+                 plan=None, orders=None, wavelength_range=None,
+                 progress=None):
         self.arm = polyspect_instance
         self.slitview = slitview_instance
         self.transpose = transpose
@@ -181,24 +732,86 @@ class Extractor(object):
         self.vararray = vararray
         self.badpixmask = badpixmask
         self.cr_flag = cr_flag
+        self.n_workers = n_workers
+        self.snoise = snoise
+        self.nsigma = nsigma
+        self.cr_max_iter = cr_max_iter
+        self.dtype = np.dtype(dtype)
+        self.memory_budget = memory_budget
+        self.plan = plan
+        self.progress = progress
+        self.num_additional_crs = 0
+        self.crs_per_order = None
+        self.num_rejected_lines = 0
+        self._order_strips = None
+        # The inverse variance models of the frame being extracted, and the
+        # (data, vararray, badpixmask) they were computed from
+        self._inv_var_refs = None
+        self._inv_var_cache = {}
+
+        if plan is not None:
+            if not plan.matches(self.arm):
+                raise ValueError('The extraction plan is for a different '
+                                 'arm, mode or binning')
+            self.slit_tilt = plan.slit_tilt
+            w_map = plan.w_map
+        else:
+            # FIXME: This warning could probably be neater.
+            if not isinstance(self.arm.x_map, np.ndarray):
+                raise UserWarning('Input polyspect_instance requires'
+                                  'spectral_format_with matrix to be run.')
+
+            # To aid in 2D extraction, let's explicitly compute the y offsets
+            # corresponding to these x offsets...
+            # The "matrices" map pixels back to slit co-ordinates, so the
+            # tilt follows from what happens to the +x direction. It may
+            # have been loaded with the maps already.
+            self.slit_tilt = self.arm.slit_tilt
+            if self.slit_tilt is None:
+                self.slit_tilt = geometry.tilt(self.arm.matrices)
+            w_map = self.arm.w_map
+
+        # The orders to extract, as indices into the models (None for all
+        # of them), and their order numbers
+        self._order_ix = self._select_orders(w_map, orders, wavelength_range)
+        self.orders = self.arm.m_min + (np.arange(w_map.shape[0])
+                                        if self._order_ix is None
+                                        else self._order_ix)
+        if self._order_ix is not None:
+            self.slit_tilt = self.slit_tilt[self._order_ix]
+
+    def _select_orders(self, w_map, orders, wavelength_range):
+        """
+        Find the indices of the orders selected for extraction.
 
-        # FIXME: This warning could probably be neater.
-        if not isinstance(self.arm.x_map, np.ndarray):
-            raise UserWarning('Input polyspect_instance requires'
-                              'spectral_format_with matrix to be run.')
-
-        # To aid in 2D extraction, let's explicitly compute the y offsets
-        # corresponding to these x offsets...
-        # The "matrices" map pixels back to slit co-ordinates.
-        ny = self.arm.x_map.shape[1]
-        nm = self.arm.x_map.shape[0]
-        self.slit_tilt = np.zeros((nm, ny))
-        for i in range(nm):
-            for j in range(ny):
-                invmat = np.linalg.inv(self.arm.matrices[i, j])
-                # What happens to the +x direction?
-                x_dir_map = np.dot(invmat, [1, 0])
-                self.slit_tilt[i, j] = x_dir_map[1] / x_dir_map[0]
+        Returns
+        -------
+        :obj:`numpy.ndarray` or None
+            The selected indices into the models, or ``None`` if every
+            order is selected.
+        """
+        if orders is None and wavelength_range is None:
+            return None
+        nm = w_map.shape[0]
+        selected = np.ones(nm, dtype=bool)
+        if orders is not None:
+            order_ix = np.asarray(orders, dtype=int).ravel() - self.arm.m_min
+            if np.any((order_ix < 0) | (order_ix >= nm)):
+                raise ValueError('Orders must be between {0:d} and {1:d}'
+                                 .format(self.arm.m_min,
+                                         self.arm.m_min + nm - 1))
+            selected[:] = False
+            selected[order_ix] = True
+        if wavelength_range is not None:
+            wmin, wmax = sorted(wavelength_range)
+            with np.errstate(invalid='ignore'):
+                selected &= (np.nanmax(w_map, axis=1) >= wmin) & \
+                            (np.nanmin(w_map, axis=1) <= wmax)
+        if not np.any(selected):
+            raise ValueError('No orders selected for extraction')
+        if np.all(selected):
+            return None
+        return np.where(selected)[0]
 
     def bin_models(self):
         """
@@ -213,6 +826,9 @@ class Extractor(object):
         values for each binned pixel are assumed to be equivalent to the average
         value of all physical pixels that are part of the binned pixel.
 
+        If the extractor has an extraction :attr:`plan`, its binned models are
+        returned instead. Only the selected :attr:`orders` are returned.
+
         Returns
         -------
         x_map: :obj:`numpy.ndarray`
@@ -224,63 +840,107 @@ class Extractor(object):
         matrices: :obj:`numpy.ndarray`
             Binned version of the matrices array
         """
-        if self.arm.xbin == 1 and self.arm.ybin == 1:
-            return self.arm.x_map, self.arm.w_map, self.arm.blaze, \
-                   self.arm.matrices
-        # Start by getting the order number. This should never change.
-        n_orders = self.arm.x_map.shape[0]
-
-        x_map = self.arm.x_map.copy()
-        w_map = self.arm.w_map.copy()
-        blaze = self.arm.blaze.copy()
-        matrices = self.arm.matrices.copy()
-        # The best way to do this is to firstly do all the ybinning, and then do
-        # the x binning
-        if self.arm.ybin > 1:
-            # Now bin the x_map, firstly in the spectral direction
-            # We do this by reshaping the array by adding another dimension of
-            # length ybin and then averaging over this axis
-            x_map = np.mean(x_map.reshape(n_orders,
-                                          int(self.arm.szy / self.arm.ybin),
-                                          self.arm.ybin), axis=2)
-
-            # Now do the same for the wavelength scale and blaze where necessary
-            w_map = np.mean(w_map.reshape(n_orders,
-                                          int(self.arm.szy / self.arm.ybin),
-                                          self.arm.ybin), axis=2)
-
-            blaze = np.mean(blaze.reshape(n_orders,
-                                          int(self.arm.szy / self.arm.ybin),
-                                          self.arm.ybin), axis=2)
-            # The matrices are a bit harder to work with, but still the same
-            # principle applies.
-            matrices = np.mean(matrices.reshape(n_orders,
-                                                int(
-                                                    self.arm.szy /
-                                                    self.arm.ybin),
-                                                self.arm.ybin, 2, 2), axis=2)
-
-        if self.arm.xbin > 1:
-            # Now, naturally, the actualy x values must change according to the
-            # xbin
-            x_map /= self.arm.xbin
-            # The w_map and blaze remain unchanged by this. 
-
-        # Now we must modify the values of the [0,0] and [1,1] elements of
-        # each matrix according to the binning to reflect the now size of
-        # binned pixels.
-        rescale_mat = np.array([[self.arm.xbin, 0], [0, self.arm.ybin]])
-        matrices = np.dot(matrices, rescale_mat)
-
-        return x_map, w_map, blaze, matrices
-
-    def make_pixel_model(self):
+        if self.plan is not None:
+            models = self.plan.x_map, self.plan.w_map, self.plan.blaze, \
+                self.plan.matrices
+        else:
+            models = bin_arm_models(self.arm)
+        if self._order_ix is not None:
+            models = tuple(model[self._order_ix] for model in models)
+        return models
+
+    def order_strips(self):
+        """
+        Return the extraction windows of every order as an order strip cube.
+
+        The :class:`~polyfit.orderstrip.OrderStripCube` only depends on the
+        (binned) models and the slit length, so it is computed once (or
+        taken from the extraction :attr:`plan`) and re-used by every
+        extraction with this instance.
+
+        Returns
+        -------
+        strips: :class:`~polyfit.orderstrip.OrderStripCube`
+            The index map between the detector and the rectified cube.
+        """
+        if self._order_strips is None and self.plan is not None:
+            if self._order_ix is None:
+                self._order_strips = self.plan.order_strips()
+            else:
+                self._order_strips = OrderStripCube.from_cutouts(
+                    self.plan.x_map[self._order_ix],
+                    self.plan.nx_cutouts[self._order_ix], self.plan.nx)
+        elif self._order_strips is None:
+            try:
+                x_map, w_map, blaze, matrices = self.bin_models()
+            except Exception:
+                raise RuntimeError('Extraction failed, unable to bin models.')
+            self._order_strips = OrderStripCube(
+                x_map, matrices, self.slitview.slit_length,
+                int(self.arm.szx / self.arm.xbin))
+        return self._order_strips
+
+    def tilted_strips(self, x_map, matrices, centroids, slit_ix):
+        """
+        Return the precomputed gather for 2D extraction.
+
+        The result only depends on the geometry, so it is cached (keyed on
+        a digest of its inputs) and shared with any other extraction, by
+        this or any other instance, with the same models and slit
+        centroids.
+
+        Parameters
+        ----------
+        x_map, matrices: :obj:`numpy.ndarray`
+            The binned models, from :meth:`bin_models`.
+        centroids: :obj:`numpy.ndarray`
+            The slit centroids, as returned by the slit viewer.
+        slit_ix: :obj:`numpy.ndarray`
+            The slit position of each centroid.
+
+        Returns
+        -------
+        gather: :class:`~polyfit.orderstrip.TiltedStripGather`
+            The tap indices and fractions for every order strip pixel.
+        """
+        strips = self.order_strips()
+        digest = hashlib.sha1()
+        for arr in (x_map, matrices, self.slit_tilt, centroids, slit_ix,
+                    strips.nx_cutouts):
+            arr = np.ascontiguousarray(arr)
+            digest.update(str(arr.shape).encode())
+            digest.update(arr.view(np.uint8))
+        digest.update(str((strips.nx, self.transpose)).encode())
+        key = digest.hexdigest()
+
+        if key in _TILTED_GATHERS:
+            _TILTED_GATHERS[key] = _TILTED_GATHERS.pop(key)
+        else:
+            _TILTED_GATHERS[key] = TiltedStripGather(
+                strips, x_map, matrices, self.slit_tilt, centroids,
+                slit_ix, transpose=self.transpose)
+            while len(_TILTED_GATHERS) > _TILTED_GATHERS_SIZE:
+                _TILTED_GATHERS.popitem(last=False)
+        return _TILTED_GATHERS[key]
+
+    def make_pixel_model(self, progress=None):
         """
         Based on the xmod and the slit viewer image, create a complete model image, 
         where flux versus wavelength pixel is constant. As this is designed for 
         comparing to flats, normalisation is to the median of the non-zero pixels in the
         profile.
-        
+
+        The profile kernels of every order are computed at once on the
+        order strips (see :meth:`order_strips`), then written into the
+        detector image order by order. Pixels that fall off the detector
+        are left out.
+
+        Parameters
+        ----------
+        progress: callable, optional
+            If given, called as ``progress(i, norders)`` once the model of
+            order index ``i`` is in place.
+
         Returns
         -------
         model: :obj:`numpy.ndarray`
@@ -308,45 +968,36 @@ class Extractor(object):
             pixel_model = np.zeros( (ny, nx) ) 
         else:
             pixel_model = np.zeros( (nx, ny) )
-        
-        # Loop through all orders then through all y pixels.        
+
+        # Create our column cutouts for the PSF, for every order and y pixel
+        # at once. The cutout size is based on the largest slit
+        # magnification for each order.
+        # FIXME: Profiles should be convolved by a detector pixel,
+        # but binning has to be taken into account properly!
+        # Interpolating at (offset / scale) onto the profile is the same as
+        # interpolating at offset onto profile_y_microns / scale.
+        strips = self.order_strips()
+        phi = np.interp(strips.x_offsets * matrices[:, :, 0, 0, None],
+                        profile_y_microns, profile)
+        outside = (np.arange(strips.shape[2]) >=
+                   strips.nx_cutouts[:, None, None]) | \
+            ~strips.good_cols[:, :, None]
+        phi[np.broadcast_to(outside, phi.shape)] = 0.
+
+        # Normalise to the median of the non-zero pixels. This is neater
+        # if it normalises to the median, but normalisation can occur
+        # later, and shouldn't occur wavelength by wavelength.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            phi /= np.sum(phi, axis=2)[:, :, None]
+
+        # Put the cutouts into our 2D array, one order at a time. Where the
+        # cutouts of neighbouring orders overlap, the later order wins.
         for i in range(nm):
-            print("Creating order: {0:d}".format(i))
-
-            # Create an empty model array. Base the size on the largest
-            # slit magnification for this order.
-            nx_cutout = int(np.ceil(self.slitview.slit_length / np.min(
-                matrices[i, :, 0, 0])))
-            phi = np.empty((nx_cutout))
-
-            for j in range(ny):
-                # Create an array of y pixels based on the scale for this
-                # order and pixel.
-                profile_y_pix = profile_y_microns / matrices[i, j, 0, 0]
-
-                # Create our column cutout for the data and the PSF, then put
-                # it back into our 2D array. 
-                
-                # FIXME: Is "round" most correct on the next line???
-                # FIXME: Profiles should be convolved by a detector pixel,
-                # but binning has to be taken into account properly!
-                x_ix = int(np.round(
-                    x_map[i, j])) - nx_cutout // 2 + \
-                       np.arange(nx_cutout, dtype=int) + nx // 2
-                phi = np.interp(
-                        x_ix - x_map[i, j] - nx // 2, profile_y_pix,
-                        profile)
-                        
-                # Normalise to the median of the non-zero pixels. This is neater
-                # if it normalises to the median, but normalisation can occur 
-                # later, and shouldn't occur wavelength by wavelength.
-                phi /= np.sum(phi[phi != 0])
-                
-                if self.transpose:
-                    pixel_model[j, np.minimum(x_ix,nx-1)] = phi
-                else:
-                    pixel_model[np.minimum(x_ix,nx-1), j] = phi
-                    
+            strips.scatter(phi[strips.order(i)], pixel_model,
+                           transpose=self.transpose, order=i)
+            if progress is not None:
+                progress(i, nm)
+
         return pixel_model
 
     def one_d_extract(self, data=None, fl=None, correct_for_sky=True,
@@ -384,7 +1035,7 @@ class Extractor(object):
 
         debug_crs : bool, optional
             Passed along as the ``debug`` parameter to
-            :any:`find_additional_crs`.
+            :any:`find_order_crs`.
 
         vararray : :obj:`numpy.ndarray` , optional
             If given, the instance's `vararray` attribute will be updated
@@ -402,7 +1053,7 @@ class Extractor(object):
         extracted_var: :obj:`numpy.ndarray`
             Extracted variance as a function of pixel along the spectral
             direction
-        extraction_weights: :obj:`numpy.ndarray`
+        extraction_weights: :class:`ExtractionWeights`
             Extraction weights as a function of pixel along the spectral
             direction
 
@@ -418,25 +1069,262 @@ class Extractor(object):
             if fl is None:
                 raise ValueError("Must input data or file")
             else:
-                data = pyfits.getdata(fl)
+                # With a memory budget, only the band of rows being
+                # extracted is read from the file at a time
+                data = pyfits.getdata(fl,
+                                      memmap=self.memory_budget is not None)
+
+        # Our profiles...
+        # FIXME: Consider carefully whether there is a way to extract x-centroids
+        # as well for PRV, as part of slitim_offsets below.
+        profiles = self.slitview.object_slit_profiles(
+            arm=self.arm.arm, correct_for_sky=correct_for_sky,
+            used_objects=used_objects, append_sky=use_sky
+        )
+
+        return self._one_d_sweep(data, profiles,
+                                 [np.arange(profiles.shape[0])],
+                                 debug_crs=debug_crs)[0]
 
+    def extract_configurations(self, data, configurations,
+                               correct_for_sky=True, debug_crs=False,
+                               vararray=None, two_d=True):
+        """
+        Extract several object/sky configurations in a single pass.
+
+        This is equivalent to calling :meth:`one_d_extract` (and, optionally,
+        :meth:`two_d_extract`) once per configuration, but the frame is only
+        gathered into order strips once, the slit profile kernels are only
+        built once for the union of all objects (and sky) requested, and the
+        cosmic ray search is done once, against that union model. Each
+        configuration then only requires its own small normal-matrix solve.
+
+        Because the cosmic ray search happens before any weights are
+        computed, the weights of every configuration are computed with the
+        additional cosmic rays already masked. This matches what sequential
+        calls give for all but the first configuration, where pixels flagged
+        by an earlier call are already in the bad pixel mask.
+
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            Image data, transposed so that dispersion is in the "y" direction.
+
+        configurations: list of tuple
+            ``(used_objects, use_sky)`` pairs, with the same meaning as the
+            arguments of the same name to :meth:`one_d_extract`.
+
+        correct_for_sky: bool, optional
+            Do we correct the object slit profiles for sky? Should be yes for
+            objects and no for flats/arcs.
+
+        debug_crs : bool, optional
+            Passed along as the ``debug`` parameter to
+            :any:`find_order_crs`.
+
+        vararray : :obj:`numpy.ndarray` , optional
+            If given, the instance's `vararray` attribute will be updated
+            to hold this array.
+
+        two_d: bool, optional
+            Return the fluxes and variances from :meth:`two_d_extract` (the
+            default) rather than from the 1D extraction.
+
+        Raises
+        ------
+        ValueError
+            If no configurations are given.
+
+        Returns
+        -------
+        results: list of tuple
+            One ``(extracted_flux, extracted_var, extraction_weights)`` tuple
+            per configuration, in the order given.
+        """
+        if len(configurations) == 0:
+            raise ValueError("Must give at least one configuration")
+
+        self.num_additional_crs = 0
+        if vararray is not None:
+            self.vararray = vararray
+
+        profiles, profile_sets = self._configuration_profiles(
+            configurations, correct_for_sky)
+        one_d_results = self._one_d_sweep(data, profiles, profile_sets,
+                                          debug_crs=debug_crs,
+                                          weights_after_crs=True)
+        if not two_d:
+            return one_d_results
+
+        weights = [w for _, _, w in one_d_results]
+        two_d_results = self._two_d_sweep(data, weights)
+        return [(flux, var, w) for (flux, var), w in
+                zip(two_d_results, weights)]
+
+    def reextract(self, data, results, changed, configurations,
+                  correct_for_sky=True, weights_after_crs=True,
+                  debug_crs=False):
+        """
+        Update a 1D extraction after some detector pixels have changed.
+
+        Only the columns (order and spectral pixel) whose extraction window
+        contains a changed pixel are extracted again, including the search
+        for additional cosmic rays; their fluxes, variances and weights are
+        patched in ``results`` in place. As every column is extracted
+        independently, the result is the same as a new extraction with the
+        current bad pixel mask, at a fraction of the cost. Typical changed
+        pixels are those newly flagged in the bad pixel mask, e.g. cosmic
+        rays flagged by another extraction or an updated bad pixel mask.
+
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            The image data that was extracted.
+
+        results: list of tuple
+            ``(extracted_flux, extracted_var, extraction_weights)`` for
+            each configuration, as returned by
+            :meth:`extract_configurations` with ``two_d=False``. For a
+            single result of :meth:`one_d_extract`, pass it in a list.
+
+        changed: :obj:`numpy.ndarray`
+            Boolean image, the same shape as the data, True for the pixels
+            that have changed. If the mask was modified in place, with
+            pixels that are no longer bad, the cached inverse variance
+            models are discarded.
+
+        configurations: list of tuple
+            ``(used_objects, use_sky)`` pairs, as originally extracted.
+
+        correct_for_sky: bool, optional
+            As originally extracted.
+
+        weights_after_crs: bool, optional
+            As for :meth:`_one_d_extract_order`. Results of
+            :meth:`extract_configurations` use True (the default), those
+            of :meth:`one_d_extract` use False.
+
+        debug_crs : bool, optional
+            Passed along as the ``debug`` parameter to
+            :any:`find_order_crs`.
+
+        Raises
+        ------
+        ValueError
+            If the numbers of results and configurations differ.
+
+        Returns
+        -------
+        affected: :obj:`numpy.ndarray`
+            ``(norders, ny)`` boolean array, True for the columns extracted
+            again.
+        """
+        if len(results) != len(configurations):
+            raise ValueError("Must give one configuration per result")
         try:
             x_map, w_map, blaze, matrices = self.bin_models()
         except Exception:
             raise RuntimeError('Extraction failed, unable to bin models.')
 
-        ny = x_map.shape[1]
-        nm = x_map.shape[0]
-        nx = int(self.arm.szx / self.arm.xbin)
+        self.num_additional_crs = 0
+        changed = np.asarray(changed, dtype=bool)
+        if self.badpixmask is not None and \
+                np.all(self.badpixmask[changed] != 0):
+            self._flag_inv_var(changed)
+        else:
+            self._inv_var_refs = None
+
+        strips = self.order_strips()
+        affected = np.any(strips.gather(changed, transpose=self.transpose) &
+                          ~strips.edges, axis=2) & strips.good_cols
+
+        profiles, profile_sets = self._configuration_profiles(
+            configurations, correct_for_sky)
+        profile_y_microns, centroids = self._profile_centroids(profiles)
+        pixel_inv_var = self.pixel_inv_var(data)
+        cr_params = dict(snoise=self.snoise, nsigma=self.nsigma,
+                         max_iter=self.cr_max_iter, debug=debug_crs)
+        crs_per_order = np.zeros(strips.norders, dtype=int)
+        for i in np.where(np.any(affected, axis=1))[0]:
+            j_ix = np.where(affected[i])[0]
+            nx_cutout = strips.nx_cutouts[i]
+            sl = (i, j_ix, slice(0, nx_cutout))
+            x_ix = strips.x_ix[sl]
+            y_ix = np.broadcast_to(j_ix[:, None], x_ix.shape)
+            image_ix = (y_ix, x_ix) if self.transpose else (x_ix, y_ix)
+            col_inv_var = np.asarray(pixel_inv_var[image_ix],
+                                     dtype=np.float64)
+            col_inv_var[strips.edges[sl]] = 0
+            order_results, crs = self._one_d_extract_order(
+                np.asarray(data[image_ix], dtype=self.dtype).astype(
+                    np.float64),
+                col_inv_var, strips.x_offsets[sl], strips.edges[sl],
+                matrices[i, j_ix], profiles, profile_y_microns, centroids,
+                profile_sets, cr_params=cr_params,
+                weights_after_crs=weights_after_crs)
+
+            for (flux, var, weights), (new_flux, new_var, new_weights) in \
+                    zip(results, order_results):
+                flux[i, j_ix] = new_flux
+                var[i, j_ix] = new_var
+                rows = np.zeros((len(j_ix), ) + weights.rows.shape[1:],
+                                dtype=weights.rows.dtype)
+                rows[:, :nx_cutout] = new_weights
+                weights.update_rows(i, j_ix, rows)
+
+            crs_per_order[i] = np.sum(crs)
+            if self.badpixmask is not None and np.any(crs):
+                flagged = tuple(ix[crs] for ix in image_ix)
+                self.badpixmask[flagged] |= self.cr_flag
+                self._flag_inv_var(flagged)
+
+        self.crs_per_order = crs_per_order
+        self.num_additional_crs = int(np.sum(crs_per_order))
+        return affected
+
+    def _configuration_profiles(self, configurations, correct_for_sky):
+        """
+        Build the slit profiles for a list of configurations.
 
-        # Our profiles...
-        # FIXME: Consider carefully whether there is a way to extract x-centroids
-        # as well for PRV, as part of slitim_offsets below.
+        The profiles are those of the union of all configurations, ordered
+        as :meth:`SlitView.object_slit_profiles
+        <polyfit.slitview.SlitView.object_slit_profiles>` orders them
+        (objects, then sky). As each profile is normalised independently, a
+        configuration's profiles are simply a selection of these rows.
+
+        Returns
+        -------
+        profiles: :obj:`numpy.ndarray`
+            The (nprof, n_slitpix) slit profiles.
+        profile_sets: list of :obj:`numpy.ndarray`
+            Indices into ``profiles`` for each configuration.
+        """
+        all_objects = sorted(set(o for objs, _ in configurations
+                                 for o in (objs or [])))
+        any_sky = any(s for _, s in configurations)
         profiles = self.slitview.object_slit_profiles(
             arm=self.arm.arm, correct_for_sky=correct_for_sky,
-            used_objects=used_objects, append_sky=use_sky
+            used_objects=all_objects, append_sky=any_sky
         )
-                
+        profile_sets = []
+        for objs, s in configurations:
+            ix = [all_objects.index(int(o)) for o in (objs or [])]
+            if s:
+                ix.append(len(all_objects))
+            profile_sets.append(np.array(ix, dtype=int))
+        return profiles, profile_sets
+
+    def _profile_centroids(self, profiles):
+        """
+        Return the slit-plane coordinates and centroids of the profiles.
+
+        Returns
+        -------
+        profile_y_microns: :obj:`numpy.ndarray`
+            The slit-plane coordinate of each profile pixel.
+        centroids: :obj:`numpy.ndarray`
+            The (2, nprof) profile centroids in the slit plane.
+        """
         # Number of "objects" and "slit pixels"
         no = profiles.shape[0]
         n_slitpix = profiles.shape[1]
@@ -458,22 +1346,116 @@ class Extractor(object):
             y_centroids[object_ix] = np.sum(profile *
                                             profile_y_microns) / np.sum(profile)
         centroids = np.array([x_centroids, y_centroids])
+        return profile_y_microns, centroids
+
+    def pixel_inv_var(self, data, smoothed=True, x_slice=slice(None)):
+        """
+        Return the pixel inverse variance model of a frame.
+
+        Two models are used: the smoothed inverse variance of the 1D
+        extraction (see :meth:`_smoothed_inv_var`), and, with
+        ``smoothed=False``, the unsmoothed read noise plus photon noise
+        model of the 2D extraction. Bad pixels have zero inverse variance
+        in both.
 
-        # Our extracted arrays, and the weights array
-        extracted_flux = np.zeros((nm, ny, no))
-        extracted_var = np.zeros((nm, ny, no))
-        extraction_weights = np.zeros((no, nx, ny))
+        The models are cached, and re-used for as long as the data, the
+        :attr:`vararray` and the :attr:`badpixmask` are the same objects
+        (arrays modified in place are not detected). Cosmic rays flagged by
+        a 1D extraction are zeroed in the cached models as they are added
+        to the bad pixel mask.
 
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            The image data being extracted.
+        smoothed: bool, optional
+            Return the smoothed model of the 1D extraction (the default),
+            rather than that of the 2D extraction.
+        x_slice: slice, optional
+            Only model these detector rows (in the spatial direction), as
+            for :meth:`_smoothed_inv_var`. Partial models are not cached.
+
+        Returns
+        -------
+        pixel_inv_var: :obj:`numpy.ndarray`
+            Detector-shaped inverse variance (or the slice of it).
+        """
+        refs = (data, self.vararray, self.badpixmask)
+        if self._inv_var_refs is None or \
+                any(a is not b for a, b in zip(refs, self._inv_var_refs)):
+            self._inv_var_refs = refs
+            self._inv_var_cache = {}
+        if x_slice == slice(None) and smoothed in self._inv_var_cache:
+            return self._inv_var_cache[smoothed]
+
+        region = (slice(None), x_slice) if self.transpose else (x_slice, )
+        if smoothed:
+            pixel_inv_var = self._smoothed_inv_var(data, x_slice=x_slice)
+        else:
+            # Assuming that the data are in photo-electrons, construct a
+            # simple model for the pixel inverse variance.
+            pixel_inv_var = 1.0 / (np.maximum(
+                np.asarray(data[region], dtype=self.dtype), 0) +
+                                   self.rnoise ** 2)
+        if self.badpixmask is not None:
+            pixel_inv_var[self.badpixmask[region] != 0] = 0
+
+        if x_slice == slice(None):
+            self._inv_var_cache[smoothed] = pixel_inv_var
+        return pixel_inv_var
+
+    def _flag_inv_var(self, flagged=None):
+        """
+        Zero the cached inverse variance of newly flagged pixels.
+
+        Parameters
+        ----------
+        flagged: optional
+            Index (e.g. boolean mask) of the pixels flagged. Default is all
+            pixels flagged as cosmic rays in the bad pixel mask.
+        """
+        if self.badpixmask is None or not self._inv_var_cache:
+            return
+        if flagged is None:
+            flagged = (self.badpixmask & self.cr_flag) != 0
+        for pixel_inv_var in self._inv_var_cache.values():
+            pixel_inv_var[flagged] = 0
+
+    def _smoothed_inv_var(self, data, x_slice=slice(None)):
+        """
+        Model the smoothed pixel inverse variance used for 1D extraction.
+
+        Bad pixels are not masked here; see :meth:`pixel_inv_var`.
+
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            The image data being extracted.
+        x_slice: slice, optional
+            Only model these detector rows (in the spatial direction). The
+            first and last rows are smoothed as if they were at the edge of
+            the detector, so the slice should include a halo of one row on
+            either side of the rows that are needed.
+
+        Returns
+        -------
+        pixel_inv_var: :obj:`numpy.ndarray`
+            Detector-shaped inverse variance (or the slice of it), smoothed
+            in both directions.
+        """
+        region = (slice(None), x_slice) if self.transpose else (x_slice, )
         # Assuming that the data are in photo-electrons, construct a simple
         # model for the pixel inverse variance.
         # This really should come from an input "vararray" because of differing
         # gain and readout noise parameters for different amplifiers, and known
         # bad pixels.
         if self.vararray is None:
-            pixel_inv_var = 1.0 / (np.maximum(data, 0) /
+            pixel_inv_var = 1.0 / (np.maximum(
+                np.asarray(data[region], dtype=self.dtype), 0) /
                                    self.gain + self.rnoise ** 2)
         else:
-            pixel_inv_var = 1.0 / self.vararray
+            pixel_inv_var = 1.0 / np.asarray(self.vararray[region],
+                                             dtype=self.dtype)
 
         # Now, smooth filter this variance plane for the purposes of not allowing tilted
         # slits or line profiles to affect the extraction. Simply convolve the inverse
@@ -498,181 +1480,388 @@ class Extractor(object):
                                                axis=1)
             pixel_inv_var = 1.0/ndimage.convolve1d(1.0/pixel_inv_var,
                                                    spat_conv_weights, axis=0)
-        
-        #Set the inverse variance to zero for bad pixels. Note that if all pixels end
-        #up being bad for an extraction, then it will fail.
-        if self.badpixmask is not None:
-            pixel_inv_var[self.badpixmask.astype(bool)] = 0
-            
-        # Loop through all orders then through all y pixels.
-        for i in range(nm):
-            print("Extracting order: {0:d}".format(i))
-
-            # Create an empty weight array. Base the size on the largest
-            # slit magnification
-            # for this order.
-            nx_cutout = int(np.ceil(self.slitview.slit_length / np.min(
-                matrices[i, :, 0, 0])))
-            phi = np.empty((nx_cutout, no))
-
-            for j in range(ny):
-                # Compute offsets in slit-plane microns directly from the y_
-                # centroid and
-                # the matrix.
-                # FIXME: It is unclear what to DO with this for a 1D extraction,
-                # unless
-                # we were going to output a new wavelength scale associated
-                # with a
-                # 1D extraction. This is currently only used to make the
-                # fitting as
-                # part of the CR rejection neat.
-                slitim_offsets = np.dot(np.linalg.inv(matrices[i, j]),
-                                        centroids)
-
-                profile_y_pix = profile_y_microns / matrices[i, j, 0, 0]
-
-                # Check for NaNs
-                if x_map[i, j] != x_map[i, j]:
-                    extracted_var[i, j, :] = np.nan
+        return pixel_inv_var
+
+    def _one_d_sweep(self, data, profiles, profile_sets, debug_crs=False,
+                     weights_after_crs=False):
+        """
+        Run the 1D extraction for one or more sets of slit profiles.
+
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            The image data being extracted.
+        profiles: :obj:`numpy.ndarray`
+            The (nprof, n_slitpix) slit profiles, covering every set.
+        profile_sets: list of :obj:`numpy.ndarray`
+            Indices into ``profiles`` of the objects to extract together.
+        debug_crs: bool, optional
+            Passed along to :any:`find_order_crs`.
+        weights_after_crs: bool, optional
+            See :meth:`_one_d_extract_order`.
+
+        Returns
+        -------
+        results: list of tuple
+            ``(extracted_flux, extracted_var, extraction_weights)`` for each
+            entry of ``profile_sets``.
+        """
+        try:
+            x_map, w_map, blaze, matrices = self.bin_models()
+        except Exception:
+            raise RuntimeError('Extraction failed, unable to bin models.')
+
+        ny = x_map.shape[1]
+        nm = x_map.shape[0]
+        nx = int(self.arm.szx / self.arm.xbin)
+        profile_y_microns, centroids = self._profile_centroids(profiles)
+
+        # Our extracted arrays, and the weights arrays
+        strips = self.order_strips()
+        extracted_flux = [np.zeros((nm, ny, len(s)), dtype=self.dtype)
+                          for s in profile_sets]
+        extracted_var = [np.zeros((nm, ny, len(s)), dtype=self.dtype)
+                         for s in profile_sets]
+        pixel_weights = [np.zeros(strips.shape + (len(s), ), dtype=self.dtype)
+                         for s in profile_sets]
+        crs_per_order = np.zeros(nm, dtype=int)
+
+        # Loop through all orders, in bands that fit in the memory budget.
+        # Within an order, every spectral pixel is handled at once by
+        # _one_d_extract_order. Orders are independent, so they may be
+        # spread over a pool of worker processes; every order writes its own
+        # part of the outputs.
+        for var in extracted_var:
+            var[~strips.good_cols, :] = np.nan
+        context = dict(matrices=matrices, nx_cutouts=strips.nx_cutouts,
+                       profiles=profiles, profile_y_microns=profile_y_microns,
+                       centroids=centroids, profile_sets=profile_sets,
+                       cr_params=dict(snoise=self.snoise,
+                                      nsigma=self.nsigma,
+                                      max_iter=self.cr_max_iter,
+                                      debug=debug_crs),
+                       weights_after_crs=weights_after_crs)
+        # The cosmic rays of each band are only added to the bad pixel mask
+        # once every band is extracted, so that the inverse variance of
+        # every band is computed from the same input mask, and the results
+        # do not depend on the memory budget where bands share rows
+        band_crs = []
+        for band, x_slice in self._order_bands(strips, profile_sets):
+            # Gather the data and inverse variance of the band into
+            # rectified order strips, reading only the detector rows that
+            # the band covers. The inverse variance is already zero for bad
+            # pixels; set it to zero for pixels off the detector too. Note
+            # that if all pixels end up being bad for an extraction, then it
+            # will fail.
+            band_gather = self._band_gather(strips, band, x_slice)
+            data_cube = band_gather(data).astype(self.dtype, copy=False)
+            inv_var_cube = band_gather(
+                self.pixel_inv_var(data, x_slice=x_slice), x_slice=None)
+            inv_var_cube[strips.edges[band]] = 0
+
+            orders = [i for i in range(band.start, band.stop)
+                      if np.any(strips.good_cols[i])]
+            crs = np.zeros(data_cube.shape, dtype=bool)
+            arrays = dict(data=data_cube, inv_var=inv_var_cube,
+                          x_offsets=strips.x_offsets[band],
+                          edges=strips.edges[band],
+                          good_cols=strips.good_cols[band])
+            outputs = dict(crs=crs)
+            for k, weights in enumerate(pixel_weights):
+                outputs['weights{0:d}'.format(k)] = weights[band]
+            context['first_order'] = band.start
+            with OrderPool(self.n_workers, arrays=arrays, outputs=outputs,
+                           context=context) as pool:
+                results = pool.map(_one_d_order_task, orders,
+                                   callback=self._order_done(nm))
+            for i, order_results in zip(orders, results):
+                j_ix = np.where(strips.good_cols[i])[0]
+                for k, (flux, var) in enumerate(order_results):
+                    extracted_flux[k][i, j_ix, :] = flux
+                    extracted_var[k][i, j_ix, :] = var
+
+            crs_per_order[band] = np.sum(crs, axis=(1, 2))
+            if np.any(crs):
+                band_crs.append((band, crs))
+
+        if self.badpixmask is not None and band_crs:
+            for band, crs in band_crs:
+                strips.scatter_flags(crs, self.badpixmask, self.cr_flag,
+                                     transpose=self.transpose, orders=band)
+            self._flag_inv_var()
+
+        # Keep the weights in their order strips, rather than scattering
+        # them into detector-sized arrays.
+        extraction_weights = [ExtractionWeights.from_strips(weights, strips)
+                              for weights in pixel_weights]
+
+        # Keep a count of the new cosmic rays in each order, for QA
+        self.crs_per_order = crs_per_order
+        self.num_additional_crs += int(np.sum(self.crs_per_order))
+
+        return list(zip(extracted_flux, extracted_var, extraction_weights))
+
+    def _order_done(self, nm):
+        """
+        Return the :meth:`OrderPool.map` callback reporting the extraction
+        of each of ``nm`` orders to :attr:`progress`, if any.
+        """
+        if self.progress is None:
+            return None
+        return lambda i: self.progress(i, nm)
+
+    def _order_bands(self, strips, profile_sets):
+        """
+        Split the orders into bands that fit in the memory budget.
+
+        Parameters
+        ----------
+        strips: :class:`~polyfit.orderstrip.OrderStripCube`
+            The order strips.
+        profile_sets: list of :obj:`numpy.ndarray`
+            The sets of objects being extracted, as for :meth:`_one_d_sweep`.
+
+        Returns
+        -------
+        bands: list of tuple
+            ``(orders, x_slice)`` for each band: the slice of order indices,
+            and the slice of detector rows (in the spatial direction) needed
+            to extract them, including a halo of one row either side for
+            the spatial smoothing of the variance.
+        """
+        nm, ny, nx_cutout = strips.shape
+        if self.memory_budget is None and self._order_ix is None:
+            return [(slice(0, nm), slice(None))]
+
+        # The spatial extent of each order, on the detector
+        x_lo = np.where(strips.edges, strips.nx, strips.x_ix).min(axis=(1, 2))
+        x_hi = np.where(strips.edges, -1, strips.x_ix).max(axis=(1, 2)) + 1
+
+        # Bytes per order for the gathered strips (data, inverse variance,
+        # weights, indices), and per detector row for the band's slice of
+        # the data, variance and mask and the smoothing temporaries.
+        itemsize = self.dtype.itemsize
+        nweights = sum(len(s) for s in profile_sets)
+        order_bytes = ny * nx_cutout * (itemsize * (2 + nweights) + 8 + 2)
+        row_bytes = ny * (itemsize * 6 + 2)
+        # With a subset of the orders and no budget, the orders are kept in
+        # a single band, which only covers the rows they span.
+        budget = np.inf if self.memory_budget is None else \
+            self.memory_budget * 2 ** 20
+
+        bands = []
+        first = 0
+        for i in range(1, nm + 1):
+            if i < nm:
+                lo = max(min(x_lo[first:i + 1]) - 1, 0)
+                hi = min(max(x_hi[first:i + 1]) + 1, strips.nx)
+                if (i + 1 - first) * order_bytes + \
+                        max(hi - lo, 0) * row_bytes <= budget:
                     continue
+            lo = max(min(x_lo[first:i]) - 1, 0)
+            hi = max(min(max(x_hi[first:i]) + 1, strips.nx), lo + 1)
+            bands.append((slice(first, i), slice(lo, hi)))
+            first = i
+        return bands
 
-                # Create our column cutout for the data and the PSF. 
-                # FIXME: Is "round" most correct on the next line???
-                # FIXME: Profiles should be convolved by a detector pixel,
-                # but binning has to be taken into account properly!
-                x_ix = int(np.round(
-                    x_map[i, j])) - nx_cutout // 2 + \
-                       np.arange(nx_cutout, dtype=int) + nx // 2
-                for k in range(no):
-                    phi[:, k] = np.interp(
-                        x_ix - x_map[i, j] - nx // 2, profile_y_pix,
-                        profiles[k])
-                    phi[:, k] /= np.sum(phi[:, k])
-                # Deal with edge effects...
-                ww = np.where((x_ix >= nx) | (x_ix < 0))[0]
-                x_ix[ww] = 0
-                phi[ww, :] = 0.0
-
-                # Cut out our data and inverse variance. This is where we worry
-                # about whether
-                # the data come with orders horizontal (default) or
-                # transposed (i.e. like the
-                # physical detector)
-                if self.transpose:
-                    col_data = data[j, x_ix]
-                    col_inv_var = pixel_inv_var[j, x_ix]
-                else:
-                    col_data = data[x_ix, j]
-                    col_inv_var = pixel_inv_var[x_ix, j]                    
-
-                # Search for additional cosmic rays here, by seeing if the data
-                # look different to the model.
-                additional_crs = find_additional_crs(phi, slitim_offsets,
-                                                     col_data, col_inv_var,
-                                                     debug=debug_crs)
-                self.num_additional_crs += len(additional_crs)
-                                                     
-                #Insist that variance if physical. If the model has a significant error
-                #on any pixel, we don't want the weights to be completely wrong - this
-                #check ensures that a reasonable extraction is possible for an imperfect
-                #model. For each of the phi[:,object] arrays, "large" values can't 
-                #correspond to "small" variances. So set the minimum variance to be 
-                #object shot noise.
-                
-                # FIXME: This is not appropriate for sky fibers, and the extraction
-                # mathematics assumes that pixel variance is the same for all objects.
-                # A sanity check is needed, but this isn't quite it, as 
-                # minimum_variance can't be object-dependent.
-                col_inv_var_mat = np.reshape(col_inv_var.repeat(no), (nx_cutout, no))
-                if False:
-                    good_pix = np.where(col_inv_var != 0)[0]
-                    
-                    minimum_variance = phi * np.sum(phi[good_pix,:]/ \
-                        col_inv_var_mat[good_pix,:], axis=0)/ \
-                        np.sum(phi[good_pix,:]**2, axis=0)
-                
-                    col_inv_var_mat[good_pix,:] = 1./np.maximum(1./col_inv_var_mat[good_pix,:], \
-                        minimum_variance[good_pix,:])
-                                                     
-                if len(additional_crs) > 0:
-                    col_inv_var[additional_crs] = 0
-                    if self.badpixmask is not None:
-                        if self.transpose:
-                            self.badpixmask[j, x_ix[additional_crs]] |= \
-                                self.cr_flag
-                        else:
-                            self.badpixmask[x_ix[additional_crs], j] |= \
-                                self.cr_flag
-
-                # Fill in the "c" matrix and "b" vector from Sharp and Birchall
-                # equation 9 Simplify things by writing the sum in the
-                # computation of "b" as a matrix multiplication.
-                # We can do this because we're content to invert the
-                # (small) matrix "c" here. 
-                
-                # FIXME: Transpose matrices appropriately so that multiplication
-                # order is the same as documentation.
-                b_mat = phi * col_inv_var_mat
-                c_mat = np.dot(phi.T, phi * col_inv_var_mat)
-
-                # DEBUG - should try several columns...
-                #if (i==10 and j>3000):
-                #    import matplotlib.pyplot as plt
-                #    plt.ion()
-                #    plt.plot(col_data/np.max(col_data))
-                #    plt.plot(phi[:,0]/np.max(phi[:,0]))
-                #    import pdb; pdb.set_trace()
-                
-                # FIXME: (from Joao? Should be deleted if so)
-                # Sometimes the determinant of c_mat is 0.0
-                # leading to the impossibility of inverting the matrix.
-                # currently the pixel weights are unmodified and those used are
-                # whatever the last iteration calculation was.
-
-                # FIXME: (from Joao? Should be deleted if so)
-                # The above problem is made more complicated by the fact
-                # that due to the different slit magnifications,
-                # the previous weights may not have the same shape, so
-                # we make copies of b_mat for pixel weights when
-                # determinant is zero and shape is different.
-
-                # If all pixels for a given object (e.g. an arc) are
-                # marked as bad, c_mat can't be inverted. In this case,
-                # we do the best we can with an inverse that works for
-                # no cross-talk.
+    def _band_gather(self, strips, band, x_slice):
+        """
+        Return a function that gathers a band of orders from an image.
+
+        The function takes a detector-shaped image (or, with
+        ``x_slice=None``, an image already sliced to ``x_slice``), and only
+        reads the rows of ``x_slice`` from it.
+        """
+        x_start = x_slice.start or 0
+        x_ix = strips.x_ix[band] - x_start
+        if x_slice.stop is not None:
+            # Pixels off the detector may read from anywhere; keep them
+            # inside the slice
+            x_ix = np.clip(x_ix, 0, x_slice.stop - x_start - 1)
+        y_ix = np.arange(strips.ny)[None, :, None]
+
+        def band_gather(image, x_slice=x_slice):
+            if x_slice is not None:
+                image = image[(slice(None), x_slice) if self.transpose
+                              else (x_slice, )]
+            if self.transpose:
+                return image[y_ix, x_ix]
+            return image[x_ix, y_ix]
+        return band_gather
+
+    @staticmethod
+    def _one_d_extract_order(col_data, col_inv_var, x_offsets, edges,
+                             matrices_order, profiles, profile_y_microns,
+                             centroids, profile_sets, cr_params=None,
+                             weights_after_crs=False):
+        """
+        Optimally extract every spectral pixel of a single order at once.
+
+        This is the engine behind :meth:`one_d_extract`. The per-column
+        profile kernels are stacked into an (ny, nx_cutout, nprof) array, the
+        normal matrices (the "c" matrix of Sharp and Birchall, equation 9)
+        are built for all columns in one go and then solved with a batched
+        :any:`numpy.linalg.solve`, once for each set of profiles.
+
+        Parameters
+        ----------
+        col_data: :obj:`numpy.ndarray`
+            (ny, nx_cutout) data for the order, from
+            :meth:`OrderStripCube.gather
+            <polyfit.orderstrip.OrderStripCube.gather>`.
+        col_inv_var: :obj:`numpy.ndarray`
+            (ny, nx_cutout) pixel inverse variance for the order. Bad pixels
+            must already have zero inverse variance. Pixels found to be
+            cosmic rays are set to zero in place.
+        x_offsets: :obj:`numpy.ndarray`
+            (ny, nx_cutout) offsets of the pixels from the order trace.
+        edges: :obj:`numpy.ndarray`
+            (ny, nx_cutout) boolean array, True for pixels off the detector.
+        matrices_order: :obj:`numpy.ndarray`
+            The (binned) (ny, 2, 2) matrices for the columns to extract.
+        profiles: :obj:`numpy.ndarray`
+            The (nprof, n_slitpix) slit profiles. The cosmic ray search
+            models the data with all of them.
+        profile_y_microns: :obj:`numpy.ndarray`
+            The slit-plane coordinate of each profile pixel.
+        centroids: :obj:`numpy.ndarray`
+            The (2, nprof) profile centroids in the slit plane.
+        profile_sets: list of :obj:`numpy.ndarray`
+            Indices into ``profiles`` of the objects to extract together.
+        cr_params: dict, optional
+            Keyword arguments for :any:`find_order_crs`.
+        weights_after_crs: bool, optional
+            If True, compute the weights with the additional cosmic rays
+            masked. By default, the weights are computed from the inverse
+            variance as it was before the cosmic ray search.
+
+        Returns
+        -------
+        results: list of tuple
+            For each entry of ``profile_sets``, the (ny, nobj) extracted
+            flux, the (ny, nobj) extracted variance and the
+            (ny, nx_cutout, nobj) extraction weights for each cutout pixel.
+        crs: :obj:`numpy.ndarray`
+            (ny, nx_cutout) boolean array, True for cutout pixels flagged as
+            additional cosmic rays.
+        """
+        no = profiles.shape[0]
+        n_cols, nx_cutout = col_data.shape
+
+        # Compute offsets in slit-plane microns directly from the y_
+        # centroid and the matrix.
+        # FIXME: It is unclear what to DO with this for a 1D extraction,
+        # unless we were going to output a new wavelength scale associated
+        # with a 1D extraction. This is currently only used to make the
+        # fitting as part of the CR rejection neat.
+        slitim_offsets = geometry.slit_offsets(matrices_order, centroids)
+
+        # Create our PSF for each column.
+        # FIXME: Profiles should be convolved by a detector pixel,
+        # but binning has to be taken into account properly!
+        # Interpolating at (offset / scale) onto the profile is the same as
+        # interpolating at offset onto profile_y_microns / scale, which lets
+        # every column share a single set of sample points.
+        slit_microns = x_offsets * matrices_order[:, 0, 0][:, None]
+        phi = np.empty((n_cols, nx_cutout, no))
+        for k in range(no):
+            phi[:, :, k] = np.interp(slit_microns, profile_y_microns,
+                                     profiles[k])
+        phi /= np.sum(phi, axis=1)[:, None, :]
+        # Deal with edge effects...
+        phi[edges] = 0.0
+
+        if not weights_after_crs:
+            weight_inv_var = col_inv_var.copy()
+
+        # Search for additional cosmic rays here, by seeing if the data
+        # look different to the model. Every column is fitted at once.
+        crs = find_order_crs(phi, slitim_offsets, col_data, col_inv_var,
+                             **(cr_params or {}))
+        col_inv_var[crs] = 0
+
+        if weights_after_crs:
+            weight_inv_var = col_inv_var
+
+        # Rather than trying to understand and
+        # document Equation 17 from Sharp and Birchall, which
+        # doesn't make a lot of sense...  lets just calculate the
+        # variance in the simple explicit way for a linear combination
+        # of independent pixels.
+        col_var = 1.0 / np.maximum(col_inv_var, 1e-12)
+
+        results = []
+        for ix in profile_sets:
+            pixel_weights = Extractor._optimal_weights(phi[:, :, ix],
+                                                       weight_inv_var)
+
+            # FIXME: Some tilted, bright arc lines cause strange
+            # weightings here... Probably OK - only strange weightings in 2D
+            # really matter, and has to be re-tested once the fitted
+            # spatial scale and tilt is more robust.
+
+            # Actual extraction is simple: Just matrix-multiply the data by
+            # the weights.
+            extracted_flux = np.matmul(col_data[:, None, :],
+                                       pixel_weights)[:, 0]
+            extracted_var = np.matmul(col_var[:, None, :],
+                                      pixel_weights ** 2)[:, 0]
+            results.append((extracted_flux, extracted_var, pixel_weights))
+
+        return results, crs
+
+    @staticmethod
+    def _optimal_weights(phi, inv_var):
+        """
+        Solve for the optimal extraction weights of a stack of columns.
+
+        Parameters
+        ----------
+        phi: :obj:`numpy.ndarray`
+            (ncols, npix, nobj) normalised profile kernels.
+        inv_var: :obj:`numpy.ndarray`
+            (ncols, npix) pixel inverse variance.
+
+        Returns
+        -------
+        pixel_weights: :obj:`numpy.ndarray`
+            (ncols, npix, nobj) extraction weights.
+        """
+        # Fill in the "c" matrix and "b" vector from Sharp and Birchall
+        # equation 9 Simplify things by writing the sum in the
+        # computation of "b" as a matrix multiplication.
+        # We can do this because we're content to solve the
+        # (small) matrix "c" here.
+        b_mat = phi * inv_var[:, :, None]
+        c_mat = np.matmul(phi.transpose(0, 2, 1), b_mat)
+
+        # If all pixels for a given object (e.g. an arc) are
+        # marked as bad, c_mat can't be inverted. In this case,
+        # we do the best we can with an inverse that works for
+        # no cross-talk.
+        c_diag = np.diagonal(c_mat, axis1=1, axis2=2)
+        singular = np.any(c_diag == 0, axis=1)
+        solvable = np.where(~singular)[0]
+        pixel_weights = np.empty_like(b_mat)
+        try:
+            # pixel_weights = b_mat . c_mat^-1, i.e. the transpose of
+            # c_mat^T x = b_mat^T
+            pixel_weights[solvable] = np.linalg.solve(
+                c_mat[solvable].transpose(0, 2, 1),
+                b_mat[solvable].transpose(0, 2, 1)).transpose(0, 2, 1)
+        except np.linalg.LinAlgError:
+            # At least one other matrix is singular - find out which one(s)
+            # column by column.
+            for c_ix in solvable:
                 try:
-                    pixel_weights = np.dot(b_mat, np.linalg.inv(c_mat))
-                except:
-                    pixel_weights = np.dot(b_mat,
-                        np.diag(1./np.maximum(np.diag(c_mat),1e-12)))
-
-                # FIXME: Some tilted, bright arc lines cause strange
-                # weightings here... Probably OK - only strange weightings in 2D
-                # really matter, and has to be re-tested once the fitted
-                # spatial scale and tilt is more robust.
-
-                # DEBUG
-                # if (np.max(pixel_weights) > 2) and (j > 0.1*ny):
-                # if (j==2000):
-
-                # FIXME: Search here for weights that are non-zero for
-                # any overlapping orders:
-                for ii, ew_one in enumerate(extraction_weights):
-                    ew_one[x_ix, j] += pixel_weights[:, ii]
-
-                # Actual extraction is simple: Just matrix-multiply the data by
-                # the weights.
-                extracted_flux[i, j, :] = np.dot(col_data, pixel_weights)
-
-                # Rather than trying to understand and
-                # document Equation 17 from Sharp and Birchall, which 
-                # doesn't make a lot of sense...  lets just calculate the
-                # variance in the simple explicit way for a linear combination
-                # of independent pixels.
-                extracted_var[i, j, :] = np.dot(
-                    1.0 / np.maximum(col_inv_var, 1e-12), pixel_weights ** 2)
-
-        return extracted_flux, extracted_var, extraction_weights
+                    pixel_weights[c_ix] = np.dot(b_mat[c_ix],
+                                                 np.linalg.inv(c_mat[c_ix]))
+                except np.linalg.LinAlgError:
+                    singular[c_ix] = True
+        no_crosstalk = np.where(singular)[0]
+        pixel_weights[no_crosstalk] = b_mat[no_crosstalk] / np.maximum(
+            c_diag[no_crosstalk], 1e-12)[:, None, :]
+        return pixel_weights
 
     def two_d_extract(self, data=None, fl=None, extraction_weights=None):
         """
@@ -701,34 +1890,37 @@ class Extractor(object):
             A fits file with conventional row/column directions containing the
             data to be extracted.
             
-        extraction_weights: :obj:`numpy.ndarray`, optional
+        extraction_weights: :class:`ExtractionWeights`, optional
             Extraction weights created from a call to one_d_extract. Separating
             this makes the code more readable, but is not speed optimised.
+            A table made by :meth:`ExtractionWeights.to_table`, or a dense
+            (nobj, nx, ny) array, are also accepted.
         """
-
-        # FIXME: Much of this code is doubled-up with one_d_extract.
-        # Re-factoring is needed!
         if data is None:
             if fl is None:
                 raise UserWarning("ERROR: Must input data or file")
             else:
                 data = pyfits.getdata(fl)
 
-        # Correct for scattered light - a place-holder, to show where it can 
-        # most easily fit.
-        mask = np.sum(extraction_weights, axis=0) == 0
-        data = subtract_scattered_light(data, mask)
-
         try:
-            x_map, w_map, blaze, matrices = self.bin_models()
-        except Exception:
-            return 'Extraction failed, unable to bin models.'
+            return self._two_d_sweep(data, [extraction_weights])[0]
+        except RuntimeError as e:
+            return str(e)
 
-        # Set up convenience local variables
-        ny = x_map.shape[1]
-        nm = x_map.shape[0]
-        nx = int(self.arm.szx / self.arm.xbin)
+    def _two_d_gather(self, x_map, matrices):
+        """
+        Return the gather of the 2D extraction for the current slit profile.
+
+        Parameters
+        ----------
+        x_map, matrices: :obj:`numpy.ndarray`
+            The binned models, from :meth:`bin_models`.
 
+        Returns
+        -------
+        gather: :class:`~polyfit.orderstrip.TiltedStripGather`
+            See :meth:`tilted_strips`.
+        """
         # Our profiles... we re-extract these in order to include the centroids.
         profile, centroids = self.slitview.slit_profile(arm=self.arm.arm, \
                                                         return_centroid=True)
@@ -747,115 +1939,210 @@ class Extractor(object):
         for c in centroids:
             c = np.convolve(c, det_pix, mode='same') * self.slitview.microns_pix
 
-        # Number of "objects"
-        no = extraction_weights.shape[0]
-        extracted_flux = np.zeros((nm, ny, no))
-        extracted_var = np.zeros((nm, ny, no))
-        extracted_covar = np.zeros((nm, ny - 1, no))
+        slit_ix = np.arange(len(centroids)) - len(centroids) // 2
+        return self.tilted_strips(x_map, matrices, centroids, slit_ix)
 
-        # Assuming that the data are in photo-electrons, construct a simple
-        # model for the pixel inverse variance.
-        pixel_inv_var = 1.0 / (np.maximum(data, 0) + self.rnoise ** 2)
-        if self.badpixmask is not None:
-            pixel_inv_var[self.badpixmask.astype(bool)] = 0.0
+    def _two_d_sweep(self, data, weights_list):
+        """
+        Run the 2D extraction for one or more sets of extraction weights.
 
-        # Loop through all orders then through all y pixels.
-        for i in range(nm):
-            print("Extracting order: {0:d}".format(i))
-
-            # Create an empty weight array. Base the size on the largest slit
-            # magnification for this order.
-            nx_cutout = int(np.ceil(self.slitview.slit_length / np.min(
-                matrices[i, :, 0, 0])))
-            ny_cutout = 2 * \
-                        int(nx_cutout * np.nanmax(
-                            np.abs(self.slit_tilt)) / 2) + 3
-
-            for j in range(ny):
-                # Check for NaNs
-                if x_map[i, j] != x_map[i, j]:
-                    extracted_var[i, j, :] = np.nan
-                    continue
+        The data and pixel inverse variance are only gathered once for each
+        order, and shared between all sets of weights.
+
+        Parameters
+        ----------
+        data: :obj:`numpy.ndarray`
+            The image data being extracted.
+        weights_list: list
+            Extraction weights, as returned by :meth:`one_d_extract`. Tables
+            made by :meth:`ExtractionWeights.to_table` and dense
+            (nobj, nx, ny) arrays are also accepted.
+
+        Returns
+        -------
+        results: list of tuple
+            ``(extracted_flux, extracted_var)`` for each set of weights.
+        """
+        weights_list = [ExtractionWeights.from_table(w)
+                        if isinstance(w, Table) else w for w in weights_list]
+
+        # Correct for scattered light - a place-holder, to show where it can 
+        # most easily fit.
+        mask = np.ones(weights_list[0].shape[1:], dtype=bool)
+        for w in weights_list:
+            if isinstance(w, ExtractionWeights):
+                mask &= ~w.footprint()
+            else:
+                mask &= np.sum(w, axis=0) == 0
+        data = subtract_scattered_light(data, mask)
+
+        try:
+            x_map, w_map, blaze, matrices = self.bin_models()
+        except Exception:
+            raise RuntimeError('Extraction failed, unable to bin models.')
+
+        # Set up convenience local variables
+        ny = x_map.shape[1]
+        nm = x_map.shape[0]
+        nx = int(self.arm.szx / self.arm.xbin)
+
+        # Number of "objects" for each set of weights
+        extracted_flux = [np.zeros((nm, ny, w.shape[0]), dtype=self.dtype)
+                          for w in weights_list]
+        extracted_var = [np.zeros((nm, ny, w.shape[0]), dtype=self.dtype)
+                         for w in weights_list]
+
+        strips = self.order_strips()
+        gather = self._two_d_gather(x_map, matrices)
+
+        # Loop through all orders. Within an order, every spectral pixel is
+        # handled at once, by gathering the precomputed taps either side of
+        # the tilted slit. Orders are independent, so they may be spread
+        # over a pool of worker processes.
+        for var in extracted_var:
+            var[~strips.good_cols, :] = np.nan
+        arrays = dict(data=np.asarray(data, dtype=self.dtype),
+                      inv_var=self.pixel_inv_var(data, smoothed=False),
+                      image_ix=gather.image_ix, weight_ix=gather.weight_ix,
+                      frac=gather.frac)
+        outputs = {}
+        sparse = []
+        for k, weights in enumerate(weights_list):
+            if isinstance(weights, ExtractionWeights):
+                arrays['weights{0:d}'.format(k)] = weights.rows
+                arrays['rowindex{0:d}'.format(k)] = weights.row_index
+                arrays['xstart{0:d}'.format(k)] = weights.x_start
+                sparse.append(weights.x_range)
+            else:
+                arrays['weights{0:d}'.format(k)] = weights
+                sparse.append(None)
+            outputs['flux{0:d}'.format(k)] = extracted_flux[k]
+            outputs['var{0:d}'.format(k)] = extracted_var[k]
+        context = dict(strips=strips, nsets=len(weights_list), sparse=sparse)
+        with OrderPool(self.n_workers, arrays=arrays, outputs=outputs,
+                       context=context) as pool:
+            pool.map(_two_d_order_task, range(nm),
+                     callback=self._order_done(nm))
+
+        return list(zip(extracted_flux, extracted_var))
+
+    def extraction_operators(self, extraction_weights, two_d=False):
+        """
+        Export the extraction as sparse linear operators.
+
+        Once the weights are known, both the 1D and the 2D extraction are
+        linear maps from the detector pixels to the extracted fluxes, and
+        the extracted variances are linear in the pixel variances. The
+        operators apply these maps to any frame (or stack of frames) that
+        shares the calibrations and weights, e.g.::
+
+            flux_op, var_op = extractor.extraction_operators(weights)
+            flux = (flux_op @ data.ravel()).reshape((norders, ny, nobj))
+            fluxes = flux_op @ frames.reshape((nframes, -1)).T
+
+        The detector pixels are in the order of ``data.ravel()``, i.e. in
+        the same layout (transposed or not) as the data being extracted.
+        The variance operator multiplies a flattened pixel variance model;
+        to reproduce :meth:`one_d_extract` (or :meth:`two_d_extract`) this
+        is ``1 / np.maximum(self.pixel_inv_var(data, smoothed=not two_d),
+        1e-12)``, except where orders overlap: a cosmic ray flagged while
+        extracting one order is only masked in that order by the
+        extraction, but in every order by the variance model. Columns that
+        are not extracted (where the ``x_map`` is NaN) have zero rows in
+        both operators.
 
-                # Create our cutout of columns for the data. 
-                x_ix = int(np.round(
-                    x_map[i, j])) - nx_cutout // 2 + \
-                       np.arange(nx_cutout, dtype=int) + nx // 2
-                y_ix = j + np.arange(ny_cutout, dtype=int) - ny_cutout // 2
-
-                # Deal with edge effects...
-                ww = np.where((x_ix >= nx) | (x_ix < 0))[0]
-                x_ix[ww] = 0
-                # phi[:, ww, :] = 0.0
-                # phi1d[:, ww, :] = 0.0
-                ww = np.where((y_ix >= ny) | (y_ix < 0))[0]
-                y_ix[ww] = 0
-                # phi[ww, :, :] = 0.0
-                xy = np.meshgrid(x_ix, y_ix, indexing='ij')
-
-                # Cut out our data and inverse variance.
-                col_data = data[xy]
-                col_inv_var = pixel_inv_var[xy]
-                col_weights = np.array([ew[xy] for ew in extraction_weights])
-
-                # Find the pixel (including fractional pixels) within our
-                # cutout that we'll use for extraction. First - find the pixel
-                # coordinates according to slit tilt:
-
-                ysub_pix = (x_ix - x_map[i, j] - nx // 2) * \
-                           self.slit_tilt[i, j] + ny_cutout // 2
-
-                # DEBUG
-                # if (np.max(col_data) > 1e3):
-
-                # Next, add the contribution of the centroid in the slit
-                # viewing camera.
-                # The [1,1] component of the matrix is slit_microns_per_det_
-                # pix_y
-                # Above, slit_ix was called profile_y_pix.
-                slit_ix = np.arange(len(centroids)) - len(centroids) // 2
-                col_ix = np.arange(nx_cutout) - nx_cutout // 2
-
-                # Interpolate onto the slit coordinates
-                # FIXME: See 1d code for how this was done for profiles...
-                # PRV: This is only absolutely needed for PRV mode, with 
-                # matrices[i,j,1,1] coming from "specmod.fits".
-                ysub_pix += np.interp(x_ix - x_map[i, j] - nx // 2, \
-                                      slit_ix / matrices[i, j, 0, 0], \
-                                      centroids / matrices[i, j, 1, 1])
-
-                # Make sure this is within the limits of our subarray.
-                ysub_pix = np.maximum(ysub_pix, 0)
-                ysub_pix = np.minimum(ysub_pix, ny_cutout - 1e-6)
-
-                # Create the arrays needed for interpolation.
-                ysub_ix_lo = ysub_pix.astype(int)
-                ysub_ix_hi = ysub_ix_lo + 1
-                ysub_ix_frac = ysub_pix - ysub_ix_lo
-                xsub_ix = np.arange(nx_cutout).astype(int)
-
-                # FIXME: SERIOUS Weighting here relies on col_weights being
-                # approximately correct, which it isn't for bright arc lines
-                # and a tilted slit.
-                # We should consider if this is "good enough" carefully.
-                for k in range(no):
-                    extracted_flux[i, j, k] = \
-                        np.dot(col_data[xsub_ix, ysub_ix_lo],
-                               col_weights[k, xsub_ix, ysub_ix_lo] * (
-                                       1 - ysub_ix_frac))
-                    extracted_flux[i, j, k] += \
-                        np.dot(col_data[xsub_ix, ysub_ix_hi], col_weights[
-                            k, xsub_ix, ysub_ix_hi] * ysub_ix_frac)
-                    extracted_var[i, j, k] = np.dot(
-                        (1 - ysub_ix_frac) / np.maximum(
-                            col_inv_var[xsub_ix, ysub_ix_lo], 1e-12),
-                        col_weights[k, xsub_ix, ysub_ix_lo] ** 2)
-                    extracted_var[i, j, k] += np.dot(
-                        ysub_ix_frac / np.maximum(
-                            col_inv_var[xsub_ix, ysub_ix_hi], 1e-12),
-                        col_weights[k, xsub_ix, ysub_ix_hi] ** 2)
-
-        return extracted_flux, extracted_var
+        Parameters
+        ----------
+        extraction_weights: :class:`ExtractionWeights`
+            The weights, as returned by :meth:`one_d_extract`. A table made
+            by :meth:`ExtractionWeights.to_table` is also accepted, and for
+            2D, a dense (nobj, nx, ny) array.
+        two_d: bool, optional
+            Export the 2D extraction of :meth:`two_d_extract`, rather than
+            the 1D extraction (the default).
+
+        Raises
+        ------
+        ValueError
+            If dense weights are given for a 1D extraction, where they do
+            not separate the orders.
+
+        Returns
+        -------
+        flux_op: :obj:`scipy.sparse.csr_matrix`
+            ``(norders * ny * nobj, npix)`` flux operator.
+        var_op: :obj:`scipy.sparse.csr_matrix`
+            ``(norders * ny * nobj, npix)`` variance operator.
+        """
+        if isinstance(extraction_weights, Table):
+            extraction_weights = ExtractionWeights.from_table(
+                extraction_weights)
+        try:
+            x_map, w_map, blaze, matrices = self.bin_models()
+        except Exception:
+            raise RuntimeError('Extraction failed, unable to bin models.')
+        strips = self.order_strips()
+        nm, ny = x_map.shape
+        nx = strips.nx
+        nobj = extraction_weights.shape[0]
+        shape = (nm * ny * nobj, nx * ny)
+        k_ix = np.arange(nobj)
+
+        rows, cols, flux_values, var_values = [], [], [], []
+        if not two_d:
+            if not isinstance(extraction_weights, ExtractionWeights):
+                raise ValueError("1D extraction operators need "
+                                 "ExtractionWeights, not dense weights")
+            # Every stored weight row is one column of one order
+            m_ix, y_ix = np.nonzero((extraction_weights.row_index >= 0) &
+                                    strips.good_cols)
+            weights = np.asarray(extraction_weights.rows[
+                extraction_weights.row_index[m_ix, y_ix]], dtype=np.float64)
+            x_ix = extraction_weights.x_start[m_ix, y_ix][:, None] + \
+                np.arange(weights.shape[1])
+            y_ix = np.broadcast_to(y_ix[:, None], x_ix.shape)
+            on_chip = (x_ix >= 0) & (x_ix < nx)
+            image_ix = y_ix * nx + x_ix if self.transpose else \
+                x_ix * ny + y_ix
+            out_ix = (m_ix * ny)[:, None] + y_ix
+            rows.append((out_ix[on_chip][:, None] * nobj + k_ix).ravel())
+            cols.append(np.repeat(image_ix[on_chip], nobj))
+            flux_values.append(weights[on_chip].ravel())
+            var_values.append(weights[on_chip].ravel() ** 2)
+        else:
+            gather = self._two_d_gather(x_map, matrices)
+            for i in range(nm):
+                sl = (slice(None), ) + strips.order(i)
+                image_ix = gather.image_ix[sl]
+                frac = gather.frac[sl]
+                w_x, w_y = np.divmod(gather.weight_ix[sl], ny)
+                # As for _two_d_order_task: (2, ny, nx_cutout, nobj)
+                if isinstance(extraction_weights, ExtractionWeights):
+                    col_weights = extraction_weights.gather(None, w_x, w_y)
+                else:
+                    col_weights = np.moveaxis(
+                        extraction_weights[:, w_x, w_y], 0, -1)
+                good = np.broadcast_to(strips.good_cols[i][None, :, None],
+                                       image_ix.shape)
+                out_ix = (i * ny + np.arange(ny))[None, :, None]
+                out_ix = np.broadcast_to(out_ix, image_ix.shape)
+                rows.append((out_ix[good][:, None] * nobj + k_ix).ravel())
+                cols.append(np.repeat(image_ix[good], nobj))
+                flux_values.append(
+                    (col_weights * frac[..., None])[good].ravel())
+                var_values.append(
+                    (col_weights ** 2 * frac[..., None])[good].ravel())
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        operators = []
+        for values in (flux_values, var_values):
+            # Duplicate entries (e.g. both taps on one pixel) are summed
+            operator = scipy.sparse.coo_matrix(
+                (np.concatenate(values), (rows, cols)), shape=shape).tocsr()
+            operator.eliminate_zeros()
+            operators.append(operator)
+        return tuple(operators)
 
     def find_lines(self, flux, arclines, hw=12,
                    arcfile=None, # Now dead-letter - always overridden
@@ -867,14 +2154,18 @@ class Extractor(object):
         expected to be. An initial decent model must be present, likely
         the result of a manual adjustment.
 
+        A window of ``2 * hw`` pixels is cut out around every candidate line,
+        and all lines are fitted together with :func:`fit_gaussians`.
+
         Parameters
         ----------
         flux: :obj:`numpy.ndarray`
             Flux data extracted with the 1D extractor. Just the flux, not the
             variance.
 
-        arclines: float array
-            Array containing the wavelength of the arc lines.
+        arclines: :class:`~polyfit.linelist.LineCatalogue` or float array
+            The arc line catalogue, or an array containing the wavelength of
+            the arc lines.
 
         hw: int, optional
             Number of pixels from each order end to be ignored due to proximity
@@ -894,6 +2185,11 @@ class Extractor(object):
 
         lines_out: float array
             Whatever used to be placed in a file.
+
+        Notes
+        -----
+        The number of lines rejected for their low signal-to-noise is kept
+        in :attr:`num_rejected_lines`, for the caller to report.
         """
         # arcfile = flux
         # Only use the middle object.
@@ -903,7 +2199,6 @@ class Extractor(object):
         ny = flux.shape[1]
         nm = flux.shape[0]
         nx = self.arm.szx
-        lines_out = []
         # Let's try the median absolute deviation as a measure of background
         # noise if the search region is not large enough for robust median
         # determination.
@@ -918,90 +2213,168 @@ class Extractor(object):
             plt.imshow(image, interpolation='nearest', aspect='auto',
                        cmap=cm.gray)
 
+        # Select the lines to fit, and cut out a window of 2*hw pixels around
+        # the expected position of each of them.
+        line_orders = []
+        line_waves = []
+        line_pix = []
+        if not isinstance(arclines, LineCatalogue):
+            arclines = LineCatalogue(arclines)
+        # The flux may only cover a subset of the orders
+        model_ix = self.orders - self.arm.m_min
         for m_ix in range(nm):
-            # Select only arc lines that should be in this order.
-            filtered_arclines = arclines[
-                (arclines >= self.arm.w_map[m_ix, :].min())
-                & (arclines <= self.arm.w_map[m_ix, :].max())]
-            # This line interpolates between filtered lines and w_map on a
-            # linear array, to find the expected pixel locations of the lines.
-            w_ix = np.interp(filtered_arclines, self.arm.w_map[m_ix, :],
-                             np.arange(ny))
-            # Ensure that lines close to the edges of the chip are not
-            # considered
-            ww = np.where((w_ix >= hw) & (w_ix < ny - hw))[0]
-            w_ix = w_ix[ww]
-            arclines_to_fit = filtered_arclines[ww]
-            print('order ', m_ix)
-            for i, ix in enumerate(w_ix):
-                # This ensures that lines too close together are not used in the
-                # fit, whilst avoiding looking at indeces that don't exist.
-                if len(w_ix) > 1:
-                    if (np.abs(ix - w_ix[i - 1]) < 1.5 * hw):
-                        continue
-                    elif i != (len(w_ix) - 1) and (
-                            np.abs(ix - w_ix[i + 1]) < 1.5 * hw):
-                        continue
-                x = np.arange(ix - hw, ix + hw, dtype=np.int)
-                y = flux[m_ix, x]
-                # Try median absolute deviation for noise characteristics if
-                # Enough pixels are available per cut.
-                if hw >= 7:
-                    noise_level = np.median(np.abs(y - np.median(y)))
-                # Any line with peak S/N under a value is not considered.
-                # e.g. 20 is considered.
-                if (np.max(y) < 20 * noise_level):
-                    print("Rejecting due to low SNR!")
-                    continue
-
-                g_init = models.Gaussian1D(amplitude=np.max(y), mean=x[
-                    np.argmax(y)], stddev=1.5)
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    fit_g = fitting.LevMarLSQFitter()
-                    g = fit_g(g_init, x, y)
-                # Wave, ypos, xpos, m, amplitude, fwhm
-                xpos = nx // 2 + \
-                       np.interp(g.mean.value, np.arange(ny),
-                                 self.arm.x_map[m_ix])
-                ypos = g.mean.value
-
-                line_to_append = [arclines_to_fit[i], ypos, xpos, m_ix +
-                                  self.arm.m_min, g.amplitude.value,
-                                  g.stddev.value * 2.3548]
-
-                # If any of the values to append are nans, don't do it and
-                # just go on to the next line.
-                if np.isnan(line_to_append).any():
-                    continue
-
-                # This option is here to allow the user to inspect individual
-                # gaussian fits. Useful to test whether the method is working.
-                if plots:
-                    f, sub = plt.subplots(1, 2)
-                    sub[0].plot(x, y)
-                    sub[0].plot(x, g(x))
-                    sub[0].axvline(ix)
-                    snapshot = image[int(ix - hw * 4):int(ix + hw * 4),
-                               int(xpos - 40):
-                               int(xpos + 40)]
-                    sub[1].imshow(np.arcsinh((snapshot - np.median(snapshot)) /
-                                             1e2))
-                    plt.show()
-
-                # This part allows the user to inspect the global fit and
-                # position finding. 
-                if inspect:
-                    plt.plot(xpos, ix, 'bx')
-                    plt.plot(xpos, ypos, 'rx')
-                    plt.text(xpos + 10, ypos,
-                             str(arclines_to_fit[i]), color='green',
-                             fontsize=10)
-
-                lines_out.append(line_to_append)
+            # Select only arc lines that should be in this order, away from
+            # the ends of the order and from each other.
+            waves, w_ix = arclines.order_lines(
+                self.arm.w_map[model_ix[m_ix], :], hw)
+            line_orders.append(np.full(len(waves), m_ix, dtype=int))
+            line_waves.append(waves)
+            line_pix.append(w_ix)
+        line_orders = np.concatenate(line_orders)
+        line_waves = np.concatenate(line_waves)
+        line_pix = np.concatenate(line_pix)
+
+        x = (line_pix - hw).astype(int)[:, None] + np.arange(2 * hw)
+        y = flux[line_orders[:, None], x]
+        # Try median absolute deviation for noise characteristics if
+        # Enough pixels are available per cut.
+        if hw >= 7:
+            noise_level = np.median(
+                np.abs(y - np.median(y, axis=1)[:, None]), axis=1)
+        # Any line with peak S/N under a value is not considered.
+        # e.g. 20 is considered.
+        snr_ok = np.max(y, axis=1) >= 20 * noise_level
+        self.num_rejected_lines = int(np.sum(~snr_ok))
+        line_orders, line_waves, line_pix, x, y = [
+            arr[snr_ok] for arr in (line_orders, line_waves, line_pix, x, y)]
+
+        # Fit all the lines at once
+        amplitude, mean, stddev = fit_gaussians(x, y)
+
+        # Wave, ypos, xpos, m, amplitude, fwhm
+        xpos = np.empty_like(mean)
+        for m_ix in np.unique(line_orders):
+            in_order = line_orders == m_ix
+            xpos[in_order] = nx // 2 + np.interp(
+                mean[in_order], np.arange(ny), self.arm.x_map[model_ix[m_ix]])
+        lines_out = np.array([line_waves, mean, xpos,
+                              self.orders[line_orders], amplitude,
+                              stddev * 2.3548]).T.reshape((-1, 6))
+
+        # If any of the values are nans, don't use the line.
+        good = ~np.any(np.isnan(lines_out), axis=1)
+
+        for i in np.where(good)[0] if (plots or inspect) else []:
+            ix, ypos, xpos_i = line_pix[i], mean[i], xpos[i]
+            # This option is here to allow the user to inspect individual
+            # gaussian fits. Useful to test whether the method is working.
+            if plots:
+                f, sub = plt.subplots(1, 2)
+                sub[0].plot(x[i], y[i])
+                sub[0].plot(x[i], amplitude[i] * np.exp(
+                    -0.5 * ((x[i] - ypos) / stddev[i]) ** 2))
+                sub[0].axvline(ix)
+                snapshot = image[int(ix - hw * 4):int(ix + hw * 4),
+                           int(xpos_i - 40):
+                           int(xpos_i + 40)]
+                sub[1].imshow(np.arcsinh((snapshot - np.median(snapshot)) /
+                                         1e2))
+                plt.show()
+
+            # This part allows the user to inspect the global fit and
+            # position finding.
+            if inspect:
+                plt.plot(xpos_i, ix, 'bx')
+                plt.plot(xpos_i, ypos, 'rx')
+                plt.text(xpos_i + 10, ypos,
+                         str(line_waves[i]), color='green',
+                         fontsize=10)
 
         if inspect:
             plt.axis([0, nx, ny, 0])
             plt.show()
 
-        return np.array(lines_out)
+        return lines_out[good]
+
+
+def _one_d_order_task(i):
+    """
+    Run the 1D extraction of a single order, as an :class:`OrderPool` task.
+
+    The weights and cosmic ray flags of the order are written into the
+    shared outputs; the extracted fluxes and variances are returned.
+    """
+    arrays, context = shared()
+    nx_cutout = context['nx_cutouts'][i]
+    # The arrays only hold the band of orders being extracted
+    b = i - context['first_order']
+    j_ix = np.where(arrays['good_cols'][b])[0]
+    results, crs = Extractor._one_d_extract_order(
+        np.asarray(arrays['data'][b, j_ix, :nx_cutout], dtype=np.float64),
+        np.asarray(arrays['inv_var'][b, j_ix, :nx_cutout], dtype=np.float64),
+        np.asarray(arrays['x_offsets'][b, j_ix, :nx_cutout]),
+        np.asarray(arrays['edges'][b, j_ix, :nx_cutout]),
+        context['matrices'][i, j_ix], context['profiles'],
+        context['profile_y_microns'], context['centroids'],
+        context['profile_sets'], cr_params=context['cr_params'],
+        weights_after_crs=context['weights_after_crs'])
+    for k, (_, _, pixel_weights) in enumerate(results):
+        arrays['weights{0:d}'.format(k)][b, j_ix, :nx_cutout] = pixel_weights
+    arrays['crs'][b, j_ix, :nx_cutout] = crs
+    return [(flux, var) for flux, var, _ in results]
+
+
+def _two_d_order_task(i):
+    """
+    Run the 2D extraction of a single order, as an :class:`OrderPool` task.
+
+    The extracted fluxes and variances are written into the shared outputs.
+    """
+    arrays, context = shared()
+    strips = context['strips']
+    nx = strips.nx
+    ny = strips.ny
+
+    sl = (slice(None), ) + strips.order(i)
+    image_ix = np.asarray(arrays['image_ix'][sl])
+    weight_ix = np.asarray(arrays['weight_ix'][sl])
+    frac = np.asarray(arrays['frac'][sl])
+
+    # Cut out our data, inverse variance and weights, at the two
+    # rows either side of the tilted slit.
+    # FIXME: SERIOUS Weighting here relies on col_weights being
+    # approximately correct, which it isn't for bright arc lines
+    # and a tilted slit.
+    # We should consider if this is "good enough" carefully.
+    col_data = np.take(np.ravel(arrays['data']), image_ix).astype(
+        np.float64, copy=False)
+    col_inv_var = np.take(np.ravel(arrays['inv_var']), image_ix).astype(
+        np.float64, copy=False)
+    col_var = frac / np.maximum(col_inv_var, 1e-12)
+    x_ix, y_ix = np.divmod(weight_ix, ny)
+
+    for n, x_range in enumerate(context['sparse']):
+        weights = arrays['weights{0:d}'.format(n)]
+        flux = arrays['flux{0:d}'.format(n)]
+        var = arrays['var{0:d}'.format(n)]
+        # Gather the weights of all objects at both taps, as
+        # (nobj, 2, ny, nx_cutout)
+        if x_range is None:
+            col_weights = np.take(
+                np.reshape(weights, (weights.shape[0], -1)), weight_ix,
+                axis=1)
+        else:
+            col_weights = np.moveaxis(ExtractionWeights(
+                weights, arrays['rowindex{0:d}'.format(n)],
+                arrays['xstart{0:d}'.format(n)], nx,
+                x_range=x_range).gather(None, x_ix, y_ix), -1, 0)
+        for tap in range(2):
+            for k in range(col_weights.shape[0]):
+                flux[i, :, k] += np.sum(
+                    col_data[tap] * (col_weights[k, tap] * frac[tap]),
+                    axis=1)
+                var[i, :, k] += np.sum(
+                    col_var[tap] * col_weights[k, tap] ** 2, axis=1)
+
+    for n in range(context['nsets']):
+        arrays['flux{0:d}'.format(n)][i, ~strips.good_cols[i], :] = 0.
@@ -0,0 +1,170 @@
+"""
+Batched 2x2 slit geometry.
+
+The spectral format describes the mapping between the detector and the slit
+at every spectral pixel of every order as a 2x2 matrix, so the models carry
+``(norders, ny, 2, 2)`` stacks of matrices. The functions here operate on
+whole stacks at once (any leading shape is allowed), using the closed-form
+expressions for 2x2 matrices rather than calling :any:`numpy.linalg.inv` one
+matrix at a time.
+"""
+
+from __future__ import division, print_function
+import numpy as np
+
+
+def det(matrices):
+    """
+    Determinant of every matrix in a stack.
+
+    Parameters
+    ----------
+    matrices: :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of matrices.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        ``(...)`` array of determinants.
+    """
+    return matrices[..., 0, 0] * matrices[..., 1, 1] - \
+        matrices[..., 0, 1] * matrices[..., 1, 0]
+
+
+def inv(matrices):
+    """
+    Inverse of every matrix in a stack.
+
+    Parameters
+    ----------
+    matrices: :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of matrices.
+
+    Raises
+    ------
+    numpy.linalg.LinAlgError
+        If any of the matrices is singular, as for :any:`numpy.linalg.inv`.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of inverse matrices.
+    """
+    d = det(matrices)
+    if np.any(d == 0):
+        raise np.linalg.LinAlgError('Singular matrix')
+    inverse = np.empty(np.shape(matrices))
+    inverse[..., 0, 0] = matrices[..., 1, 1] / d
+    inverse[..., 0, 1] = -matrices[..., 0, 1] / d
+    inverse[..., 1, 0] = -matrices[..., 1, 0] / d
+    inverse[..., 1, 1] = matrices[..., 0, 0] / d
+    return inverse
+
+
+def tilt(matrices):
+    """
+    Slope of the slit image on the detector.
+
+    The matrices map detector pixels back to slit co-ordinates, so a step
+    along the slit (the slit-plane +x direction) maps to the first column of
+    the inverse matrix. The tilt is the ratio of its spectral to its spatial
+    component, i.e. the number of detector pixels the slit image moves in
+    the spectral direction per pixel in the spatial direction. The
+    determinant cancels in this ratio, so no inverse is needed.
+
+    Parameters
+    ----------
+    matrices: :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of detector-to-slit matrices.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        ``(...)`` array of slit tilts.
+    """
+    return -matrices[..., 1, 0] / matrices[..., 1, 1]
+
+
+def rotation_scale(rotation, scale_x, scale_y):
+    """
+    Build a stack of detector-to-slit matrices.
+
+    Each matrix rotates by ``rotation`` degrees and scales the two rows by
+    the slit microns per detector pixel in each direction, i.e.
+
+    .. math::
+
+       M = \\begin{bmatrix}
+           \\cos(\\theta) s_x & -\\sin(\\theta) s_x \\\\
+           \\sin(\\theta) s_y & \\cos(\\theta) s_y
+           \\end{bmatrix}
+
+    Parameters
+    ----------
+    rotation: :obj:`numpy.ndarray`
+        Rotation angles, in degrees.
+    scale_x, scale_y: :obj:`numpy.ndarray`
+        Slit microns per detector pixel in the spatial (x) and spectral (y)
+        directions. Must broadcast against ``rotation``.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of matrices, where ``...`` is the broadcast
+        shape of the inputs.
+    """
+    r_rad = np.radians(rotation)
+    cos_r, sin_r, scale_x, scale_y = np.broadcast_arrays(
+        np.cos(r_rad), np.sin(r_rad), scale_x, scale_y)
+    matrices = np.empty(cos_r.shape + (2, 2))
+    matrices[..., 0, 0] = cos_r * scale_x
+    matrices[..., 0, 1] = -sin_r * scale_x
+    matrices[..., 1, 0] = sin_r * scale_y
+    matrices[..., 1, 1] = cos_r * scale_y
+    return matrices
+
+
+def rescale(matrices, xbin=1, ybin=1):
+    """
+    Rescale detector-to-slit matrices for binned detector pixels.
+
+    This is equivalent to ``np.dot(matrices, [[xbin, 0], [0, ybin]])``: a
+    binned pixel covers ``xbin`` (``ybin``) unbinned pixels in the spatial
+    (spectral) direction.
+
+    Parameters
+    ----------
+    matrices: :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of matrices.
+    xbin, ybin: int, optional
+        The binning in the spatial and spectral directions.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        A new ``(..., 2, 2)`` array of rescaled matrices.
+    """
+    rescaled = np.array(matrices, dtype=float)
+    rescaled[..., 0] *= xbin
+    rescaled[..., 1] *= ybin
+    return rescaled
+
+
+def slit_offsets(matrices, slit_coords):
+    """
+    Map slit-plane co-ordinates to detector pixel offsets.
+
+    Parameters
+    ----------
+    matrices: :obj:`numpy.ndarray`
+        ``(..., 2, 2)`` array of detector-to-slit matrices.
+    slit_coords: :obj:`numpy.ndarray`
+        ``(2, n)`` slit-plane co-ordinates (e.g. object centroids), in
+        microns.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        ``(..., 2, n)`` detector pixel offsets of each co-ordinate.
+    """
+    return np.matmul(inv(matrices), slit_coords)
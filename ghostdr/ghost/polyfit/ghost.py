@@ -25,7 +25,9 @@ TODO:
 """
 from __future__ import division, print_function
 import numpy as np
+from astropy.table import Table
 from .polyspect import Polyspect
+from . import geometry
 
 GHOST_BLUE_SZX = 4112 # 4096 # 
 GHOST_BLUE_SZY = 4096 # 4112 # 
@@ -187,6 +189,130 @@ class GhostArm(Polyspect):
                                     cols).sum(axis=1).sum(axis=2)
         return binned_array
 
+    def geometry_table(self, models=None, dtype=np.float64):
+        """
+        Convert the spectral format to a compact table, e.g. for the
+        GEOMETRY extension of a processed flat.
+
+        The unbinned ``x_map``, ``w_map``, ``blaze`` and ``matrices``, and
+        the slit tilt, are stored with one row per order. The binned models
+        of any binning follow from these (see :func:`bin_arm_models
+        <polyfit.plan.bin_arm_models>`), so they are not stored separately.
+
+        Parameters
+        ----------
+        models: list of :obj:`numpy.ndarray`, optional
+            The models the spectral format was computed from, as passed to
+            :meth:`spectral_format_with_matrix
+            <polyfit.polyspect.Polyspect.spectral_format_with_matrix>`. If
+            given, a digest of them is stored, so that the table can be
+            checked against the models when it is loaded.
+        dtype: :obj:`numpy.dtype`, optional
+            The type of the stored maps. ``float32`` halves the size of the
+            table, but the extraction is sensitive to the ``x_map`` at the
+            level of its rounding error, so by default the maps are stored
+            at full precision and the extraction is unchanged by a
+            round-trip through the table.
+
+        Raises
+        ------
+        ValueError
+            If :meth:`spectral_format_with_matrix
+            <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` has
+            not been run.
+
+        Returns
+        -------
+        :obj:`astropy.table.Table`
+            Table with columns ``ORDER``, ``X``, ``W``, ``BLAZE``,
+            ``MATRICES`` and ``TILT``, and the arm, mode and model digest in
+            its ``meta``.
+        """
+        if self.matrices is None:
+            raise ValueError('spectral_format_with_matrix must be run before '
+                             'the geometry can be stored')
+        slit_tilt = self.slit_tilt
+        if slit_tilt is None:
+            slit_tilt = geometry.tilt(self.matrices)
+        orders = np.arange(self.m_min, self.m_min + self.x_map.shape[0])
+        table = Table([orders.astype(np.int16)] +
+                      [np.asarray(arr, dtype=dtype) for arr in
+                       (self.x_map, self.w_map, self.blaze, self.matrices,
+                        slit_tilt)],
+                      names=('ORDER', 'X', 'W', 'BLAZE', 'MATRICES', 'TILT'))
+        table.meta.update({'ARM': self.arm, 'MODE': self.mode,
+                           'SZX': self.szx, 'SZY': self.szy,
+                           'KEY': '' if models is None
+                           else self._format_key(*models)})
+        return table
+
+    def load_geometry_table(self, table, models=None):
+        """
+        Set the spectral format from a table made by :meth:`geometry_table`.
+
+        This is an alternative to :meth:`spectral_format_with_matrix
+        <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` that
+        reads the maps rather than evaluating the models. The
+        :attr:`slit_tilt` is also set.
+
+        Parameters
+        ----------
+        table: :obj:`astropy.table.Table`
+            The geometry table. Its ``meta`` may be either as made by
+            :meth:`geometry_table` or in the FITS header in
+            ``meta['header']``, as it is once read back from disk.
+        models: list of :obj:`numpy.ndarray`, optional
+            If given, the models the geometry must have been computed from.
+
+        Raises
+        ------
+        ValueError
+            If the table is for a different arm or mode, or was not
+            computed from ``models``.
+        """
+        meta = table.meta.get('header', table.meta)
+        if (meta['ARM'], meta['MODE'], meta['SZX'], meta['SZY']) != \
+                (self.arm, self.mode, self.szx, self.szy):
+            raise ValueError('The geometry is for a different arm or mode')
+        if models is not None and \
+                meta.get('KEY', '') != self._format_key(*models):
+            raise ValueError('The geometry was computed from different '
+                             'models')
+        orders = np.asarray(table['ORDER'], dtype=int)
+        if not np.array_equal(orders, np.arange(self.m_min,
+                                                self.m_max + 1)):
+            raise ValueError('The geometry is for different orders')
+        self.x_map, self.w_map, self.blaze, self.matrices, self.slit_tilt = [
+            np.asarray(table[name], dtype=float)
+            for name in ('X', 'W', 'BLAZE', 'MATRICES', 'TILT')]
+
+    @classmethod
+    def from_geometry_table(cls, table, detector_x_bin=1, detector_y_bin=1,
+                            models=None):
+        """
+        Create an arm with the spectral format in a geometry table.
+
+        Parameters
+        ----------
+        table: :obj:`astropy.table.Table`
+            The geometry table, made by :meth:`geometry_table`. It sets the
+            arm and mode.
+        detector_x_bin, detector_y_bin: int, optional
+            The binning of the detector, as for :class:`GhostArm`.
+        models: list of :obj:`numpy.ndarray`, optional
+            As for :meth:`load_geometry_table`.
+
+        Returns
+        -------
+        :class:`GhostArm`
+        """
+        meta = table.meta.get('header', table.meta)
+        arm = cls(arm=meta['ARM'], mode=meta['MODE'],
+                  detector_x_bin=detector_x_bin,
+                  detector_y_bin=detector_y_bin)
+        arm.load_geometry_table(table, models=models)
+        return arm
+
     def slit_flat_convolve(self, flat, slit_profile=None, spatpars=None,
                            microns_pix=None, xpars=None, num_conv=3):
         """
@@ -354,16 +480,14 @@ class GhostArm(Polyspect):
             slit_coord = (np.arange(len(slit_profile)) -
                           len(slit_profile) // 2) * microns_pix
 
-            x_map = np.empty((len(mprimes), self.szy))
+            # The spatial scales and x pixel values, just for these orders
+            y_grid = np.tile(y_values, (len(orders), 1))
+            spat_scales = self.evaluate_poly(spatpars, (y_grid, orders))
+            x_map = self.evaluate_poly(xpars, (y_grid, orders))
 
             # Now convolved in 2D
             for j, mprime in enumerate(mprimes):
-                # The spatial scales
-                spat_scale = self.evaluate_poly(spatpars)[
-                    orders[j] - self.m_min]
-
-                # The x pixel values, just for this order
-                x_map[j] = self.evaluate_poly(xpars)[orders[j] - self.m_min]
+                spat_scale = spat_scales[j]
                 
                 for i in range(im_fft.shape[1]):
                     # Create the slit model.
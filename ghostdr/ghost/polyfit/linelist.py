@@ -0,0 +1,166 @@
+"""
+Arc line catalogues.
+
+:class:`LineCatalogue` holds the wavelengths of an arc line list in sorted
+order, so that the lines falling on each order can be found with
+:any:`numpy.searchsorted` rather than by masking the whole list. Catalogues
+read from text files are kept in memory, and cached as a binary ``.npy``
+file next to the text file (one per set of columns read), so that each
+list is only parsed once.
+"""
+
+from __future__ import division, print_function
+import os
+import tempfile
+import numpy as np
+
+# Catalogues already loaded in this process, by file name and columns.
+_CATALOGUES = {}
+
+
+class LineCatalogue(object):
+    """
+    A sorted list of arc line wavelengths.
+
+    Parameters
+    ----------
+    waves: :obj:`numpy.ndarray`
+        The line wavelengths, in any order.
+    strengths: :obj:`numpy.ndarray`, optional
+        A strength for each line, e.g. as given in the line list.
+
+    Attributes
+    ----------
+    waves: :obj:`numpy.ndarray`
+        The line wavelengths, in increasing order.
+    strengths: :obj:`numpy.ndarray` or None
+        The line strengths, in the same order as :attr:`waves`.
+    """
+    def __init__(self, waves, strengths=None):
+        waves = np.asarray(waves, dtype=float).ravel()
+        order = np.argsort(waves, kind='mergesort')
+        self.waves = waves[order]
+        self.strengths = None if strengths is None else \
+            np.asarray(strengths, dtype=float).ravel()[order]
+
+    def __len__(self):
+        return len(self.waves)
+
+    @classmethod
+    def load(cls, filename, usecols=(1, 2)):
+        """
+        Load a line list from a text file.
+
+        The wavelength and strength columns are parsed once, then kept in
+        memory and cached next to the text file, with the columns in the
+        name, e.g. as ``lines_cols1_2.npy`` for ``lines.txt``. The binary
+        cache is used as long as it is newer than the text file. It is
+        written to a temporary file and moved into place, so that concurrent
+        reductions never read a partly written cache. If it cannot be
+        written (e.g. in a read-only installation), the text file is parsed
+        again in the next process.
+
+        Parameters
+        ----------
+        filename: str
+            The line list, as read by :any:`numpy.loadtxt`.
+        usecols: tuple, optional
+            The wavelength and strength columns. Default is ``(1, 2)``.
+
+        Returns
+        -------
+        :class:`LineCatalogue`
+        """
+        key = (os.path.abspath(filename), tuple(usecols))
+        if key in _CATALOGUES:
+            return _CATALOGUES[key]
+
+        cache = '{0}_cols{1}.npy'.format(
+            os.path.splitext(filename)[0],
+            '_'.join(str(int(col)) for col in usecols))
+        columns = None
+        if os.path.exists(cache) and \
+                os.path.getmtime(cache) >= os.path.getmtime(filename):
+            try:
+                columns = np.load(cache)
+            except (IOError, OSError, ValueError, EOFError):
+                columns = None
+            if columns is not None and columns.shape[0] != len(usecols):
+                columns = None
+        if columns is None:
+            columns = np.atleast_2d(np.loadtxt(filename, usecols=usecols).T)
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(
+                    suffix='.tmp', dir=os.path.dirname(os.path.abspath(cache)))
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, columns)
+                getattr(os, 'replace', os.rename)(tmp, cache)
+                tmp = None
+            except (IOError, OSError):
+                pass
+            finally:
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+
+        catalogue = cls(*columns)
+        _CATALOGUES[key] = catalogue
+        return catalogue
+
+    def in_range(self, wmin, wmax):
+        """
+        Return the index range of the lines between two wavelengths.
+
+        Parameters
+        ----------
+        wmin, wmax: float
+            The wavelength limits, both inclusive.
+
+        Returns
+        -------
+        :obj:`slice`
+            The slice of :attr:`waves` with ``wmin <= wave <= wmax``.
+        """
+        return slice(np.searchsorted(self.waves, wmin, side='left'),
+                     np.searchsorted(self.waves, wmax, side='right'))
+
+    def order_lines(self, w_map_order, hw):
+        """
+        Find the isolated lines that fall on one order.
+
+        Lines are kept if they fall within the wavelength range of the
+        order, at least ``hw`` pixels from either end of it, and at least
+        ``1.5 * hw`` pixels away from the next line on either side (among
+        the lines kept so far).
+
+        Parameters
+        ----------
+        w_map_order: :obj:`numpy.ndarray`
+            The wavelength of every pixel along the order, increasing.
+        hw: int
+            The half-width of the window used to fit each line, in pixels.
+
+        Returns
+        -------
+        waves: :obj:`numpy.ndarray`
+            The wavelengths of the lines.
+        pix: :obj:`numpy.ndarray`
+            The expected (fractional) pixel position of each line along the
+            order.
+        """
+        ny = len(w_map_order)
+        waves = self.waves[self.in_range(np.min(w_map_order),
+                                         np.max(w_map_order))]
+        # Interpolate between the lines and the wavelength scale to find
+        # the expected pixel locations of the lines.
+        pix = np.interp(waves, w_map_order, np.arange(ny))
+        # Ensure that lines close to the edges of the chip are not
+        # considered
+        on_chip = (pix >= hw) & (pix < ny - hw)
+        waves, pix = waves[on_chip], pix[on_chip]
+        # Nor lines too close to their neighbours to be fitted alone
+        gaps = np.abs(np.diff(pix))
+        isolated = np.ones(len(pix), dtype=bool)
+        isolated[1:] &= gaps >= 1.5 * hw
+        isolated[:-1] &= gaps >= 1.5 * hw
+        return waves[isolated], pix[isolated]
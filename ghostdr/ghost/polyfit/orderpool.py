@@ -0,0 +1,194 @@
+"""
+Run per-order extraction tasks, optionally spread over a process pool.
+
+Extraction is independent from order to order, so the work for each order
+can be handed to a separate process. Rather than pickling the (large) input
+images for every task, :class:`OrderPool` writes them once to
+:class:`numpy.memmap` files (in ``/dev/shm`` where available, i.e. in shared
+memory), and each worker maps them read-only. Large per-order outputs are
+written by the workers straight into shared, writable memory maps, and
+copied back into the caller's arrays when the pool is closed.
+
+Task functions must be importable module-level functions. They access the
+shared arrays and the (read-only) context through :func:`shared`, so that
+exactly the same task code runs in serial and in parallel mode.
+"""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+# The arrays and context available to tasks in the current process.
+_SHARED = None
+
+
+def shared():
+    """
+    Return the shared arrays and context of the current :class:`OrderPool`.
+
+    Returns
+    -------
+    arrays: dict
+        The input and output arrays, by name.
+    context: object
+        The context passed to :class:`OrderPool`.
+    """
+    if _SHARED is None:
+        raise RuntimeError('shared() must be called from an OrderPool task')
+    return _SHARED
+
+
+def _init_worker(specs, context):
+    """
+    Map the shared arrays into a worker process.
+
+    ``specs`` maps each array name to its memory-map parameters, or to
+    ``None`` for arrays that were not given.
+    """
+    global _SHARED
+    arrays = {}
+    for name, spec in specs.items():
+        if spec is None:
+            arrays[name] = None
+            continue
+        filename, dtype, shape, mode = spec
+        arrays[name] = np.memmap(filename, dtype=dtype, shape=shape,
+                                 mode=mode)
+    _SHARED = (arrays, context)
+
+
+class OrderPool(object):
+    """
+    Context manager that maps per-order tasks over a (process) pool.
+
+    With ``n_workers`` of 1 (or less), tasks run in the calling process on
+    the arrays themselves. Otherwise, inputs and outputs are backed by
+    memory-mapped files shared with the worker processes. In either case,
+    :meth:`map` returns results in task order, and every output element
+    is written by exactly one task, so the results do not depend on the
+    number of workers.
+
+    Parameters
+    ----------
+    n_workers: int
+        The number of worker processes.
+    arrays: dict, optional
+        Read-only input arrays, by name. ``None`` values are passed through.
+    outputs: dict, optional
+        Output arrays, by name. Tasks write into these in place; in parallel
+        mode the results are copied back when the pool is closed.
+    context: object, optional
+        Read-only, picklable context shared by every task (e.g. models and
+        parameters). It is sent to each worker once, not once per task.
+    tmpdir: str, optional
+        Where to create the memory-mapped files. Defaults to ``/dev/shm`` if
+        it exists, otherwise the system temporary directory.
+    """
+    def __init__(self, n_workers=1, arrays=None, outputs=None, context=None,
+                 tmpdir=None):
+        self.n_workers = int(n_workers) if n_workers else 1
+        self.arrays = arrays or {}
+        self.outputs = outputs or {}
+        self.context = context
+        if tmpdir is None and os.path.isdir('/dev/shm'):
+            tmpdir = '/dev/shm'
+        self.tmpdir = tmpdir
+        self._dir = None
+        self._pool = None
+        self._memmaps = {}
+
+    @property
+    def parallel(self):
+        return self.n_workers > 1
+
+    def _share(self, name, arr, mode):
+        filename = os.path.join(self._dir, name + '.dat')
+        mm = np.memmap(filename, dtype=arr.dtype, shape=arr.shape,
+                       mode='w+')
+        mm[...] = arr
+        mm.flush()
+        self._memmaps[name] = mm
+        return filename, arr.dtype.str, arr.shape, mode
+
+    def __enter__(self):
+        global _SHARED
+        if not self.parallel:
+            arrays = dict(self.arrays)
+            arrays.update(self.outputs)
+            _SHARED = (arrays, self.context)
+            return self
+
+        self._dir = tempfile.mkdtemp(prefix='ghost_orders_', dir=self.tmpdir)
+        specs = {}
+        try:
+            for name, arr in self.arrays.items():
+                specs[name] = None if arr is None else \
+                    self._share(name, np.asarray(arr), 'r')
+            for name, arr in self.outputs.items():
+                specs[name] = self._share(name, arr, 'r+')
+            self._pool = multiprocessing.Pool(
+                self.n_workers, initializer=_init_worker,
+                initargs=(specs, self.context))
+        except Exception:
+            self._cleanup()
+            raise
+        return self
+
+    def map(self, func, tasks, callback=None):
+        """
+        Apply ``func`` to every task.
+
+        Parameters
+        ----------
+        func: callable
+            A module-level function taking a single task argument.
+        tasks: iterable
+            The task arguments, e.g. order indices.
+        callback: callable, optional
+            If given, called as ``callback(task)`` in the calling process
+            once each task has finished, in task order. Worker processes
+            should report progress through this, rather than printing.
+
+        Returns
+        -------
+        results: list
+            ``func(task)`` for every task, in task order.
+        """
+        tasks = list(tasks)
+        if not self.parallel:
+            results = (func(task) for task in tasks)
+        else:
+            results = self._pool.imap(func, tasks, chunksize=1)
+        out = []
+        for task, result in zip(tasks, results):
+            out.append(result)
+            if callback is not None:
+                callback(task)
+        return out
+
+    def _cleanup(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._memmaps = {}
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _SHARED
+        _SHARED = None
+        if not self.parallel:
+            return False
+        if exc_type is None:
+            for name, out in self.outputs.items():
+                out[...] = self._memmaps[name]
+        else:
+            self._pool.terminate()
+        self._cleanup()
+        return False
+
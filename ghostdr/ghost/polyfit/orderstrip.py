@@ -0,0 +1,438 @@
+"""
+A rectified view of the echellogram, with one strip of pixels per order.
+
+Both the 1D and 2D extraction work on a window of ``nx_cutout`` pixels in
+the spatial direction, centred on the order trace, for every spectral pixel
+of every order. :class:`OrderStripCube` computes the detector indices of all
+of these windows once, so that a frame (or its variance, or its bad pixel
+mask) can be gathered into a contiguous ``(norders, ny, nx_cutout)`` cube with
+a single vectorized gather, and per-pixel results can be scattered back to
+detector space. :class:`TiltedStripGather` does the same for the two
+detector rows either side of the tilted slit that the 2D extraction
+interpolates between.
+"""
+
+from __future__ import division, print_function
+import numpy as np
+
+
+class OrderStripCube(object):
+    """
+    Index map between the detector and a rectified cube of order strips.
+
+    The cube has shape ``(norders, ny, nx_cutout)``, where ``nx_cutout`` is
+    the widest cutout of any order. Each order uses the first
+    ``nx_cutouts[i]`` pixels of its strip; the remaining pixels, and any
+    pixels that fall off the edge of the detector, are flagged in
+    :attr:`edges`.
+
+    Detector images are assumed to be ``(nx, ny)`` (spatial, spectral), or
+    ``(ny, nx)`` if ``transpose=True`` is passed to :meth:`gather` and the
+    scatter methods.
+
+    Parameters
+    ----------
+    x_map: :obj:`numpy.ndarray`
+        The (binned) ``(norders, ny)`` x map, as returned by
+        :meth:`Extractor.bin_models <polyfit.extract.Extractor.bin_models>`.
+    matrices: :obj:`numpy.ndarray`
+        The (binned) ``(norders, ny, 2, 2)`` slit matrices.
+    slit_length: float
+        The physical slit length to be extracted, in microns.
+    nx: int
+        The (binned) size of the detector in the spatial direction.
+
+    Attributes
+    ----------
+    nx_cutouts: :obj:`numpy.ndarray`
+        The cutout width for each order.
+    good_cols: :obj:`numpy.ndarray`
+        ``(norders, ny)`` boolean array, False where the ``x_map`` is NaN.
+    x_ix: :obj:`numpy.ndarray`
+        ``(norders, ny, nx_cutout)`` spatial detector index of every cube
+        pixel. Pixels flagged in :attr:`edges` are set to 0.
+    x_start: :obj:`numpy.ndarray`
+        ``(norders, ny)`` spatial detector index of the first pixel of each
+        strip, before any edge pixels are reset. Strip pixel ``k`` is at
+        ``x_start + k``.
+    x_offsets: :obj:`numpy.ndarray`
+        ``(norders, ny, nx_cutout)`` offset of every cube pixel from the
+        order trace, in detector pixels, computed before edge pixels are
+        reset.
+    edges: :obj:`numpy.ndarray`
+        ``(norders, ny, nx_cutout)`` boolean array, True for cube pixels
+        that are off the detector, beyond the width of their order's cutout,
+        or in a NaN column.
+    """
+    def __init__(self, x_map, matrices, slit_length, nx):
+        # Base the cutout size on the largest slit magnification for each
+        # order.
+        nx_cutouts = np.array([
+            int(np.ceil(slit_length / np.min(matrices[i, :, 0, 0])))
+            for i in range(x_map.shape[0])])
+        self._set_windows(x_map, nx_cutouts, nx)
+
+    @classmethod
+    def from_cutouts(cls, x_map, nx_cutouts, nx):
+        """
+        Create the order strips from known cutout widths.
+
+        Parameters
+        ----------
+        x_map: :obj:`numpy.ndarray`
+            The (binned) ``(norders, ny)`` x_map.
+        nx_cutouts: :obj:`numpy.ndarray`
+            The cutout width of each order, e.g. the :attr:`nx_cutouts` of
+            another instance.
+        nx: int
+            The (binned) size of the detector in the spatial direction.
+
+        Returns
+        -------
+        :class:`OrderStripCube`
+        """
+        strips = cls.__new__(cls)
+        strips._set_windows(x_map, np.asarray(nx_cutouts, dtype=int), nx)
+        return strips
+
+    def _set_windows(self, x_map, nx_cutouts, nx):
+        nm, ny = x_map.shape
+        self.nx = nx
+        self.ny = ny
+        self.nx_cutouts = nx_cutouts
+        nx_cutout = int(np.max(self.nx_cutouts))
+        self.shape = (nm, ny, nx_cutout)
+
+        self.good_cols = x_map == x_map
+        x_trace = np.where(self.good_cols, x_map, 0.)
+
+        # FIXME: Is "round" most correct on the next line???
+        self.x_start = np.round(x_trace).astype(int) - \
+            (self.nx_cutouts // 2)[:, None] + nx // 2
+        x_ix = self.x_start[:, :, None] + np.arange(nx_cutout, dtype=int)
+        self.x_offsets = x_ix - x_trace[:, :, None] - nx // 2
+
+        # Deal with edge effects...
+        self.edges = (x_ix >= nx) | (x_ix < 0) | \
+            (np.arange(nx_cutout) >= self.nx_cutouts[:, None, None]) | \
+            ~self.good_cols[:, :, None]
+        x_ix[self.edges] = 0
+        self.x_ix = x_ix
+        self._y_ix = np.arange(ny)[None, :, None]
+
+    @property
+    def norders(self):
+        return self.shape[0]
+
+    def order(self, i):
+        """
+        Return the index slice of the cube for a single order.
+
+        Parameters
+        ----------
+        i: int
+            The order index.
+
+        Returns
+        -------
+        :obj:`tuple`
+            Slice that selects the ``(ny, nx_cutouts[i])`` strip of order
+            ``i`` from any cube-shaped array.
+        """
+        return (i, slice(None), slice(0, self.nx_cutouts[i]))
+
+    def indices(self, order=None, y_offset=None):
+        """
+        Return the detector indices of the cube, or of one order's strip.
+
+        Parameters
+        ----------
+        order: int, optional
+            If given, only return the indices of this order's strip.
+        y_offset: :obj:`numpy.ndarray`, optional
+            Integer offset in the spectral direction, as for :meth:`gather`.
+
+        Returns
+        -------
+        x_ix, y_ix: :obj:`numpy.ndarray`
+            Spatial and spectral indices, which broadcast against each
+            other to the shape of the cube (or strip).
+        """
+        if order is None:
+            x_ix = self.x_ix
+            y_ix = self._y_ix
+        else:
+            sl = self.order(order)
+            x_ix = self.x_ix[sl]
+            y_ix = self._y_ix[0]
+        if y_offset is not None:
+            y_ix = y_ix + y_offset
+            y_ix = np.where((y_ix >= self.ny) | (y_ix < 0), 0, y_ix)
+        return x_ix, y_ix
+
+    def gather(self, image, transpose=False, order=None, y_offset=None):
+        """
+        Gather detector pixels into the rectified cube.
+
+        Parameters
+        ----------
+        image: :obj:`numpy.ndarray`
+            A detector-shaped image (data, inverse variance, mask, ...).
+        transpose: bool, optional
+            Is the image ``(ny, nx)`` rather than ``(nx, ny)``?
+        order: int, optional
+            If given, only gather the ``(ny, nx_cutouts[order])`` strip of
+            this order.
+        y_offset: :obj:`numpy.ndarray`, optional
+            Integer offset in the spectral direction to apply to each pixel
+            (used by the 2D extraction to follow the slit tilt). Must
+            broadcast against the gathered shape. Pixels that are then off
+            the detector in the spectral direction read spectral pixel 0.
+
+        Returns
+        -------
+        cube: :obj:`numpy.ndarray`
+            The gathered pixels. Pixels flagged in :attr:`edges` contain
+            whatever is at spatial pixel 0.
+        """
+        x_ix, y_ix = self.indices(order=order, y_offset=y_offset)
+        if transpose:
+            return image[y_ix, x_ix]
+        return image[x_ix, y_ix]
+
+    def scatter_add(self, values, out, transpose=False):
+        """
+        Add cube values back into a detector image.
+
+        Pixels flagged in :attr:`edges` are ignored. Pixels covered by more
+        than one order receive the sum of the contributions of each order.
+
+        Parameters
+        ----------
+        values: :obj:`numpy.ndarray`
+            A cube-shaped array of values.
+        out: :obj:`numpy.ndarray`
+            The detector image to add into. Modified in place.
+        transpose: bool, optional
+            Is ``out`` ``(ny, nx)`` rather than ``(nx, ny)``?
+
+        Returns
+        -------
+        out: :obj:`numpy.ndarray`
+            The updated detector image.
+        """
+        y_grid = np.broadcast_to(self._y_ix, self.shape)
+        for i in range(self.norders):
+            # Within a single order, every on-chip pixel is unique.
+            on_chip = ~self.edges[i]
+            x_ix = self.x_ix[i][on_chip]
+            y_ix = y_grid[i][on_chip]
+            if transpose:
+                out[y_ix, x_ix] += values[i][on_chip]
+            else:
+                out[x_ix, y_ix] += values[i][on_chip]
+        return out
+
+    def scatter(self, values, out, transpose=False, order=None):
+        """
+        Write cube values into a detector image.
+
+        Pixels flagged in :attr:`edges` are ignored. Where the strips of
+        several orders cover the same pixel, the last order written wins.
+
+        Parameters
+        ----------
+        values: :obj:`numpy.ndarray`
+            A cube-shaped array of values, or the ``(ny, nx_cutouts[order])``
+            strip of a single order if ``order`` is given.
+        out: :obj:`numpy.ndarray`
+            The detector image to write into. Modified in place.
+        transpose: bool, optional
+            Is ``out`` ``(ny, nx)`` rather than ``(nx, ny)``?
+        order: int, optional
+            If given, only write the strip of this order.
+
+        Returns
+        -------
+        out: :obj:`numpy.ndarray`
+            The updated detector image.
+        """
+        orders = range(self.norders) if order is None else [order]
+        for i in orders:
+            sl = self.order(i)
+            on_chip = ~self.edges[sl]
+            x_ix = self.x_ix[sl][on_chip]
+            y_ix = np.broadcast_to(self._y_ix[0], on_chip.shape)[on_chip]
+            strip = values if order is not None else values[sl]
+            if transpose:
+                out[y_ix, x_ix] = strip[on_chip]
+            else:
+                out[x_ix, y_ix] = strip[on_chip]
+        return out
+
+    def scatter_flags(self, flags, mask, flag, transpose=False,
+                      orders=slice(None)):
+        """
+        Set a bit in a detector-shaped mask for flagged cube pixels.
+
+        Parameters
+        ----------
+        flags: :obj:`numpy.ndarray`
+            A boolean cube, True where ``flag`` should be set. If ``orders``
+            is given, only the cube of those orders.
+        mask: :obj:`numpy.ndarray`
+            The detector-shaped mask. Modified in place.
+        flag: int
+            The bit value to OR into ``mask``.
+        transpose: bool, optional
+            Is ``mask`` ``(ny, nx)`` rather than ``(nx, ny)``?
+        orders: slice, optional
+            The orders that ``flags`` covers. Default is all of them.
+
+        Returns
+        -------
+        mask: :obj:`numpy.ndarray`
+            The updated mask.
+        """
+        _, y_ix, _ = np.nonzero(flags)
+        x_ix = self.x_ix[orders][flags]
+        if transpose:
+            mask[y_ix, x_ix] |= flag
+        else:
+            mask[x_ix, y_ix] |= flag
+        return mask
+
+
+class TiltedStripGather(object):
+    """
+    Precomputed gather for the 2D extraction of a set of order strips.
+
+    The 2D extraction samples every strip pixel on the two detector rows
+    either side of the tilted slit, and interpolates linearly between them.
+    Where those rows fall only depends on the geometry (the order strips,
+    slit tilt, slit matrices and slit centroids), not on the frame being
+    extracted, so the detector indices of both rows ("taps") and their
+    interpolation fractions are computed once here. Extracting a frame is
+    then a matter of :meth:`gather`-ing its pixels and taking weighted sums.
+
+    Parameters
+    ----------
+    strips: :class:`OrderStripCube`
+        The order strips.
+    x_map: :obj:`numpy.ndarray`
+        The (binned) ``(norders, ny)`` x map.
+    matrices: :obj:`numpy.ndarray`
+        The (binned) ``(norders, ny, 2, 2)`` slit matrices.
+    slit_tilt: :obj:`numpy.ndarray`
+        The ``(norders, ny)`` slit tilt, as computed by
+        :class:`Extractor <polyfit.extract.Extractor>`.
+    centroids: :obj:`numpy.ndarray`
+        The slit centroid in the spectral direction, as a function of
+        position along the slit.
+    slit_ix: :obj:`numpy.ndarray`
+        The position along the slit of each entry of ``centroids``.
+    transpose: bool, optional
+        Are the images to be gathered ``(ny, nx)`` rather than ``(nx, ny)``?
+
+    Attributes
+    ----------
+    image_ix: :obj:`numpy.ndarray`
+        ``(2, norders, ny, nx_cutout)`` flat index into the (raveled) image
+        of both taps of every strip pixel.
+    weight_ix: :obj:`numpy.ndarray`
+        As :attr:`image_ix`, but into raveled ``(nx, ny)`` arrays such as
+        the extraction weights. This is :attr:`image_ix` itself, unless
+        ``transpose`` is True.
+    frac: :obj:`numpy.ndarray`
+        ``(2, norders, ny, nx_cutout)`` interpolation fraction of each tap.
+    """
+    def __init__(self, strips, x_map, matrices, slit_tilt, centroids,
+                 slit_ix, transpose=False):
+        self.strips = strips
+        self.transpose = transpose
+        nx, ny = strips.nx, strips.ny
+        shape = (2, ) + strips.shape
+        self.image_ix = np.zeros(shape, dtype=np.int64)
+        self.weight_ix = self.image_ix if not transpose else \
+            np.zeros(shape, dtype=np.int64)
+        self.frac = np.zeros(shape)
+
+        max_tilt = np.nanmax(np.abs(slit_tilt))
+        for i in range(strips.norders):
+            sl = strips.order(i)
+            nx_cutout = strips.nx_cutouts[i]
+            ny_cutout = 2 * int(nx_cutout * max_tilt / 2) + 3
+            x_trace = np.where(strips.good_cols[i], x_map[i], 0.)[:, None]
+
+            # Find the pixel (including fractional pixels) within our
+            # cutout that we'll use for extraction. First - find the pixel
+            # coordinates according to slit tilt:
+            x_offsets = strips.x_ix[sl] - x_trace - nx // 2
+            ysub_pix = x_offsets * slit_tilt[i, :ny, None] + ny_cutout // 2
+
+            # Next, add the contribution of the centroid in the slit
+            # viewing camera. The [1,1] component of the matrix is
+            # slit_microns_per_det_pix_y.
+            # FIXME: See 1d code for how this was done for profiles...
+            # PRV: This is only absolutely needed for PRV mode, with
+            # matrices[i,j,1,1] coming from "specmod.fits".
+            ysub_pix += np.interp(x_offsets * matrices[i, :, 0, 0, None],
+                                  slit_ix, centroids) / \
+                matrices[i, :, 1, 1, None]
+
+            # Make sure this is within the limits of our subarray.
+            ysub_pix = np.maximum(ysub_pix, 0)
+            ysub_pix = np.minimum(ysub_pix, ny_cutout - 1e-6)
+
+            ysub_ix_lo = ysub_pix.astype(int)
+            ysub_ix_hi = np.minimum(ysub_ix_lo + 1, ny_cutout - 1)
+            ysub_ix_frac = ysub_pix - ysub_ix_lo
+            for tap, (y_sub, frac) in enumerate(
+                    [(ysub_ix_lo, 1 - ysub_ix_frac),
+                     (ysub_ix_hi, ysub_ix_frac)]):
+                x_ix, y_ix = strips.indices(
+                    order=i, y_offset=y_sub - ny_cutout // 2)
+                self.weight_ix[(tap, ) + sl] = x_ix * ny + y_ix
+                if transpose:
+                    self.image_ix[(tap, ) + sl] = y_ix * nx + x_ix
+                self.frac[(tap, ) + sl] = frac
+
+    def order_taps(self, i):
+        """
+        Return the precomputed taps of a single order.
+
+        Parameters
+        ----------
+        i: int
+            The order index.
+
+        Returns
+        -------
+        image_ix, weight_ix, frac: :obj:`numpy.ndarray`
+            The ``(2, ny, nx_cutouts[i])`` slices of :attr:`image_ix`,
+            :attr:`weight_ix` and :attr:`frac` for the order.
+        """
+        sl = (slice(None), ) + self.strips.order(i)
+        return self.image_ix[sl], self.weight_ix[sl], self.frac[sl]
+
+    def gather(self, image, order=None):
+        """
+        Gather image pixels at both taps of every strip pixel.
+
+        Parameters
+        ----------
+        image: :obj:`numpy.ndarray`
+            A detector-shaped image, ``(ny, nx)`` if ``transpose`` was set.
+        order: int, optional
+            If given, only gather the ``(2, ny, nx_cutouts[order])`` taps of
+            this order.
+
+        Returns
+        -------
+        taps: :obj:`numpy.ndarray`
+            The gathered pixels, ``(2, norders, ny, nx_cutout)`` or
+            ``(2, ny, nx_cutouts[order])``.
+        """
+        image_ix = self.image_ix if order is None else \
+            self.order_taps(order)[0]
+        return np.take(np.ravel(image), image_ix)
@@ -0,0 +1,355 @@
+"""
+Reusable extraction geometry.
+
+For a given arm, resolution mode and binning, the geometry of an extraction
+only depends on the processed flat (its ``XMOD``) and the polyfit models:
+every science frame reduced with the same calibrations has the same binned
+models, slit tilt and order strip windows. An :class:`ExtractionPlan`
+captures this geometry, so that it can be computed once, saved as a compact
+``.npz`` file next to the processed flat, and handed to
+:class:`~polyfit.extract.Extractor` by every later reduction, instead of
+being recomputed from the models each time.
+"""
+
+from __future__ import division, print_function
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+from . import geometry
+from .orderstrip import OrderStripCube
+
+# Bump to stop reusing saved plans when the plan format or the geometry
+# computed by ExtractionPlan.from_arm changes
+_PLAN_VERSION = 1
+
+# Errors raised by np.load on a missing, truncated or corrupt plan
+_LOAD_ERRORS = (IOError, OSError, ValueError, KeyError, EOFError,
+                getattr(zipfile, 'BadZipFile', None) or zipfile.BadZipfile)
+
+
+def bin_arm_models(arm):
+    """
+    Bin the models of a spectrograph arm to match its detector binning.
+
+    See :meth:`Extractor.bin_models <polyfit.extract.Extractor.bin_models>`.
+
+    Parameters
+    ----------
+    arm: :any:`polyspect.Polyspect`
+        The spectrograph arm, on which :meth:`spectral_format_with_matrix
+        <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` has been
+        run.
+
+    Returns
+    -------
+    x_map, w_map, blaze, matrices: :obj:`numpy.ndarray`
+        The binned models.
+    """
+    if arm.xbin == 1 and arm.ybin == 1:
+        return arm.x_map, arm.w_map, arm.blaze, \
+               arm.matrices
+    # Start by getting the order number. This should never change.
+    n_orders = arm.x_map.shape[0]
+
+    x_map = arm.x_map.copy()
+    w_map = arm.w_map.copy()
+    blaze = arm.blaze.copy()
+    matrices = arm.matrices.copy()
+    # The best way to do this is to firstly do all the ybinning, and then do
+    # the x binning
+    if arm.ybin > 1:
+        # Now bin the x_map, firstly in the spectral direction
+        # We do this by reshaping the array by adding another dimension of
+        # length ybin and then averaging over this axis
+        x_map = np.mean(x_map.reshape(n_orders,
+                                      int(arm.szy / arm.ybin),
+                                      arm.ybin), axis=2)
+
+        # Now do the same for the wavelength scale and blaze where necessary
+        w_map = np.mean(w_map.reshape(n_orders,
+                                      int(arm.szy / arm.ybin),
+                                      arm.ybin), axis=2)
+
+        blaze = np.mean(blaze.reshape(n_orders,
+                                      int(arm.szy / arm.ybin),
+                                      arm.ybin), axis=2)
+        # The matrices are a bit harder to work with, but still the same
+        # principle applies.
+        matrices = np.mean(matrices.reshape(n_orders,
+                                            int(
+                                                arm.szy /
+                                                arm.ybin),
+                                            arm.ybin, 2, 2), axis=2)
+
+    if arm.xbin > 1:
+        # Now, naturally, the actualy x values must change according to the
+        # xbin
+        x_map /= arm.xbin
+        # The w_map and blaze remain unchanged by this. 
+
+    # Now we must modify the values of the [0,0] and [1,1] elements of
+    # each matrix according to the binning to reflect the now size of
+    # binned pixels.
+    matrices = geometry.rescale(matrices, arm.xbin, arm.ybin)
+
+    return x_map, w_map, blaze, matrices
+
+
+def plan_key(arm, slit_length, *models):
+    """
+    Compute the key of an extraction plan.
+
+    Parameters
+    ----------
+    arm: :any:`polyspect.Polyspect`
+        The spectrograph arm, which sets the arm, mode, binning and detector
+        size.
+    slit_length: float
+        The physical slit length extracted, as for
+        :meth:`ExtractionPlan.from_arm`, which sets the order strip widths.
+    models: :obj:`numpy.ndarray`
+        The model parameters the geometry is computed from, i.e. the
+        ``XMOD`` of the processed flat and the wavelength, spatial,
+        spectral and rotation models, in that order.
+
+    Returns
+    -------
+    str
+        A checksum of the plan format version, the models, the slit length
+        and the arm configuration.
+    """
+    digest = hashlib.sha1()
+    digest.update('v{0:d}_{1}_{2}_{3}_{4}_{5}_{6!r}'.format(
+        _PLAN_VERSION, arm.arm, arm.mode, arm.xbin, arm.ybin,
+        int(arm.szx / arm.xbin), float(slit_length)).encode())
+    for model in models:
+        model = np.ascontiguousarray(model, dtype=float)
+        digest.update(str(model.shape).encode())
+        digest.update(model.tobytes())
+    return digest.hexdigest()
+
+
+class ExtractionPlan(object):
+    """
+    The geometry of an extraction.
+
+    Parameters
+    ----------
+    arm, mode: str
+        The arm and resolution mode.
+    xbin, ybin: int
+        The detector binning.
+    x_map, w_map, blaze, matrices: :obj:`numpy.ndarray`
+        The binned models, as returned by
+        :meth:`Extractor.bin_models <polyfit.extract.Extractor.bin_models>`.
+    slit_tilt: :obj:`numpy.ndarray`
+        The slit tilt, as :attr:`Extractor.slit_tilt
+        <polyfit.extract.Extractor.slit_tilt>`.
+    nx_cutouts: :obj:`numpy.ndarray`
+        The width of the order strip of every order, which with the
+        ``x_map`` defines the extraction window of every column.
+    nx: int
+        The (binned) size of the detector in the spatial direction.
+    key: str, optional
+        The :any:`plan_key` of the calibrations the plan was computed from.
+    """
+    _ARRAYS = ('x_map', 'w_map', 'blaze', 'matrices', 'slit_tilt',
+               'nx_cutouts')
+
+    def __init__(self, arm, mode, xbin, ybin, x_map, w_map, blaze, matrices,
+                 slit_tilt, nx_cutouts, nx, key=None):
+        self.arm = arm
+        self.mode = mode
+        self.xbin = int(xbin)
+        self.ybin = int(ybin)
+        self.x_map = x_map
+        self.w_map = w_map
+        self.blaze = blaze
+        self.matrices = matrices
+        self.slit_tilt = slit_tilt
+        self.nx_cutouts = np.asarray(nx_cutouts, dtype=int)
+        self.nx = int(nx)
+        self.key = key
+
+    @classmethod
+    def from_arm(cls, arm, slit_length, key=None):
+        """
+        Compute the plan from a spectrograph arm.
+
+        Parameters
+        ----------
+        arm: :any:`polyspect.Polyspect`
+            The spectrograph arm, on which
+            :meth:`spectral_format_with_matrix
+            <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` has
+            been run.
+        slit_length: float
+            The physical slit length to be extracted, in microns, i.e. the
+            :attr:`slit_length <polyfit.slitview.SlitView.slit_length>` of
+            the slit viewer.
+        key: str, optional
+            The :any:`plan_key` of the models.
+
+        Returns
+        -------
+        :class:`ExtractionPlan`
+        """
+        x_map, w_map, blaze, matrices = bin_arm_models(arm)
+        nx = int(arm.szx / arm.xbin)
+        strips = OrderStripCube(x_map, matrices, slit_length, nx)
+        slit_tilt = arm.slit_tilt
+        if slit_tilt is None:
+            slit_tilt = geometry.tilt(arm.matrices)
+        return cls(arm.arm, arm.mode, arm.xbin, arm.ybin, x_map, w_map,
+                   blaze, matrices, slit_tilt, strips.nx_cutouts, nx,
+                   key=key)
+
+    def matches(self, arm):
+        """
+        Does the plan apply to this arm, mode and binning?
+
+        Parameters
+        ----------
+        arm: :any:`polyspect.Polyspect`
+            The spectrograph arm.
+
+        Returns
+        -------
+        bool
+        """
+        return (self.arm, self.mode, self.xbin, self.ybin) == \
+            (arm.arm, arm.mode, arm.xbin, arm.ybin)
+
+    def order_strips(self):
+        """
+        Return the order strips of the plan.
+
+        Returns
+        -------
+        :class:`~polyfit.orderstrip.OrderStripCube`
+        """
+        return OrderStripCube.from_cutouts(self.x_map, self.nx_cutouts,
+                                           self.nx)
+
+    def save(self, filename):
+        """
+        Save the plan as a compressed ``.npz`` file.
+
+        The plan is written to a temporary file in the same directory
+        first, and then moved into place, so that a reduction reading the
+        plan concurrently never sees a partly written file.
+
+        Parameters
+        ----------
+        filename: str
+            The file to write.
+        """
+        fd, tmp = tempfile.mkstemp(
+            suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(
+                    f, arm=self.arm, mode=self.mode,
+                    binning=np.array([self.xbin, self.ybin]), nx=self.nx,
+                    key='' if self.key is None else self.key,
+                    **dict((name, getattr(self, name))
+                           for name in self._ARRAYS))
+            getattr(os, 'replace', os.rename)(tmp, filename)
+            tmp = None
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a plan saved by :meth:`save`.
+
+        Parameters
+        ----------
+        filename: str
+            The ``.npz`` file to read.
+
+        Returns
+        -------
+        :class:`ExtractionPlan`
+        """
+        with np.load(filename) as npz:
+            xbin, ybin = npz['binning']
+            return cls(str(npz['arm']), str(npz['mode']), xbin, ybin,
+                       nx=int(npz['nx']), key=str(npz['key']) or None,
+                       **dict((name, npz[name]) for name in cls._ARRAYS))
+
+    @staticmethod
+    def filename(flat_filename, key):
+        """
+        Return the file name of a plan kept next to a processed flat.
+
+        Parameters
+        ----------
+        flat_filename: str
+            The processed flat.
+        key: str
+            The :any:`plan_key` of the plan.
+
+        Returns
+        -------
+        str
+        """
+        return '{0}_plan_{1}.npz'.format(os.path.splitext(flat_filename)[0],
+                                         key[:16])
+
+    @classmethod
+    def for_flat(cls, flat_filename, arm, slit_length, models,
+                 compute=None):
+        """
+        Look up the plan for a processed flat, or create and save it.
+
+        Parameters
+        ----------
+        flat_filename: str or None
+            The processed flat, next to which the plan is kept. If None,
+            the plan is computed but not saved.
+        arm: :any:`polyspect.Polyspect`
+            The spectrograph arm.
+        slit_length: float
+            As for :meth:`from_arm`.
+        models: list of :obj:`numpy.ndarray`
+            The models, as for :any:`plan_key`.
+        compute: callable, optional
+            Called with no arguments before the plan is computed, to run
+            :meth:`spectral_format_with_matrix
+            <polyfit.polyspect.Polyspect.spectral_format_with_matrix>` on
+            ``arm``. Not called if a saved plan is found.
+
+        Returns
+        -------
+        plan: :class:`ExtractionPlan`
+            The plan.
+        found: bool
+            Was a saved plan found?
+        """
+        key = plan_key(arm, slit_length, *models)
+        filename = None if flat_filename is None else \
+            cls.filename(flat_filename, key)
+        if filename is not None and os.path.exists(filename):
+            try:
+                plan = cls.load(filename)
+            except _LOAD_ERRORS:
+                plan = None
+            if plan is not None and plan.key == key and plan.matches(arm):
+                return plan, True
+
+        if compute is not None:
+            compute()
+        plan = cls.from_arm(arm, slit_length, key=key)
+        if filename is not None:
+            try:
+                plan.save(filename)
+            except (IOError, OSError):
+                pass
+        return plan, False
+
@@ -14,16 +14,115 @@ from __future__ import division, print_function
 
 import os
 import pdb
+import collections
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from matplotlib.widgets import Slider, Button
 import scipy.optimize as op
 from scipy.interpolate import interp1d
+from . import geometry
 
 
 # pylint: disable=maybe-no-member, too-many-instance-attributes
 
+# The Vandermonde bases of the full-detector evaluation grid, keyed on
+# (m_ref, m_min, m_max, szy, ydeg, xdeg)
+_GRID_BASES = {}
+
+# Recently computed spectral formats, by a digest of the spectrograph
+# geometry and the models, so that every frame reduced with the same
+# calibrations shares one (read-only) copy.
+_SPECTRAL_FORMATS = collections.OrderedDict()
+_SPECTRAL_FORMATS_SIZE = 4
+
+def trace_xcorr(image, x, max_shift):
+    """
+    Cross-correlate an image with a set of traces.
+
+    Each trace has a single pixel at its (rounded) position in every row
+    of the image. The cross-correlation at a shift is the sum of the image
+    over the traces, shifted along the rows by that many pixels (wrapping
+    around the edge of the image), with every pixel counted once however
+    many traces fall on it.
+
+    The cross-correlation is computed by gathering the image at the
+    shifted traces, or, when that would touch more pixels than there are
+    in the image, by a row-by-row FFT, whose cost does not depend on the
+    number of shifts.
+
+    Parameters
+    ----------
+    image: :obj:`numpy.ndarray`
+        ``(ny, nx)`` image.
+    x: :obj:`numpy.ndarray`
+        ``(ny, ntraces)`` positions of the traces along the rows. Positions
+        off the image are ignored.
+    max_shift: int
+        The largest shift, in pixels.
+
+    Returns
+    -------
+    shifts: :obj:`numpy.ndarray`
+        The shifts, from ``-max_shift`` to ``max_shift``.
+    xcorr: :obj:`numpy.ndarray`
+        The cross-correlation at each shift.
+    """
+    ny, nx = image.shape
+    shifts = np.arange(-max_shift, max_shift + 1)
+    y_ix = np.broadcast_to(np.arange(x.shape[0])[:, np.newaxis], x.shape)
+    with np.errstate(invalid='ignore'):
+        x_ix = np.round(x)
+        on_image = (x_ix >= 0) & (x_ix < nx) & (y_ix < ny)
+    pixels = np.unique(y_ix[on_image] * nx + x_ix[on_image].astype(int))
+    y_ix, x_ix = np.divmod(pixels, nx)
+
+    if len(shifts) * len(pixels) <= image.size:
+        x_ix = (x_ix[:, np.newaxis] + shifts) % nx
+        xcorr = np.sum(image[y_ix[:, np.newaxis], x_ix], axis=0,
+                       dtype=float)
+    else:
+        # Correlate every row in Fourier space, and sum over the rows
+        # before transforming back
+        traces = np.zeros(image.shape)
+        traces[y_ix, x_ix] = 1.
+        spectrum = np.sum(np.fft.rfft(image, axis=1) *
+                          np.conj(np.fft.rfft(traces, axis=1)), axis=0)
+        xcorr = np.fft.irfft(spectrum, n=nx)[shifts % nx]
+    return shifts, xcorr
+
+
+def peak_shift(shifts, xcorr):
+    """
+    Find the shift of the peak of a cross-correlation.
+
+    The peak is refined to a fraction of a pixel by fitting a parabola to
+    the maximum and its neighbours.
+
+    Parameters
+    ----------
+    shifts: :obj:`numpy.ndarray`
+        Consecutive integer shifts, e.g. from :any:`trace_xcorr`.
+    xcorr: :obj:`numpy.ndarray`
+        The cross-correlation at each shift.
+
+    Returns
+    -------
+    float
+        The shift of the peak. If the maximum is at either end of the
+        shifts, it is not refined.
+    """
+    i = int(np.argmax(xcorr))
+    if i == 0 or i == len(xcorr) - 1:
+        return float(shifts[i])
+    left, peak, right = xcorr[i - 1:i + 2]
+    curvature = left - 2 * peak + right
+    if curvature >= 0:
+        return float(shifts[i])
+    return shifts[i] + 0.5 * (left - right) / curvature
+
+
 class Polyspect(object):
     """
     A class containing tools common for any spectrograph.
@@ -81,6 +180,11 @@ class Polyspect(object):
     matrices: :obj:`numpy.ndarray`
         Rotation matrices as a function of pixel in the spectral direction
         for all orders.
+    slit_tilt: :obj:`numpy.ndarray` or None
+        The slit tilt, if it was loaded along with the maps (see
+        :meth:`GhostArm.load_geometry_table
+        <polyfit.ghost.GhostArm.load_geometry_table>`). Otherwise None,
+        and it is computed from the matrices when needed.
     """
 
     def __init__(self, m_ref, szx, szy, m_min, m_max, transpose):
@@ -97,6 +201,7 @@ class Polyspect(object):
         self.w_map = None
         self.blaze = None
         self.matrices = None
+        self.slit_tilt = None
 
     def evaluate_poly(self, params, data=None):
         """
@@ -116,6 +221,15 @@ class Polyspect(object):
         This function is designed such that any set of polynomial coefficients
         can be given and the evaluation will take place.
 
+        The evaluation is vectorised: the polynomials in :math:`m'` are
+        evaluated for every order at once, and then combined with the powers
+        of :math:`y'`. For the default grid, the Vandermonde bases in
+        :math:`m'` and :math:`y'` are computed once per spectrograph
+        geometry and cached, so that an evaluation only costs two small
+        matrix products. If ``data`` is given, each of its orders is
+        evaluated at its own y values, e.g. at a list of arbitrary
+        (order, y) points.
+
         See Also
         --------
         :meth:`spectral_format`
@@ -152,39 +266,69 @@ class Polyspect(object):
         # The polynomial degree as a function of y position.
         ydeg = params.shape[0] - 1
 
-        if data is not None:
-            y_values, orders = data
-        else:
-            # Create the y_values and orders.
-            # This is essentially the purpose of creating this function. These
-            # parameters can be easily derived from class properties and should
-            # not have to be provided as inputs. 
-            y_values, orders = np.meshgrid(np.arange(self.szy),
-                                           np.arange(self.m_max -
-                                                     self.m_min + 1) +
-                                           self.m_min)
+        if data is None:
+            # The y_values and orders are those of the whole detector, which
+            # can be derived from class properties and should not have to be
+            # provided as inputs.
+            if params.ndim == 1:
+                mprime = self._grid_basis(0, 0)[2]
+                return np.tile(np.poly1d(params)(mprime)[:, None],
+                               (1, self.szy))
+            m_basis, y_basis, _ = self._grid_basis(ydeg, params.shape[1] - 1)
+            return m_basis.dot(params.T).dot(y_basis)
+
+        y_values, orders = data
         # However, we should just use the orders as a single array.
         if orders.ndim > 1:
             orders = orders[:, 0]
-        mprime = np.float(self.m_ref) / orders - 1
+        mprime = float(self.m_ref) / orders - 1
         # In case of a single polynomial, this solves the index problem.
         if params.ndim == 1:
-            polyp = np.poly1d(params)
-            evaluation = np.meshgrid(np.arange(self.szy), polyp(mprime))[1]
-        else:
-            # Initiate a polynomials array.
-            polynomials = np.empty((len(orders), ydeg + 1))
-            # Find the polynomial coefficients for each order.
-            for i in range(ydeg + 1):
-                polyq = np.poly1d(params[i, :])
-                polynomials[:, i] = polyq(mprime)
-            evaluation = np.empty(y_values.shape)
-            # The evaluate as a function of position.
-            for i in range(len(orders)):
-                polyp = np.poly1d(polynomials[i, :])
-                evaluation[i] = polyp(y_values[i] - self.szy // 2)
+            return np.tile(np.poly1d(params)(mprime)[:, None], (1, self.szy))
+        # The polynomial coefficients in y' for each order, and then the
+        # polynomial in y' for every point at once (by Horner's method),
+        # with each order broadcast against its own y values.
+        polynomials = np.vander(mprime, params.shape[1]).dot(params.T)
+        y_values = np.asarray(y_values, dtype=float)
+        polynomials = polynomials.reshape(
+            polynomials.shape[:1] + (1, ) * (y_values.ndim - 1) + (-1, ))
+        yprime = y_values - self.szy // 2
+        evaluation = np.zeros(y_values.shape)
+        for i in range(ydeg + 1):
+            evaluation *= yprime
+            evaluation += polynomials[..., i]
         return evaluation
 
+    def _grid_basis(self, ydeg, xdeg):
+        """
+        Return the Vandermonde bases of the full-detector evaluation grid.
+
+        The bases only depend on the geometry of the spectrograph and the
+        polynomial degrees, so they are cached and shared by every instance
+        with the same geometry.
+
+        Returns
+        -------
+        m_basis: :obj:`numpy.ndarray`
+            ``(norders, xdeg + 1)`` powers of :math:`m'`, highest first.
+        y_basis: :obj:`numpy.ndarray`
+            ``(ydeg + 1, szy)`` powers of :math:`y'`, highest first.
+        mprime: :obj:`numpy.ndarray`
+            The :math:`m'` of every order.
+        """
+        key = (self.m_ref, self.m_min, self.m_max, self.szy, ydeg, xdeg)
+        if key not in _GRID_BASES:
+            mprime = float(self.m_ref) / np.arange(self.m_min,
+                                                   self.m_max + 1) - 1
+            yprime = np.arange(self.szy) - self.szy // 2
+            bases = (np.vander(mprime, xdeg + 1),
+                     np.vander(yprime.astype(float), ydeg + 1).T.copy(),
+                     mprime)
+            for basis in bases:
+                basis.flags.writeable = False
+            _GRID_BASES[key] = bases
+        return _GRID_BASES[key]
+
     def fit_resid(self, params, orders, y_values, data, ydeg=3, xdeg=3,
                   sigma=None):
         """
@@ -248,7 +392,121 @@ class Polyspect(object):
 
         return (data - result) / sigma
 
-    def read_lines_and_fit(self, init_mod, arclines, ydeg=3, xdeg=3):
+    def design_matrix(self, orders, y_values, ydeg=3, xdeg=3):
+        """
+        The design matrix of a polynomial of polynomials.
+
+        The model evaluated by :meth:`evaluate_poly` is linear in its
+        coefficients: each column of the design matrix is the product of a
+        power of :math:`y'` and a power of :math:`m'`, so that the model
+        at every point is the product of this matrix and the flattened
+        ``(ydeg + 1, xdeg + 1)`` coefficient array.
+
+        Parameters
+        ----------
+        orders: :obj:`numpy.ndarray`
+            The order number of every point.
+        y_values: :obj:`numpy.ndarray`
+            The spectral pixel of every point.
+        ydeg: int
+            Polynomial degree as a function of y
+        xdeg: int
+            Polynomial degree as a function of order
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            The ``(npoints, (ydeg + 1) * (xdeg + 1))`` design matrix.
+        """
+        mprime = float(self.m_ref) / np.asarray(orders, dtype=float) - 1
+        yprime = np.asarray(y_values, dtype=float) - self.szy // 2
+        # np.vander puts the highest power first, as np.poly1d does
+        return (np.vander(yprime.ravel(), ydeg + 1)[:, :, None] *
+                np.vander(mprime.ravel(), xdeg + 1)[:, None, :]).reshape(
+            (yprime.size, -1))
+
+    def linear_fit(self, orders, y_values, data, ydeg=3, xdeg=3, sigma=None,
+                   clip=None, max_iter=10):
+        """
+        Fit a polynomial of polynomials by linear least squares.
+
+        As the model is linear in its coefficients, the fit is solved
+        directly from the :meth:`design_matrix`, rather than iteratively
+        with :any:`scipy.optimize.leastsq` on :meth:`fit_resid`. Points with
+        non-finite data or uncertainties are ignored.
+
+        Parameters
+        ----------
+        orders: :obj:`numpy.ndarray`
+            The order number of every point.
+        y_values: :obj:`numpy.ndarray`
+            The spectral pixel of every point.
+        data: :obj:`numpy.ndarray`
+            The values to fit.
+        ydeg: int
+            Polynomial degree as a function of y
+        xdeg: int
+            Polynomial degree as a function of order
+        sigma: :obj:`numpy.ndarray`, optional
+            Uncertainties (or relative uncertainties) of the data, for a
+            weighted fit.
+        clip: float, optional
+            If given, iteratively reject points whose weighted residual is
+            more than ``clip`` times the standard deviation of the weighted
+            residuals of the points kept, and re-fit, until no more points
+            are rejected. Default is ``None`` (no clipping).
+        max_iter: int, optional
+            Maximum number of clipping iterations. Default is ``10``.
+
+        Returns
+        -------
+        params: :obj:`numpy.ndarray`
+            The ``(ydeg + 1, xdeg + 1)`` fitted parameters.
+        covariance: :obj:`numpy.ndarray`
+            The covariance of the flattened parameters, scaled by the reduced
+            chi-squared of the fit (so that ``sigma`` only needs to be
+            correct up to a constant factor).
+        used: :obj:`numpy.ndarray`
+            Boolean array, True for the points that were used in the final
+            fit.
+        """
+        data = np.asarray(data, dtype=float).ravel()
+        sigma = np.ones_like(data) if sigma is None else \
+            np.broadcast_to(np.asarray(sigma, dtype=float).ravel(),
+                            data.shape)
+        design = self.design_matrix(orders, y_values, ydeg, xdeg) / \
+            sigma[:, None]
+        target = data / sigma
+        used = np.isfinite(target) & np.all(np.isfinite(design), axis=1)
+        nparams = design.shape[1]
+
+        for _ in range(max_iter if clip is not None else 1):
+            # The columns span many orders of magnitude, so are normalised
+            # before the solve.
+            scale = np.sqrt(np.sum(design[used] ** 2, axis=0))
+            scale[scale == 0] = 1.
+            u, s, vt = np.linalg.svd(design[used] / scale,
+                                     full_matrices=False)
+            s_inv = np.where(s > s[0] * max(design.shape) *
+                             np.finfo(float).eps, 1. / s, 0.)
+            coeffs = vt.T.dot(s_inv * u.T.dot(target[used])) / scale
+            resid = target - design.dot(coeffs)
+            if clip is None:
+                break
+            scatter = np.std(resid[used])
+            keep = used & (np.abs(resid) <= clip * scatter)
+            if np.array_equal(keep, used) or np.sum(keep) <= nparams:
+                break
+            used = keep
+
+        dof = max(np.sum(used) - nparams, 1)
+        chi2 = np.sum(resid[used] ** 2) / dof
+        covariance = (vt.T * s_inv ** 2).dot(vt) / np.outer(scale, scale) * \
+            chi2
+        return coeffs.reshape((ydeg + 1, xdeg + 1)), covariance, used
+
+    def read_lines_and_fit(self, init_mod, arclines, ydeg=3, xdeg=3,
+                           method='linear', clip=None, full_output=False):
         """
         Fit to an array of spectral data using an initial model parameter set.
 
@@ -287,6 +545,16 @@ class Polyspect(object):
             wavelengths of lines from the :any:`find_lines` function.
         xdeg/ydeg: int
             Order of polynomial
+        method: str, optional
+            ``'linear'`` (the default) to solve the fit directly with
+            :meth:`linear_fit`, or ``'leastsq'`` to minimise
+            :meth:`fit_resid` with :any:`scipy.optimize.leastsq`.
+        clip: float, optional
+            Sigma-clipping threshold of the ``'linear'`` fit; see
+            :meth:`linear_fit`. Default is ``None`` (no clipping).
+        full_output: bool, optional
+            Also return the covariance of the parameters. Default is
+            ``False``.
 
         Returns
         -------
@@ -294,6 +562,9 @@ class Polyspect(object):
             Fitted parameters
         wave_and_resid: :obj:`numpy.ndarray` array
             Wavelength and fit residuals.
+        covariance: :obj:`numpy.ndarray` array
+            The covariance of the flattened parameters, if ``full_output``
+            is set.
         """
         # The next loop reads in wavelengths from a file.
         # To make this neater, it could be a function that overrides this
@@ -310,21 +581,51 @@ class Polyspect(object):
         # For weighted fitting purposes, use the maximum of the Gaussian fit.
         sigma = 1. / lines[:, 4]
         
-        # Now we proceed to the least squares minimization.
-        # We provide the fit_resid function as the minimization function
-        # and the initial model. All required arguments are also provided.
-        bestp = op.leastsq(self.fit_resid, init_mod, args=(orders, y_values,
-                                                           waves, ydeg, xdeg))
-                                                           #sigma))
-        final_resid = self.fit_resid(bestp[0], orders, y_values, waves,
+        if method == 'linear':
+            params, covariance, used = self.linear_fit(
+                orders, y_values, waves, ydeg=ydeg, xdeg=xdeg, clip=clip)
+        elif method == 'leastsq':
+            # Now we proceed to the least squares minimization.
+            # We provide the fit_resid function as the minimization function
+            # and the initial model. All required arguments are also
+            # provided.
+            params, covariance = self._leastsq_fit(
+                init_mod, orders, y_values, waves, ydeg, xdeg)
+            used = np.ones(len(waves), dtype=bool)
+        else:
+            raise ValueError("Unknown fitting method {}".format(method))
+        final_resid = self.fit_resid(params, orders, y_values, waves,
                                      ydeg=ydeg, xdeg=xdeg)
         # Output the fit residuals.
         wave_and_resid = np.array([waves, orders, final_resid]).T
+        if not np.all(used):
+            print("Rejected {0:d} of {1:d} lines".format(
+                int(np.sum(~used)), len(used)))
         print("Fit residual RMS (Angstroms): {0:6.3f}".format(
-            np.std(final_resid)))
-        params = bestp[0].reshape((ydeg + 1, xdeg + 1))
+            np.std(final_resid[used])))
+        params = params.reshape((ydeg + 1, xdeg + 1))
+        if full_output:
+            return params, wave_and_resid, covariance
         return params, wave_and_resid
 
+    def _leastsq_fit(self, init_mod, orders, y_values, data, ydeg, xdeg,
+                     sigma=None):
+        """
+        Fit :meth:`fit_resid` with :any:`scipy.optimize.leastsq`.
+
+        Returns the fitted parameters and their covariance, scaled by the
+        reduced chi-squared as for :meth:`linear_fit` (or None if the fit
+        did not constrain every parameter).
+        """
+        bestp, cov_x, info, _, _ = op.leastsq(
+            self.fit_resid, init_mod,
+            args=(orders, y_values, data, ydeg, xdeg, sigma),
+            full_output=True)
+        if cov_x is not None:
+            dof = max(len(data) - bestp.size, 1)
+            cov_x = cov_x * np.sum(info['fvec'] ** 2) / dof
+        return bestp, cov_x
+
     def spectral_format(self, wparams=None, xparams=None, img=None):
         """
         Form a spectrum from wavelength and polynomial models.
@@ -457,12 +758,15 @@ class Polyspect(object):
             A 2D image array to be used as the basis for the adjustment.
         num_xcorr: int, optional
             Size of the cross correlation function. This should be an indication
-            of how much the cross correlation should move.
+            of how much the cross correlation should move: shifts of up to
+            ``num_xcorr // 2`` pixels are searched. See :any:`trace_xcorr`
+            for the cost of large searches.
 
         Returns
         -------
         new_x: :obj:`numpy.ndarray`
-             A new adjusted value of the x array.
+             A new adjusted value of the x array, shifted by a fraction of a
+             pixel (see :any:`peak_shift`).
         """
         if not isinstance(old_x, np.ndarray):
             raise TypeError('old_x must be a numpy array')
@@ -471,23 +775,12 @@ class Polyspect(object):
         if image.ndim != 2:
             raise UserWarning('image array must be 2 dimensional')
 
-        # Create an array with a single pixel with the value 1.0 at the
-        # expected peak of each order.
-        single_pix_orders = np.zeros(image.shape)
-        xygrid = np.meshgrid(np.arange(old_x.shape[0]),
-                             np.arange(old_x.shape[1]))
-        single_pix_orders[np.round(xygrid[1]).astype(int),
-                          np.round(old_x.T + self.szx // 2).astype(int)] = 1.0
-
-        # Make an array of cross-correlation values.
-        xcorr = np.zeros(num_xcorr)
-        for i in range(num_xcorr):
-            xcorr[i] = np.sum(np.roll(single_pix_orders, i - num_xcorr // 2,
-                                      axis=1) * image)
-
-        # Based on the maximum cross-correlation, adjust the model x values.
-        the_shift = np.argmax(xcorr) - num_xcorr // 2
-        new_x = old_x + the_shift
+        # Cross-correlate the image with a single pixel at the expected
+        # peak of each order, and adjust the model x values by the shift
+        # of the maximum.
+        shifts, xcorr = trace_xcorr(image, old_x.T + self.szx // 2,
+                                    num_xcorr // 2)
+        new_x = old_x + peak_shift(shifts, xcorr)
         return new_x
 
     def fit_x_to_image(self, data, xparams, decrease_dim=8, search_pix=15,
@@ -637,7 +930,8 @@ class Polyspect(object):
         return fitted_params
 
     def fit_to_x(self, x_to_fit, init_mod, y_values=None, sigma=None,
-                 decrease_dim=1):
+                 decrease_dim=1, method='linear', clip=None,
+                 full_output=False):
         """
         Fit to an (norders, ny) array of x-values.
 
@@ -680,12 +974,25 @@ class Polyspect(object):
         decrease_dim: int, optional
             The factor of decreased dimentionality for the fit.
             This needs to be an exact factor of the y size.
+        method: str, optional
+            ``'linear'`` (the default) to solve the fit directly with
+            :meth:`linear_fit`, or ``'leastsq'`` to minimise
+            :meth:`fit_resid` with :any:`scipy.optimize.leastsq`.
+        clip: float, optional
+            Sigma-clipping threshold of the ``'linear'`` fit; see
+            :meth:`linear_fit`. Default is ``None`` (no clipping).
+        full_output: bool, optional
+            Also return the covariance of the parameters. Default is
+            ``False``.
 
         Returns
         -------
 
         params: :obj:`numpy.ndarray` array
             Fitted parameters.
+        covariance: :obj:`numpy.ndarray` array
+            The covariance of the flattened parameters, if ``full_output``
+            is set.
         """
 
         # FIXME More vigorous input type checking (or casting)
@@ -704,7 +1011,7 @@ class Polyspect(object):
         x_values = x_to_fit.copy()
         order_y = np.meshgrid(np.arange(x_values.shape[1]),
                               np.arange(x_values.shape[0]) + self.m_min)
-        if len(y_values) == 0:
+        if y_values is None or len(y_values) == 0:
             y_values = order_y[0]
         orders = order_y[1]
 
@@ -728,24 +1035,38 @@ class Polyspect(object):
         orders = orders.flatten()
         y_values = y_values.flatten()  # pylint: disable=maybe-no-member
         x_values = x_values.flatten()  # pylint: disable=maybe-no-member
+        if sigma is None:
+            sigma = np.ones_like(x_values)
         sigma = sigma.flatten()
 
         ydeg = init_mod.shape[0] - 1
         xdeg = init_mod.shape[1] - 1
         # Do the fit!
-        print("Fitting (this can sometimes take a while...)")
         init_resid = self.fit_resid(init_mod, orders, y_values, x_values,
                                     ydeg=ydeg, xdeg=xdeg, sigma=sigma)
-        bestp = op.leastsq(self.fit_resid, init_mod,
-                           args=(orders, y_values, x_values, ydeg, xdeg, sigma))
-        final_resid = self.fit_resid(bestp[0], orders, y_values, x_values,
+        if method == 'linear':
+            params, covariance, used = self.linear_fit(
+                orders, y_values, x_values, ydeg=ydeg, xdeg=xdeg,
+                sigma=sigma, clip=clip)
+            if not np.all(used):
+                print("Rejected {0:d} of {1:d} points".format(
+                    int(np.sum(~used)), len(used)))
+        elif method == 'leastsq':
+            print("Fitting (this can sometimes take a while...)")
+            params, covariance = self._leastsq_fit(
+                init_mod, orders, y_values, x_values, ydeg, xdeg, sigma)
+        else:
+            raise ValueError("Unknown fitting method {}".format(method))
+        final_resid = self.fit_resid(params, orders, y_values, x_values,
                                      ydeg=ydeg, xdeg=xdeg, sigma=sigma)
-        params = bestp[0].reshape((ydeg + 1, xdeg + 1))
+        params = params.reshape((ydeg + 1, xdeg + 1))
         print(init_resid, final_resid)
         
         # FIXME: Issues with the high resolution fit here. Why? How to diagnose?
         #import pdb; pdb.set_trace()
 
+        if full_output:
+            return params, covariance
         return params
 
     def spectral_format_with_matrix(self, xmod, wavemod, spatmod=None,
@@ -844,6 +1165,12 @@ class Polyspect(object):
         benefit from a number of advantages, as the model evaluations are used
         extensively throughout this module.
 
+        The format only depends on the geometry of the spectrograph and the
+        models, so the most recently used formats are kept in memory (keyed
+        on a digest of both) and shared between every instance that uses
+        them, rather than computed again. The arrays are therefore
+        read-only; copy them before modifying them.
+
         Parameters
         ----------
 
@@ -899,10 +1226,56 @@ class Polyspect(object):
                              'rotmod, otherwise there is no point in running '
                              'this function.')
 
+        key = self._format_key(xmod, wavemod, spatmod, specmod, rotmod)
+        if key in _SPECTRAL_FORMATS:
+            _SPECTRAL_FORMATS[key] = _SPECTRAL_FORMATS.pop(key)
+        else:
+            _SPECTRAL_FORMATS[key] = self._compute_spectral_format(
+                xmod, wavemod, spatmod, specmod, rotmod)
+            while len(_SPECTRAL_FORMATS) > _SPECTRAL_FORMATS_SIZE:
+                _SPECTRAL_FORMATS.popitem(last=False)
+        xbase, waves, blaze, matrices = _SPECTRAL_FORMATS[key]
+
+        self.x_map = xbase
+        self.w_map = waves
+        self.blaze = blaze
+        self.matrices = matrices
+        self.slit_tilt = None
+
+        if return_arrays:
+            return xbase, waves, blaze, matrices
+
+    def _format_key(self, *models):
+        """
+        Return a digest of the spectrograph geometry and some models.
+        """
+        digest = hashlib.sha1()
+        digest.update(str((type(self).__name__, getattr(self, 'arm', None),
+                           getattr(self, 'mode', None), self.m_ref, self.szx,
+                           self.szy, self.m_min, self.m_max,
+                           self.transpose)).encode())
+        for model in models:
+            if model is None:
+                digest.update(b'None')
+                continue
+            model = np.ascontiguousarray(model, dtype=float)
+            digest.update(str(model.shape).encode())
+            digest.update(model.view(np.uint8))
+        return digest.hexdigest()
+
+    def _compute_spectral_format(self, xmod, wavemod, spatmod=None,
+                                 specmod=None, rotmod=None):
+        """
+        Compute a spectral format, for :meth:`spectral_format_with_matrix`.
+
+        Returns
+        -------
+        x, w, blaze, matrices: :obj:`numpy.ndarray`
+            As for :meth:`spectral_format_with_matrix`, made read-only.
+        """
         # Get the basic spectral format
         xbase, waves, blaze = self.spectral_format(xparams=xmod,
                                                    wparams=wavemod)
-        matrices = np.zeros((xbase.shape[0], xbase.shape[1], 2, 2))
         # Initialize key variables in case models are not supplied.
         slit_microns_per_det_pix_x = np.ones(self.szy)
         slit_microns_per_det_pix_y = np.ones(self.szy)
@@ -915,28 +1288,16 @@ class Polyspect(object):
             slit_microns_per_det_pix_y = self.evaluate_poly(specmod)
         if rotmod is not None:
             rotation = self.evaluate_poly(rotmod)
-        # Loop through orders
-        r_rad = np.radians(rotation)
-        extra_rot_mat = np.zeros((xbase.shape[0], xbase.shape[1], 2, 2))
-        # This needs to be done separately because of the
-        # matrix structure
-        extra_rot_mat[:, :, 0, 0] = np.cos(r_rad) * \
-                                    slit_microns_per_det_pix_x
-        extra_rot_mat[:, :, 0, 1] = -np.sin(r_rad) * \
-                                    slit_microns_per_det_pix_x
-        extra_rot_mat[:, :, 1, 0] = np.sin(r_rad) * \
-                                    slit_microns_per_det_pix_y
-        extra_rot_mat[:, :, 1, 1] = np.cos(r_rad) * \
-                                    slit_microns_per_det_pix_y
-        matrices = extra_rot_mat
-
-        self.x_map = xbase
-        self.w_map = waves
-        self.blaze = blaze
-        self.matrices = matrices
-
-        if return_arrays:
-            return xbase, waves, blaze, matrices
+        # Build the matrices for every order and pixel at once
+        matrices = geometry.rotation_scale(rotation,
+                                           slit_microns_per_det_pix_x,
+                                           slit_microns_per_det_pix_y)
+        matrices = np.broadcast_to(matrices, xbase.shape + (2, 2)).copy()
+
+        arrays = (xbase, waves, blaze, matrices)
+        for arr in arrays:
+            arr.flags.writeable = False
+        return arrays
 
     def slit_flat_convolve(self, flat, slit_profile=None):
         """
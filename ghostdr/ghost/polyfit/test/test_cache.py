@@ -0,0 +1,93 @@
+from __future__ import division, print_function
+import pytest
+import numpy as np
+import os
+
+# Test suite for polyfit.cache
+from ghostdr.ghost.polyfit import cache, extract
+
+
+def make_results(seed=0, nresults=2):
+    rng = np.random.RandomState(seed)
+    results = []
+    for _ in range(nresults):
+        weights = extract.ExtractionWeights.from_cube(
+            rng.uniform(size=(3, 20, 5, 2)), rng.randint(0, 40, (3, 20)), 50)
+        results.append((rng.normal(size=(3, 20, 2)),
+                        rng.uniform(size=(3, 20, 2)), weights))
+    return results
+
+
+def test_cache_key(tmpdir):
+    """Test that cache keys follow the arrays, files and parameters"""
+    data = np.arange(12.).reshape((3, 4))
+    cal = tmpdir.join('cal.fits')
+    cal.write('calibration')
+    key = cache.cache_key([data, None], [str(cal)], dict(a=1, b=[2, 3]))
+    assert key == cache.cache_key([data.copy(), None], [str(cal)],
+                                  dict(b=[2, 3], a=1))
+    assert key != cache.cache_key([data.T, None], [str(cal)],
+                                  dict(a=1, b=[2, 3]))
+    assert key != cache.cache_key([data, None], [str(cal)],
+                                  dict(a=1, b=[2, 4]))
+    cal.write('new calibration')
+    assert key != cache.cache_key([data, None], [str(cal)],
+                                  dict(a=1, b=[2, 3]))
+
+
+def test_cache_key_code(monkeypatch):
+    """Test that cache keys follow the extraction code"""
+    assert cache.code_fingerprint() == cache.code_fingerprint()
+    key = cache.cache_key([np.arange(3.)])
+    monkeypatch.setattr(cache, '_FINGERPRINT', 'changed')
+    assert key != cache.cache_key([np.arange(3.)])
+
+
+def test_extraction_cache(tmpdir):
+    """Test storing, restoring and evicting extractions"""
+    store = cache.ExtractionCache(str(tmpdir.join('cache')))
+    assert store.get('a') == (None, {})
+
+    results = make_results()
+    store.put('a', results, crs_per_order=np.array([1, 2, 3]),
+              orders=np.array([33, 34, 35]))
+    restored, info = store.get('a')
+    assert np.array_equal(info['crs_per_order'], [1, 2, 3])
+    assert np.array_equal(info['orders'], [33, 34, 35])
+    for (flux, var, weights), (r_flux, r_var, r_weights) in zip(results,
+                                                                restored):
+        assert np.array_equal(flux, r_flux) and np.array_equal(var, r_var)
+        assert np.array_equal(weights.todense(), r_weights.todense())
+        assert np.array_equal(weights.x_range, r_weights.x_range)
+
+    # The least recently used extraction is evicted first
+    size = os.path.getsize(os.path.join(store.directory, 'a.npz'))
+    store.max_size = 2.5 * size / 2 ** 20
+    store.put('b', make_results(1))
+    os.utime(os.path.join(store.directory, 'b.npz'), (0, 0))
+    store.get('a')
+    store.put('c', make_results(2))
+    assert sorted(os.listdir(store.directory)) == ['a.npz', 'c.npz']
+
+
+def test_extraction_cache_environment(tmpdir, monkeypatch):
+    """Test configuring the cache from the environment"""
+    monkeypatch.setenv(cache.CACHE_ENV, str(tmpdir))
+    monkeypatch.setenv(cache.CACHE_SIZE_ENV, '10')
+    store = cache.ExtractionCache()
+    assert store.enabled and store.directory == str(tmpdir)
+    assert store.max_size == 10.
+
+    monkeypatch.setenv(cache.CACHE_ENV, 'on')
+    store = cache.ExtractionCache()
+    assert store.enabled and store.directory == cache.DEFAULT_CACHE_DIR
+
+    monkeypatch.setenv(cache.CACHE_ENV, 'none')
+    store = cache.ExtractionCache()
+    assert not store.enabled
+    store.put('a', make_results())
+    assert store.get('a') == (None, {})
+
+    # The cache is opt-in
+    monkeypatch.delenv(cache.CACHE_ENV)
+    assert not cache.ExtractionCache().enabled
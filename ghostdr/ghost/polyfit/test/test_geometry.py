@@ -0,0 +1,64 @@
+from __future__ import division, print_function
+import pytest
+import numpy as np
+
+# Test suite for polyfit.geometry
+from ghostdr.ghost.polyfit import geometry
+
+
+@pytest.fixture
+def make_matrices():
+    rng = np.random.RandomState(0)
+    rotation = rng.uniform(-5., 5., size=(3, 7))
+    scale_x = rng.uniform(50., 70., size=(3, 7))
+    scale_y = rng.uniform(50., 70., size=(3, 7))
+    return geometry.rotation_scale(rotation, scale_x, scale_y), \
+        rotation, scale_x, scale_y
+
+
+def test_rotation_scale(make_matrices):
+    """Test geometry.rotation_scale"""
+    matrices, rotation, scale_x, scale_y = make_matrices
+    assert matrices.shape == (3, 7, 2, 2)
+    r_rad = np.radians(rotation[1, 2])
+    expected = np.array([[np.cos(r_rad), -np.sin(r_rad)],
+                         [np.sin(r_rad), np.cos(r_rad)]]) * \
+        np.array([[scale_x[1, 2]], [scale_y[1, 2]]])
+    assert np.allclose(matrices[1, 2], expected)
+    # Scales may also be shared by all orders
+    assert geometry.rotation_scale(rotation, 1., np.ones(7)).shape == \
+        (3, 7, 2, 2)
+
+
+def test_det_inv(make_matrices):
+    """Test geometry.det and geometry.inv against numpy.linalg"""
+    matrices = make_matrices[0]
+    assert np.allclose(geometry.det(matrices), np.linalg.det(matrices))
+    assert np.allclose(geometry.inv(matrices), np.linalg.inv(matrices))
+    assert np.allclose(np.matmul(geometry.inv(matrices), matrices),
+                       np.eye(2))
+    matrices[2, 3] = [[1., 2.], [2., 4.]]
+    with pytest.raises(np.linalg.LinAlgError):
+        geometry.inv(matrices)
+
+
+def test_tilt(make_matrices):
+    """Test geometry.tilt is where the slit x direction maps to"""
+    matrices = make_matrices[0]
+    x_dir = np.matmul(np.linalg.inv(matrices), [1., 0.])
+    assert np.allclose(geometry.tilt(matrices), x_dir[..., 1] / x_dir[..., 0])
+    assert np.all(geometry.tilt(
+        geometry.rotation_scale(np.zeros(4), 1., 2.)) == 0.)
+
+
+def test_rescale_slit_offsets(make_matrices):
+    """Test geometry.rescale and geometry.slit_offsets"""
+    matrices = make_matrices[0]
+    rescaled = geometry.rescale(matrices, 2, 4)
+    assert np.allclose(rescaled, np.dot(matrices, [[2, 0], [0, 4]]))
+    assert not np.shares_memory(rescaled, matrices)
+
+    slit_coords = np.array([[0., 0.], [-30., 30.]])
+    offsets = geometry.slit_offsets(matrices, slit_coords)
+    assert offsets.shape == (3, 7, 2, 2)
+    assert np.allclose(np.matmul(matrices, offsets), slit_coords)
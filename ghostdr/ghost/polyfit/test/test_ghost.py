@@ -2,6 +2,7 @@ from __future__ import division, print_function
 import pytest
 import ghostdr.ghost.polyfit as polyfit
 import astropy.io.fits as pyfits
+from astropy.table import Table
 import pdb
 import numpy as np
 import os
@@ -283,3 +284,199 @@ def test_polyfit(res, arm):
     fitted_params = ghost.fit_x_to_image(flat_conv, xparams=xparams,
                                          decrease_dim=8, inspect=False)
     assert fitted_params.shape == xparams.shape
+
+
+def test_linear_fit():
+    """Test the linear least squares fit of a polynomial of polynomials"""
+    ga = polyfit.ghost.GhostArm('blue', 'std')
+    wmod = pyfits.getdata(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'testdata', 'Polyfit',
+        'blue', 'std', '161120', 'wavemod.fits'))
+    rng = np.random.RandomState(0)
+    nlines = 300
+    orders = rng.randint(ga.m_min, ga.m_max + 1, nlines).astype(float)
+    y_values = rng.uniform(0, ga.szy, nlines)
+    waves = ga.evaluate_poly(wmod, (y_values, orders)) + \
+        rng.normal(0, 0.01, nlines)
+    lines = np.array([waves, y_values, np.zeros(nlines), orders,
+                      np.full(nlines, 100.), np.ones(nlines)]).T
+
+    # The direct solution is the one leastsq converges to, to well within
+    # the noise, and fits at least as well
+    init_mod = wmod * (1 + 1e-4)
+    linear, linear_resid, linear_cov = ga.read_lines_and_fit(
+        init_mod, lines, full_output=True)
+    leastsq, leastsq_resid, leastsq_cov = ga.read_lines_and_fit(
+        init_mod, lines, method='leastsq', full_output=True)
+    assert np.allclose(ga.evaluate_poly(linear), ga.evaluate_poly(leastsq),
+                       rtol=0, atol=5e-3)
+    assert np.sum(linear_resid[:, 2] ** 2) <= \
+        np.sum(leastsq_resid[:, 2] ** 2) * (1 + 1e-9)
+    # leastsq only estimates the covariance, from a finite-difference
+    # Jacobian; the direct one is that of the normal equations
+    assert leastsq_cov.shape == linear_cov.shape
+    design = ga.design_matrix(orders, y_values, *[d - 1 for d in wmod.shape])
+    scale = np.sqrt(np.sum(design ** 2, axis=0))
+    resid = waves - design.dot(linear.ravel())
+    normal = np.linalg.inv((design / scale).T.dot(design / scale))
+    assert np.allclose(linear_cov, normal / np.outer(scale, scale) *
+                       np.sum(resid ** 2) / (nlines - wmod.size),
+                       rtol=1e-6, atol=0)
+    with pytest.raises(ValueError):
+        ga.read_lines_and_fit(init_mod, lines, method='unknown')
+
+    # Outliers are rejected by sigma clipping
+    lines[:10, 0] += 5.
+    params, covariance, used = ga.linear_fit(
+        lines[:, 3], lines[:, 1], lines[:, 0], ydeg=wmod.shape[0] - 1,
+        xdeg=wmod.shape[1] - 1, clip=4.)
+    assert not np.any(used[:10]) and np.all(used[10:])
+    assert np.max(np.abs(ga.evaluate_poly(params) -
+                         ga.evaluate_poly(wmod))) < 0.1
+
+    # fit_to_x recovers a noiseless model
+    xmod = pyfits.getdata(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'testdata', 'Polyfit',
+        'blue', 'std', '161120', 'xmod.fits'))
+    y_grid, order_grid = np.meshgrid(np.arange(0, ga.szy, 64),
+                                     np.arange(ga.m_min, ga.m_max + 1))
+    x_to_fit = ga.evaluate_poly(xmod, (y_grid, order_grid))
+    params = ga.fit_to_x(x_to_fit, np.zeros_like(xmod), y_values=y_grid)
+    assert np.allclose(ga.evaluate_poly(params), ga.evaluate_poly(xmod),
+                       rtol=0, atol=1e-6)
+
+
+def test_evaluate_poly():
+    """Test the vectorised evaluation of a polynomial of polynomials"""
+    ga = polyfit.ghost.GhostArm('red', 'std')
+    params = np.random.RandomState(1).normal(size=(4, 3)) * \
+        np.array([1e-9, 1e-6, 1e-3, 1.])[:, None]
+
+    # Direct evaluation, one order at a time
+    orders = np.arange(ga.m_min, ga.m_max + 1)
+    yprime = np.arange(ga.szy) - ga.szy // 2
+    expected = np.array([
+        np.poly1d([np.poly1d(row)(ga.m_ref / m - 1) for row in params])(
+            yprime) for m in orders])
+
+    evaluation = ga.evaluate_poly(params)
+    assert evaluation.shape == (len(orders), ga.szy)
+    assert np.allclose(evaluation, expected, rtol=1e-12, atol=0)
+    # The grid basis is cached, and shared between instances
+    assert polyfit.ghost.GhostArm('red', 'std')._grid_basis(3, 2)[0] is \
+        ga._grid_basis(3, 2)[0]
+
+    # Arbitrary points are evaluated as on the grid
+    rng = np.random.RandomState(2)
+    o_ix = rng.randint(0, len(orders), 50)
+    y_ix = rng.randint(0, ga.szy, 50)
+    assert np.allclose(ga.evaluate_poly(params, (y_ix, orders[o_ix])),
+                       evaluation[o_ix, y_ix], rtol=1e-12, atol=0)
+
+
+def test_spectral_format_memoized():
+    """Test that spectral formats are computed once and shared"""
+    models = [pyfits.getdata(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'testdata', 'Polyfit',
+        'red', 'high', '161120', '{}.fits'.format(name))) for name in
+        ['xmod', 'wavemod', 'spatmod', 'specmod', 'rotmod']]
+    ga = polyfit.ghost.GhostArm('red', 'high')
+    arrays = ga.spectral_format_with_matrix(*models, return_arrays=True)
+    for arr in arrays:
+        assert not arr.flags.writeable
+        with pytest.raises(ValueError):
+            arr[0] = 0.
+
+    # The same models give the same arrays, whatever the binning
+    other = polyfit.ghost.GhostArm('red', 'high', detector_x_bin=2,
+                                   detector_y_bin=4)
+    other.spectral_format_with_matrix(*[m.copy() for m in models])
+    assert other.x_map is ga.x_map and other.matrices is ga.matrices
+
+    # Different models give a different format, and only the most
+    # recently used formats are kept
+    changed = [m.copy() for m in models]
+    changed[0][-1, -1] += 1.
+    other.spectral_format_with_matrix(*changed)
+    assert np.allclose(other.x_map, ga.x_map + 1.)
+    for i in range(polyfit.polyspect._SPECTRAL_FORMATS_SIZE):
+        changed[0][-1, -1] += 1.
+        other.spectral_format_with_matrix(*changed)
+    assert len(polyfit.polyspect._SPECTRAL_FORMATS) == \
+        polyfit.polyspect._SPECTRAL_FORMATS_SIZE
+    ga.spectral_format_with_matrix(*models)
+    assert ga.x_map is not arrays[0]
+    assert np.array_equal(ga.x_map, arrays[0])
+
+
+def test_geometry_table(tmpdir):
+    """Test storing and loading a spectral format as a geometry table"""
+    models = [pyfits.getdata(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'testdata', 'Polyfit',
+        'blue', 'std', '161120', '{}.fits'.format(name))) for name in
+        ['xmod', 'wavemod', 'spatmod', 'specmod', 'rotmod']]
+    ga = polyfit.ghost.GhostArm('blue', 'std')
+    with pytest.raises(ValueError):
+        ga.geometry_table()
+    ga.spectral_format_with_matrix(*models)
+
+    # Round trip through a FITS table, whose meta ends up in the header
+    filename = str(tmpdir.join('geometry.fits'))
+    ga.geometry_table(models).write(filename)
+    table = Table.read(filename)
+    table.meta = {'header': table.meta}
+    other = polyfit.ghost.GhostArm.from_geometry_table(
+        table, detector_x_bin=2, detector_y_bin=4, models=models)
+    assert (other.arm, other.mode, other.ybin, other.xbin) == \
+        ('blue', 'std', 2, 4)
+    for name in ('x_map', 'w_map', 'blaze', 'matrices'):
+        assert np.array_equal(getattr(other, name), getattr(ga, name))
+    assert np.array_equal(other.slit_tilt,
+                          polyfit.geometry.tilt(ga.matrices))
+
+    # float32 tables are half the size
+    compact = ga.geometry_table(dtype=np.float32)
+    other.load_geometry_table(compact)
+    assert np.allclose(other.x_map, ga.x_map, rtol=1e-6, atol=0)
+
+    # A table only loads for its own arm and models
+    changed = [m.copy() for m in models]
+    changed[0][-1, -1] += 1.
+    with pytest.raises(ValueError):
+        other.load_geometry_table(table, models=changed)
+    with pytest.raises(ValueError):
+        polyfit.ghost.GhostArm('red', 'std').load_geometry_table(table)
+
+    # Recomputing the spectral format discards the loaded slit tilt
+    other.spectral_format_with_matrix(*changed)
+    assert other.slit_tilt is None
+
+
+def test_trace_xcorr():
+    """Test the cross-correlation of an image with traces"""
+    rng = np.random.RandomState(3)
+    ny, nx = 40, 64
+    image = rng.uniform(size=(ny, nx))
+    x = np.stack([20 + 0.1 * np.arange(ny), 40 - 0.2 * np.arange(ny),
+                  40 - 0.2 * np.arange(ny)], axis=1)
+    x[0, 0] = nx + 5.  # off the image
+
+    # The cross-correlation of a single-pixel trace image, by rolling it
+    traces = np.zeros(image.shape)
+    on_image = np.round(x) < nx
+    traces[np.nonzero(on_image)[0], np.round(x[on_image]).astype(int)] = 1.
+    expected = [np.sum(np.roll(traces, shift, axis=1) * image)
+                for shift in range(-5, 6)]
+    shifts, xcorr = polyfit.polyspect.trace_xcorr(image, x, 5)
+    assert np.array_equal(shifts, np.arange(-5, 6))
+    assert np.allclose(xcorr, expected)
+
+    # Large searches are done with an FFT, which gives the same result
+    shifts, xcorr = polyfit.polyspect.trace_xcorr(image, x, 30)
+    assert np.allclose(xcorr[25:36], expected)
+
+    # The peak is found to a fraction of a pixel
+    shifts = np.arange(-10, 11)
+    xcorr = np.exp(-0.5 * ((shifts - 2.3) / 2.) ** 2)
+    assert abs(polyfit.polyspect.peak_shift(shifts, xcorr) - 2.3) < 0.05
+    assert polyfit.polyspect.peak_shift(shifts, shifts) == 10.
@@ -0,0 +1,60 @@
+from __future__ import division, print_function
+import os
+import pytest
+import numpy as np
+
+# Test suite for polyfit.linelist
+from ghostdr.ghost.polyfit import linelist
+
+
+def test_linecatalogue_load(tmpdir):
+    """Test LineCatalogue.load sorts, caches in memory and on disk"""
+    filename = str(tmpdir.join('lines.txt'))
+    np.savetxt(filename, np.array([[0, 5010., 1.5], [0, 5000., 2.5],
+                                   [0, 5020., 0.5]]))
+    catalogue = linelist.LineCatalogue.load(filename)
+    assert np.array_equal(catalogue.waves, [5000., 5010., 5020.])
+    assert np.array_equal(catalogue.strengths, [2.5, 1.5, 0.5])
+    assert os.path.exists(str(tmpdir.join('lines_cols1_2.npy'))), \
+        "Binary line list cache not written"
+    assert linelist.LineCatalogue.load(filename) is catalogue
+
+    # A fresh process reads the binary cache
+    linelist._CATALOGUES.clear()
+    os.remove(filename)
+    open(filename, 'w').close()
+    os.utime(str(tmpdir.join('lines_cols1_2.npy')), None)
+    assert np.array_equal(linelist.LineCatalogue.load(filename).waves,
+                          catalogue.waves)
+    linelist._CATALOGUES.clear()
+
+
+def test_linecatalogue_load_columns(tmpdir):
+    """Test LineCatalogue.load caches each set of columns separately"""
+    filename = str(tmpdir.join('lines.txt'))
+    np.savetxt(filename, np.array([[5010., 1.5, 7.], [5000., 2.5, 8.]]))
+    catalogue = linelist.LineCatalogue.load(filename, usecols=(1, 2))
+    assert np.array_equal(catalogue.waves, [1.5, 2.5])
+    # A fresh process reading other columns does not use the first cache
+    linelist._CATALOGUES.clear()
+    catalogue = linelist.LineCatalogue.load(filename, usecols=(0, 1))
+    assert np.array_equal(catalogue.waves, [5000., 5010.])
+    assert np.array_equal(catalogue.strengths, [2.5, 1.5])
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'lines.txt', 'lines_cols0_1.npy', 'lines_cols1_2.npy']
+    linelist._CATALOGUES.clear()
+
+
+def test_linecatalogue_order_lines():
+    """Test LineCatalogue.order_lines range, edge and neighbour cuts"""
+    w_map_order = 5000. + np.arange(200) * 0.1
+    # Pixels 5 (edge), 50, 100 and 110 (neighbours), 150, and one line
+    # beyond the order
+    catalogue = linelist.LineCatalogue(
+        [5015., 5005., 5000.5, 5011., 5010., 5030.])
+    sl = catalogue.in_range(w_map_order[0], w_map_order[-1])
+    assert np.array_equal(catalogue.waves[sl],
+                          [5000.5, 5005., 5010., 5011., 5015.])
+    waves, pix = catalogue.order_lines(w_map_order, 12)
+    assert np.array_equal(waves, [5005., 5015.])
+    assert np.allclose(pix, [50., 150.])
@@ -0,0 +1,38 @@
+from __future__ import division, print_function
+import pytest
+import numpy as np
+
+# Test suite for polyfit.orderpool
+from ghostdr.ghost.polyfit import orderpool
+
+
+def _square_row(i):
+    # An OrderPool task: square one row of the input into the output, and
+    # return the row sum
+    arrays, context = orderpool.shared()
+    arrays['out'][i] = arrays['image'][i] ** 2 * context['scale']
+    return np.sum(arrays['image'][i])
+
+
+def test_shared_outside_pool():
+    """Test orderpool.shared fails outside of a pool"""
+    with pytest.raises(RuntimeError):
+        orderpool.shared()
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_orderpool_map(n_workers):
+    """Test OrderPool.map gives the same results in serial and parallel"""
+    image = np.random.RandomState(0).normal(size=(6, 10))
+    out = np.zeros_like(image)
+    done = []
+    with orderpool.OrderPool(n_workers, arrays=dict(image=image),
+                             outputs=dict(out=out),
+                             context=dict(scale=2.)) as pool:
+        sums = pool.map(_square_row, range(image.shape[0]),
+                        callback=done.append)
+    assert np.array_equal(out, image ** 2 * 2.), "Outputs not copied back"
+    assert np.array_equal(sums, np.sum(image, axis=1)), "Results out of order"
+    assert done == list(range(image.shape[0])), "Callback not in task order"
+    with pytest.raises(RuntimeError):
+        orderpool.shared()
@@ -0,0 +1,112 @@
+from __future__ import division, print_function
+import pytest
+import numpy as np
+
+# Test suite for polyfit.orderstrip
+from ghostdr.ghost.polyfit import orderstrip
+
+
+@pytest.fixture
+def make_strips():
+    # Two straight orders, the second running off the bottom of the
+    # detector, and a NaN column in the first order
+    nx, ny = 40, 8
+    x_map = np.array([np.linspace(-5., -3., ny), np.linspace(17., 19., ny)])
+    x_map[0, 3] = np.nan
+    matrices = np.zeros((2, ny, 2, 2))
+    matrices[:, :, 0, 0] = 1.
+    matrices[:, :, 1, 1] = 1.
+    matrices[1, :, 0, 0] = 2.
+    strips = orderstrip.OrderStripCube(x_map, matrices, 9., nx)
+    return strips, x_map, nx, ny
+
+
+def test_orderstrip_shape(make_strips):
+    """Test the shape and per-order widths of an OrderStripCube"""
+    strips, x_map, nx, ny = make_strips
+    assert list(strips.nx_cutouts) == [9, 5]
+    assert strips.shape == (2, ny, 9)
+    assert np.all(strips.edges[1, :, 5:]), "Padding not flagged as edges"
+    assert np.all(strips.edges[0, 3]), "NaN column not flagged as edges"
+    assert np.any(strips.edges[1, :, :5]), "Detector edge not flagged"
+    assert np.all(strips.x_ix[strips.edges] == 0)
+    assert np.all(strips.x_ix[~strips.edges] < nx)
+
+
+@pytest.mark.parametrize('transpose', [False, True])
+def test_orderstrip_gather(make_strips, transpose):
+    """Test OrderStripCube.gather against explicit indexing"""
+    strips, x_map, nx, ny = make_strips
+    image = np.arange(nx * ny, dtype=float).reshape((nx, ny))
+    cube = strips.gather(image.T if transpose else image, transpose=transpose)
+    for i, j in [(0, 0), (0, 7), (1, 2)]:
+        x_ix = int(np.round(x_map[i, j])) - strips.nx_cutouts[i] // 2 + \
+            np.arange(strips.nx_cutouts[i]) + nx // 2
+        on_chip = (x_ix >= 0) & (x_ix < nx)
+        assert np.array_equal(cube[i, j, :strips.nx_cutouts[i]][on_chip],
+                              image[x_ix[on_chip], j])
+        assert np.array_equal(strips.gather(image, order=i)[j],
+                              cube[i, j, :strips.nx_cutouts[i]])
+
+
+@pytest.mark.parametrize('transpose', [False, True])
+def test_orderstrip_scatter(make_strips, transpose):
+    """Test OrderStripCube.scatter_add and scatter_flags"""
+    strips, x_map, nx, ny = make_strips
+    shape = (ny, nx) if transpose else (nx, ny)
+    ones = strips.scatter_add(np.ones(strips.shape), np.zeros(shape),
+                              transpose=transpose)
+    assert np.sum(ones) == np.sum(~strips.edges)
+
+    flags = np.zeros(strips.shape, dtype=bool)
+    flags[0, 0, 4] = True
+    mask = strips.scatter_flags(flags, np.zeros(shape, dtype=np.uint16), 8,
+                                transpose=transpose)
+    assert np.sum(mask) == 8
+    assert strips.gather(mask, transpose=transpose)[0, 0, 4] == 8
+    # Flags for a band of orders only
+    band = strips.scatter_flags(flags[1:], np.zeros(shape, dtype=np.uint16),
+                                8, transpose=transpose, orders=slice(1, None))
+    assert np.sum(band) == 0
+    band = strips.scatter_flags(flags[:1], np.zeros(shape, dtype=np.uint16),
+                                8, transpose=transpose, orders=slice(0, 1))
+    assert np.array_equal(band, mask)
+
+    # Writing rather than adding: every on-chip pixel takes the last value
+    values = np.ones(strips.shape)
+    values[1] = 2.
+    image = strips.scatter(values, np.zeros(shape), transpose=transpose)
+    assert np.array_equal(np.unique(image), [0., 1., 2.])
+    assert np.all(strips.gather(image, transpose=transpose, order=1)[
+        ~strips.edges[strips.order(1)]] == 2.)
+    single = strips.scatter(values[strips.order(1)], np.zeros(shape),
+                            transpose=transpose, order=1)
+    assert np.array_equal(single == 2., image == 2.)
+
+
+@pytest.mark.parametrize('transpose', [False, True])
+@pytest.mark.parametrize('tilt', [0., 0.3])
+def test_tiltedstripgather(make_strips, transpose, tilt):
+    """Test TiltedStripGather against OrderStripCube.gather"""
+    strips, x_map, nx, ny = make_strips
+    matrices = np.zeros((2, ny, 2, 2))
+    matrices[:, :, 0, 0] = 1.
+    matrices[:, :, 1, 1] = 1.
+    slit_tilt = np.full((2, ny), tilt)
+    slit_ix = np.arange(5) - 2
+    gather = orderstrip.TiltedStripGather(strips, x_map, matrices, slit_tilt,
+                                          np.zeros(5), slit_ix,
+                                          transpose=transpose)
+    assert gather.image_ix.shape == (2, ) + strips.shape
+    assert (gather.weight_ix is gather.image_ix) != transpose
+
+    image = np.arange(nx * ny, dtype=float).reshape((nx, ny))
+    for i in range(strips.norders):
+        taps = gather.gather(image.T if transpose else image, order=i)
+        _, weight_ix, frac = gather.order_taps(i)
+        assert np.allclose(np.sum(frac, axis=0), 1.)
+        assert np.array_equal(taps, np.take(image, weight_ix))
+        if tilt == 0.:
+            # Without tilt, the first tap is the strip itself
+            assert np.array_equal(taps[0], strips.gather(image, order=i))
+            assert np.all(frac[0] == 1.)
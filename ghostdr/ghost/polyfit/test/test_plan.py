@@ -0,0 +1,118 @@
+from __future__ import division, print_function
+import pytest
+import numpy as np
+import os
+import astropy.io.fits as pyfits
+
+# Test suite for polyfit.plan
+from ghostdr.ghost.polyfit import extract, ghost, plan, slitview
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'testdata')
+
+
+@pytest.fixture(scope='module')
+def make_models():
+    arm, res = 'blue', 'std'
+    models = [pyfits.getdata(os.path.join(
+        TEST_DATA_DIR, 'Polyfit', arm, res, '161120',
+        '{}.fits'.format(name)), 1) for name in
+        ['xmod', 'wavemod', 'spatmod', 'specmod', 'rotmod']]
+    sv = slitview.SlitView(
+        np.loadtxt(os.path.join(TEST_DATA_DIR, 'slitimage.txt')),
+        np.loadtxt(os.path.join(TEST_DATA_DIR, 'slitflat.txt')), mode=res)
+    return models, sv
+
+
+def make_arm(models=None, detector_x_bin=2, detector_y_bin=4):
+    ga = ghost.GhostArm(arm='blue', mode='std',
+                        detector_x_bin=detector_x_bin,
+                        detector_y_bin=detector_y_bin)
+    if models is not None:
+        ga.spectral_format_with_matrix(*models)
+    return ga
+
+
+def test_plan_key(make_models, monkeypatch):
+    """Test that plan keys follow the models, slit length and binning"""
+    models, sv = make_models
+    key = plan.plan_key(make_arm(), sv.slit_length, *models)
+    assert key == plan.plan_key(make_arm(), sv.slit_length,
+                                *[m.copy() for m in models])
+    assert key != plan.plan_key(make_arm(detector_y_bin=2), sv.slit_length,
+                                *models)
+    assert key != plan.plan_key(make_arm(detector_x_bin=1), sv.slit_length,
+                                *models)
+    assert key != plan.plan_key(make_arm(), sv.slit_length * 1.1, *models)
+    changed = [m.copy() for m in models]
+    changed[0][0, 0] *= 1.001
+    assert key != plan.plan_key(make_arm(), sv.slit_length, *changed)
+    monkeypatch.setattr(plan, '_PLAN_VERSION', plan._PLAN_VERSION + 1)
+    assert key != plan.plan_key(make_arm(), sv.slit_length, *models)
+
+
+def test_extraction_plan(make_models, tmpdir):
+    """Test computing, saving, finding and using an ExtractionPlan"""
+    models, sv = make_models
+    ga = make_arm(models)
+    flat = str(tmpdir.join('flat.fits'))
+
+    # The first look-up computes the plan, the second finds it
+    calls = []
+    arm = make_arm()
+    p, found = plan.ExtractionPlan.for_flat(
+        flat, arm, sv.slit_length, models,
+        compute=lambda: calls.append(arm.spectral_format_with_matrix(
+            *models)))
+    assert not found and len(calls) == 1
+    p, found = plan.ExtractionPlan.for_flat(
+        flat, make_arm(), sv.slit_length, models,
+        compute=lambda: calls.append(None))
+    assert found and len(calls) == 1
+    assert os.path.exists(plan.ExtractionPlan.filename(flat, p.key))
+    assert [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')] == []
+
+    # A partly written or corrupt plan file is recomputed, not reused
+    filename = plan.ExtractionPlan.filename(flat, p.key)
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    for corrupt in (contents[:len(contents) // 2], b'PK\x03\x04', b''):
+        with open(filename, 'wb') as f:
+            f.write(corrupt)
+        _, found = plan.ExtractionPlan.for_flat(
+            flat, ga, sv.slit_length, models)
+        assert not found
+    _, found = plan.ExtractionPlan.for_flat(flat, ga, sv.slit_length, models)
+    assert found
+    assert p.matches(ga) and not p.matches(make_arm(detector_y_bin=2))
+
+    # A plan saved for one slit length is not reused for another
+    other = make_arm()
+    p_other, found = plan.ExtractionPlan.for_flat(
+        flat, other, sv.slit_length * 1.5, models,
+        compute=lambda: other.spectral_format_with_matrix(*models))
+    assert not found and p_other.key != p.key
+    assert np.any(p_other.nx_cutouts != p.nx_cutouts)
+
+    # The plan holds the same geometry as the arm
+    reference = extract.Extractor(ga, sv)
+    for planned, computed in zip(p.order_strips().__dict__.items(),
+                                 reference.order_strips().__dict__.items()):
+        assert planned[0] == computed[0]
+        assert np.array_equal(planned[1], computed[1])
+    for planned, computed in zip((p.x_map, p.w_map, p.blaze, p.matrices),
+                                 reference.bin_models()):
+        assert np.array_equal(planned, computed, equal_nan=True)
+    assert np.array_equal(p.slit_tilt, reference.slit_tilt)
+
+    # An arm without models extracts the same with the plan
+    rng = np.random.RandomState(0)
+    model = reference.make_pixel_model()
+    data = model * 1e4 + rng.normal(0, 3., model.shape)
+    with_plan = extract.Extractor(make_arm(), sv, plan=p)
+    for a, b in zip(reference.one_d_extract(data=data)[:2],
+                    with_plan.one_d_extract(data=data)[:2]):
+        assert np.array_equal(a, b, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        extract.Extractor(make_arm(detector_y_bin=2), sv, plan=p)
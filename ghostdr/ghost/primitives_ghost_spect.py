@@ -32,6 +32,9 @@ from gempy.gemini import gemini_tools as gt
 
 from .polyfit import GhostArm, Extractor, SlitView
 from .polyfit.ghost import GhostArm
+from .polyfit.linelist import LineCatalogue
+from .polyfit.plan import ExtractionPlan
+from .polyfit.cache import ExtractionCache, cache_key
 
 from .primitives_ghost import GHOST, filename_updater
 
@@ -245,7 +248,10 @@ class GHOSTSpect(GHOST):
                 wfit /= 2.0
 
             for ext in ad:
-                ext.WAVL = wfit
+                # Only keep the orders that were extracted
+                orders = getattr(ext, 'ORDERS', None)
+                ext.WAVL = wfit if orders is None else \
+                    wfit[np.asarray(orders, dtype=int) - gs.m_min]
 
             # FIXME Wavelength unit needs to be in output ad
 
@@ -640,9 +646,9 @@ class GHOSTSpect(GHOST):
           executes :meth:`polyfit.GhostArm.spectral_format_with_matrix`;
         - Instantiate :class:`polyfit.SlitView` and :class:`polyfit.Extractor`
           objects for the input
-        - Extract the profile from the input AstroData, using calls to
-          :meth:`polyfit.Extractor.one_d_extract` and
-          :meth:`polyfit.Extractor.two_d_extract`.
+        - Extract the profile from the input AstroData for every required
+          object/sky configuration, in a single pass using
+          :meth:`polyfit.Extractor.extract_configurations`.
         
         Parameters
         ----------
@@ -674,6 +680,48 @@ class GHOSTSpect(GHOST):
             Denotes whether or not to write out the result of profile
             extraction to disk. This is useful for both debugging, and data
             quality assurance.
+        n_workers: int
+            Number of processes to spread the orders over during extraction.
+            The image, variance and mask are shared with the workers through
+            memory-mapped files rather than copied. The result is identical
+            to a serial extraction. Defaults to 1 (serial).
+        cr_snoise: float
+            Fractional noise added to the data variance when searching the
+            extraction for additional cosmic rays. Defaults to 0.1.
+        cr_nsigma: float
+            Number of standard deviations above the slit profile model at
+            which a pixel is flagged as a cosmic ray. Defaults to 6.
+        cr_max_iter: int
+            Maximum number of passes of the cosmic ray search; the model is
+            re-fitted without the flagged pixels between passes. Defaults
+            to 1.
+        dtype: str
+            Floating-point type of the bulk extraction arrays, ``float64``
+            or ``float32``. Single precision halves the memory needed to
+            extract a frame; the per-order solves stay in double precision.
+            Defaults to ``float64``.
+        memory_budget: float
+            Approximate limit, in MB, on the working memory of the 1D
+            extraction. If set, the orders are extracted in bands that only
+            read the detector rows they cover. Defaults to None (no limit).
+        orders: list of int
+            Order numbers to extract. If set, only these orders are
+            extracted, and the extraction time scales with the number of
+            orders. The order numbers of every output extension are stored
+            in its ``ORDERS`` array. Defaults to None (all orders).
+        wavelength_range: list of float
+            ``[wmin, wmax]``: only extract the orders that overlap this
+            wavelength range, in Angstroms. May be combined with ``orders``.
+            Defaults to None (all orders).
+
+        If the ``GHOSTDR_EXTRACTION_CACHE`` environment variable is set (to
+        a directory, or to ``on`` for the default one), extractions are kept
+        in an on-disk cache, keyed on the data, variance and mask, the
+        calibration and polyfit files, the parameters and the extraction
+        code, so that re-running a reduction restores them instead of
+        extracting again. Its size limit, in MB, is set by
+        ``GHOSTDR_EXTRACTION_CACHE_SIZE``; the least recently used
+        extractions are evicted first. The cache is disabled by default.
         """
         log = self.log
         log.debug(gt.log_message("primitive", self.myself(), "starting"))
@@ -736,6 +784,8 @@ class GHOSTSpect(GHOST):
         _, slitflat_list = gt.make_lists(adinputs, slitflat_list, force_ad=True)
         _, flat_list = gt.make_lists(adinputs, flat_list, force_ad=True)
 
+        cache = ExtractionCache()
+
         for ad, slit, slitflat, flat in zip(adinputs, slit_list,
                                             slitflat_list, flat_list):
             # CJS: failure to find a suitable auxiliary file (either because
@@ -776,11 +826,35 @@ class GHOSTSpect(GHOST):
                             " skipping".format(ad.filename))
                 continue
 
-            arm.spectral_format_with_matrix(flat[0].XMOD, wpars[0].data,
-                        spatpars[0].data, specpars[0].data, rotpars[0].data)
-            sview = SlitView(slit[0].data, slitflat[0].data, mode=res_mode)
-            extractor = Extractor(arm, sview, badpixmask=ad[0].mask,
-                                  vararray=ad[0].variance)
+            # Look up the extraction in the cache before the data are
+            # modified by the flat pre-correction
+            key = self._extraction_cache_key(
+                ad, [slit, slitflat, flat],
+                [poly_wave, poly_spat, poly_spec, poly_rot], params)
+            cached, cached_info = cache.get(key)
+            if cache.enabled:
+                log.stdinfo("Extraction cache {} for {}".format(
+                    "miss" if cached is None else "hit", ad.filename))
+
+            # On a hit, neither the extraction geometry nor an Extractor is
+            # needed: everything used below is stored with the results
+            if cached is None:
+                sview = SlitView(slit[0].data, slitflat[0].data,
+                                 mode=res_mode)
+                plan = self._get_extraction_plan(
+                    arm, flat, sview, [flat[0].XMOD, wpars[0].data,
+                                       spatpars[0].data, specpars[0].data,
+                                       rotpars[0].data])
+                extractor = Extractor(
+                    arm, sview, badpixmask=ad[0].mask,
+                    vararray=ad[0].variance, n_workers=params['n_workers'],
+                    snoise=params['cr_snoise'], nsigma=params['cr_nsigma'],
+                    cr_max_iter=params['cr_max_iter'], dtype=params['dtype'],
+                    memory_budget=params['memory_budget'], plan=plan,
+                    orders=params['orders'],
+                    wavelength_range=params['wavelength_range'],
+                    progress=lambda i, n: log.debug(
+                        "Extracting order {} of {}".format(i + 1, n)))
                         
             # FIXED - MCW 190906
             # Added a kwarg to one_d_extract (the only Extractor method which
@@ -791,7 +865,7 @@ class GHOSTSpect(GHOST):
 
             # Compute the flat correction, and add to bad pixels based on this.
             # FIXME: This really could be done as part of flat processing!
-            if params['flat_precorrect']:
+            if params['flat_precorrect'] and cached is None:
                 try:
                     pix_to_correct = flat[0].PIXELMODEL > 0
 
@@ -906,39 +980,35 @@ class GHOSTSpect(GHOST):
             #objs_to_use = [[0], ]
             #use_sky = [False, ]
 
-            for i, (o, s) in enumerate(zip(objs_to_use, use_sky)):
-                print("OBJECTS:" + str(o))
-                print("SKY:" + str(s))
-                # CJS: Makes it clearer that you're throwing the first two
-                # returned objects away (get replaced in the two_d_extract call)
-                
-                # Need to use corrected_data here; the data in ad[0] is
-                # overwritten with the first extraction pass of this loop
-                # (see the try-except statement at line 925)
-                DUMMY, _, extracted_weights = extractor.one_d_extract(
-                    data=corrected_data, vararray=corrected_var,
+            # All configurations are extracted in a single pass over the
+            # frame, so that the order strips, slit profiles and cosmic ray
+            # search are shared between them.
+            # Need to use corrected_data here; the data in ad[0] is
+            # overwritten with the first extraction result below
+            if cached is None:
+                extractions = extractor.extract_configurations(
+                    corrected_data, list(zip(objs_to_use, use_sky)),
                     correct_for_sky=params['sky_correct'],
-                    use_sky=s, used_objects=o,
-                )
-
-                # DEBUG - see Mike's notes.txt, where we want to look at DUMMY
-                #import matplotlib.pyplot as plt
-                #import pickle
-                #pickle.dump( (DUMMY), open( "dummy.p", "wb" ) )
-                #plt.ion()
-                #plt.figure(1)
-                ##plt.plot(DUMMY[1,3510:3720,0])
-                ##plt.plot(np.sum(corrected_data[340:410,3510:3720], axis=0))
-                #plt.plot(np.sum(corrected_data[540:645,2380:3280], axis=0))
-                #plt.plot(DUMMY[2,2380:3280], label='Extracted')
-                #plt.ylim([0,6e4])
-                #plt.legend()
-                #import pdb; pdb.set_trace()
-
-                extracted_flux, extracted_var = extractor.two_d_extract(
-                    corrected_data,
-                    extraction_weights=extracted_weights,
+                    vararray=corrected_var,
                 )
+                crs_per_order = extractor.crs_per_order
+                orders = extractor.orders
+                cache.put(key, extractions, crs_per_order=crs_per_order,
+                          orders=orders)
+            else:
+                extractions = cached
+                crs_per_order = cached_info['crs_per_order']
+                orders = cached_info['orders']
+            log.stdinfo("{}: flagged {} additional cosmic ray pixels".format(
+                ad.filename, int(np.sum(crs_per_order))))
+            log.debug("Cosmic ray pixels per order: {}".format(
+                list(crs_per_order)))
+
+            for i, (extracted_flux, extracted_var,
+                    extracted_weights) in enumerate(extractions):
+                o, s = objs_to_use[i], use_sky[i]
+                print("OBJECTS:" + str(o))
+                print("SKY:" + str(s))
 
                 # CJS: Since you don't use the input AD any more, I'm going to
                 # modify it in place, in line with your comment that you're
@@ -954,7 +1024,12 @@ class GHOSTSpect(GHOST):
                     ad.append(new_adi[0])
                     ad[i].reset(extracted_flux, mask=None,
                                 variance=extracted_var)
-                ad[i].WGT = extracted_weights
+                # The weights are stored compactly, one short weight vector
+                # per order and column, as a table
+                ad[i].WGT = extracted_weights.to_table()
+                # The order numbers of the extracted spectra, which may only
+                # be a subset of the orders
+                ad[i].ORDERS = orders
                 ad[i].hdr['DATADESC'] = (
                     'Order-by-order processed science data - '
                     'objects {}, sky correction = {}'.format(
@@ -1116,10 +1191,22 @@ class GHOSTSpect(GHOST):
         frame. This model is placed into a new ``.XMOD`` attribute on the
         extension.
         
+        If ``store_geometry`` is set, the spectral format computed from
+        the new model (the ``x_map``, ``w_map``, ``blaze`` and ``matrices``
+        of :meth:`polyfit.GhostArm.spectral_format_with_matrix`, and the slit
+        tilt) is also stored, as a table in a new ``.GEOMETRY`` attribute.
+        Later reductions with the processed flat then read the spectral
+        format, rather than evaluating it from the models again.
+
         Parameters
         ----------
         slitflat: str or :class:`astrodata.AstroData` or None
             slit flat to use; if None, the calibration system is invoked
+        skip_pixel_model: bool
+            Don't add a pixel model of the flat in a ``.PIXELMODEL``
+            attribute?
+        store_geometry: bool
+            Store the spectral format in a ``.GEOMETRY`` attribute?
         """
         log = self.log
         log.debug(gt.log_message("primitive", self.myself(), "starting"))
@@ -1207,29 +1294,26 @@ class GHOSTSpect(GHOST):
 
             #MJI: Compute a pixel-by-pixel model of the flat field from the new XMOD and
             #the slit image.
-            if not params['skip_pixel_model']:
-                # FIXME: MJI Copied directly from extractProfile. Is this compliant?
+            if not params['skip_pixel_model'] or params['store_geometry']:
                 try:
-                    poly_wave = self._get_polyfit_filename(ad, 'wavemod')
-                    poly_spat = self._get_polyfit_filename(ad, 'spatmod')
-                    poly_spec = self._get_polyfit_filename(ad, 'specmod')
-                    poly_rot = self._get_polyfit_filename(ad, 'rotmod')
-                    wpars = astrodata.open(poly_wave)
-                    spatpars = astrodata.open(poly_spat)
-                    specpars = astrodata.open(poly_spec)
-                    rotpars = astrodata.open(poly_rot)
+                    models = self._get_spectral_format_models(ad)
                 except IOError:
                     log.warning("Cannot open required initial model files "
                                 "for {}; skipping".format(ad.filename))
                     continue
+                ghost_arm.spectral_format_with_matrix(*models)
+                if params['store_geometry']:
+                    ad[0].GEOMETRY = ghost_arm.geometry_table(models)
 
+            if not params['skip_pixel_model']:
                 #Create an extractor instance, so that we can add the pixel model to the 
                 #data.
-                ghost_arm.spectral_format_with_matrix(ad[0].XMOD, wpars[0].data,
-                            spatpars[0].data, specpars[0].data, rotpars[0].data)
                 extractor = Extractor(ghost_arm, slitview, badpixmask=ad[0].mask,
                                       vararray=ad[0].variance)
-                pixel_model = extractor.make_pixel_model()
+                pixel_model = extractor.make_pixel_model(
+                    progress=lambda i, n: log.debug(
+                        "Creating pixel model: order {} of {}".format(
+                            i + 1, n)))
                 ad[0].PIXELMODEL = pixel_model
 
             gt.mark_history(ad, primname=self.myself(), keyword=timestamp_key)
@@ -1301,25 +1385,32 @@ class GHOSTSpect(GHOST):
                 continue
 
             # CJS: line_list location is now in lookups/__init__.py
+            # The catalogue is only parsed once, and cached in binary form
             arclinefile = os.path.join(os.path.dirname(polyfit_dict.__file__),
                                        line_list)
-            arcwaves, arcfluxes = np.loadtxt(arclinefile, usecols=[1, 2]).T
+            arclines = LineCatalogue.load(arclinefile, usecols=(1, 2))
 
             arm = GhostArm(arm=ad.arm(), mode=ad.res_mode())
-            arm.spectral_format_with_matrix(flat[0].XMOD,
-                                            wpars[0].data,
-                                            spatpars[0].data,
-                                            specpars[0].data,
-                                            rotpars[0].data)
+            self._set_spectral_format(arm, flat, [flat[0].XMOD,
+                                                  wpars[0].data,
+                                                  spatpars[0].data,
+                                                  specpars[0].data,
+                                                  rotpars[0].data])
 
-            extractor = Extractor(arm, None)  # slitview=None for this usage
+            # slitview=None for this usage. The arc may only have been
+            # extracted for a subset of the orders
+            extractor = Extractor(arm, None,
+                                  orders=getattr(ad[0], 'ORDERS', None))
 
             # Find lines based on the extracted flux and the arc wavelengths. 
             # Note that "inspect=True" also requires and input arc file, which has
             # the non-extracted data. There is also a keyword "plots".
-            lines_out = extractor.find_lines(ad[0].data, arcwaves,
+            lines_out = extractor.find_lines(ad[0].data, arclines,
                                              arcfile=ad[0].data,
                                              plots=params['plot_fit'])
+            if extractor.num_rejected_lines > 0:
+                log.stdinfo("Rejecting {} lines due to low SNR".format(
+                    extractor.num_rejected_lines))
             
             #lines_out is now a long vector of many parameters, including the 
             #x and y position on the chip of each line, the order, the expected 
@@ -1462,19 +1553,20 @@ class GHOSTSpect(GHOST):
                            detector_x_bin= ad.detector_x_bin(),
                            detector_y_bin= ad.detector_y_bin()
                            )
-            arm.spectral_format_with_matrix(flat[0].XMOD,
-                                            wpars[0].data,
-                                            spatpars[0].data,
-                                            specpars[0].data,
-                                            rotpars[0].data,
-                                            )
-
             sview = SlitView(slit[0].data, slitflat[0].data, mode=res_mode)
+            plan = self._get_extraction_plan(
+                arm, flat, sview, [flat[0].XMOD, wpars[0].data,
+                                   spatpars[0].data, specpars[0].data,
+                                   rotpars[0].data])
 
-            extractor = Extractor(arm, sview)
+            extractor = Extractor(arm, sview, plan=plan,
+                                  orders=getattr(ad[0], 'ORDERS', None))
 
             #FIXME - Marc and were *going* to try:
             #adjusted_data = arm.bin_data(extractor.adjust_data(flat[0].data))
+            # WGT is the compact weights table written by extractProfile, or
+            # a dense weights image for older files; two_d_extract takes
+            # either. The table rows are only read for the orders extracted.
             extracted_flux, extracted_var = extractor.two_d_extract(
                 arm.bin_data(flat[0].data), extraction_weights=ad[0].WGT)
 
@@ -2039,6 +2131,15 @@ class GHOSTSpect(GHOST):
             # if success
         ]
 
+        # The standard and the science frames may have been extracted for
+        # different subsets of the orders, so the sensitivity functions are
+        # matched to the science orders by order number
+        m_min = GhostArm(arm=std.arm(), mode=std.res_mode()).m_min
+        std_orders = getattr(std[0], 'ORDERS', None)
+        std_orders = list(m_min + np.arange(sens_func.shape[0])
+                          if std_orders is None
+                          else np.asarray(std_orders, dtype=int))
+
         # import pdb; pdb.set_trace();
 
         for ad in adinputs:
@@ -2068,6 +2169,15 @@ class GHOSTSpect(GHOST):
             sens_func_ad.update_filename(suffix='_sensFunc', strip=True)
 
             for i, ext in enumerate(ad):
+                orders = getattr(ext, 'ORDERS', None)
+                orders = m_min + np.arange(ext.data.shape[0]) \
+                    if orders is None else np.asarray(orders, dtype=int)
+                missing = sorted(set(orders) - set(std_orders))
+                if missing:
+                    raise ValueError('The standard {} was not extracted for '
+                                     'orders {} of {}'.format(
+                                         std.filename, missing, ad.filename))
+                fit_ix = [std_orders.index(m) for m in orders]
 
                 # Interpolate the sensitivity function onto the wavelength
                 # grid of this ad
@@ -2082,7 +2192,7 @@ class GHOSTSpect(GHOST):
                     for od in range(ext.data.shape[0]):
                         # import pdb; pdb.set_trace();
                         sens_func_regrid[od, :, ob] = fitfunc(
-                            sens_func_fits[od], ext.WAVL[od, :]
+                            sens_func_fits[fit_ix[od]], ext.WAVL[od, :]
                         )
                         # if od == 29:
                         #     import pdb; pdb.set_trace();
@@ -2152,6 +2262,48 @@ class GHOSTSpect(GHOST):
         """
         return adinputs
 
+    def storeProcessedFlat(self, adinputs=None, **params):
+        """
+        Store a processed flat in the calibration system.
+
+        This overrides the generic primitive so that the spectral format of
+        the flat can be stored with it, as a ``.GEOMETRY`` table (see
+        :meth:`findApertures`), if it is not already there.
+
+        Parameters
+        ----------
+        suffix: str
+            suffix to be added to output files
+        store_geometry: bool
+            Store the spectral format with the flat? If False, any
+            ``.GEOMETRY`` is removed.
+        """
+        log = self.log
+        log.debug(gt.log_message("primitive", self.myself(), "starting"))
+
+        for ad in adinputs:
+            if not params['store_geometry']:
+                if hasattr(ad[0], 'GEOMETRY'):
+                    del ad[0].GEOMETRY
+                continue
+            if hasattr(ad[0], 'GEOMETRY') or not hasattr(ad[0], 'XMOD'):
+                continue
+            try:
+                models = self._get_spectral_format_models(ad)
+            except IOError:
+                log.warning("Cannot open required initial model files for {};"
+                            " not storing its geometry".format(ad.filename))
+                continue
+            arm = GhostArm(arm=ad.arm(), mode=ad.res_mode())
+            arm.spectral_format_with_matrix(*models)
+            ad[0].GEOMETRY = arm.geometry_table(models)
+
+        adinputs = self._markAsCalibration(adinputs, suffix=params["suffix"],
+                                           primname=self.myself(),
+                                           keyword="PROCFLAT")
+        self.storeCalibration(adinputs, caltype='processed_flat')
+        return adinputs
+
     # CJS: Primitive has been renamed for consistency with other instruments
     # The geometry_conf.py file is not needed; all you're doing is tiling
     # extensions according to their DETSEC keywords, without gaps or rotations
@@ -2298,6 +2450,143 @@ class GHOSTSpect(GHOST):
         return polyfit_file if polyfit_file.startswith(os.path.sep) else \
             os.path.join(polyfit_dir, polyfit_file)
 
+    def _get_spectral_format_models(self, ad):
+        """
+        Open the models the spectral format of a processed flat is
+        computed from.
+
+        Parameters
+        ----------
+        ad : :class:`astrodata.AstroData`
+            The flat, with an ``XMOD``.
+
+        Raises
+        ------
+        IOError
+            If a polyfit model file cannot be opened.
+
+        Returns
+        -------
+        list of :obj:`numpy.ndarray`
+            The flat's ``XMOD``, and the wavelength, spatial, spectral and
+            rotation models, in the order expected by
+            :meth:`polyfit.GhostArm.spectral_format_with_matrix`.
+        """
+        models = [ad[0].XMOD]
+        for caltype in ('wavemod', 'spatmod', 'specmod', 'rotmod'):
+            models.append(astrodata.open(
+                self._get_polyfit_filename(ad, caltype))[0].data)
+        return models
+
+    def _set_spectral_format(self, arm, flat, models):
+        """
+        Set the spectral format of an arm for a processed flat.
+
+        The format is read from the flat's ``GEOMETRY`` extension (see
+        :meth:`findApertures`) if it was computed from the same models,
+        and is otherwise computed from the models.
+
+        Parameters
+        ----------
+        arm : :class:`polyfit.ghost.GhostArm`
+            The arm.
+        flat : :class:`astrodata.AstroData`
+            The processed flat.
+        models : list of :obj:`numpy.ndarray`
+            The flat's ``XMOD``, and the wavelength, spatial, spectral and
+            rotation models.
+        """
+        geometry = getattr(flat[0], 'GEOMETRY', None)
+        if geometry is not None:
+            try:
+                arm.load_geometry_table(geometry, models=models)
+                self.log.debug("Read the spectral format from {}".format(
+                    flat.filename))
+                return
+            except (ValueError, KeyError):
+                self.log.debug("The GEOMETRY of {} does not match the "
+                               "models".format(flat.filename))
+        arm.spectral_format_with_matrix(*models)
+
+    def _get_extraction_plan(self, arm, flat, sview, models):
+        """
+        Look up or create the extraction plan for a processed flat.
+
+        The extraction geometry only depends on the arm, mode and binning,
+        the flat's ``XMOD`` and the polyfit models, so it is kept in a
+        ``.npz`` file next to the processed flat, keyed on a checksum of
+        the models, and re-used by every frame reduced with them.
+
+        Parameters
+        ----------
+        arm : :class:`polyfit.ghost.GhostArm`
+            The arm, with the binning of the data. The spectral format is
+            only set on it (see :meth:`_set_spectral_format`) if no saved
+            plan is found.
+        flat : :class:`astrodata.AstroData`
+            The processed flat.
+        sview : :class:`polyfit.slitview.SlitView`
+            The slit viewer of the data.
+        models : list of :obj:`numpy.ndarray`
+            The flat's ``XMOD``, and the wavelength, spatial, spectral and
+            rotation models.
+
+        Returns
+        -------
+        :class:`polyfit.plan.ExtractionPlan`
+        """
+        log = self.log
+        plan, found = ExtractionPlan.for_flat(
+            getattr(flat, 'path', None), arm, sview.slit_length, models,
+            compute=lambda: self._set_spectral_format(arm, flat, models))
+        log.debug("{} extraction plan for {}".format(
+            "Re-using the" if found else "Computed an", flat.filename))
+        return plan
+
+    def _extraction_cache_key(self, ad, cals, model_files, params):
+        """
+        Compute the extraction cache key of an input to extractProfile.
+
+        Parameters
+        ----------
+        ad : :class:`astrodata.AstroData`
+            The frame to be extracted.
+        cals : list of :class:`astrodata.AstroData`
+            The processed slit, slit flat and flat. Their files are
+            checksummed, or, if they have not been written to disk, their
+            data.
+        model_files : list of str
+            The polyfit model files.
+        params : dict
+            The parameters of extractProfile.
+
+        Returns
+        -------
+        str
+            See :func:`polyfit.cache.cache_key`.
+        """
+        arrays = [ad[0].data, ad[0].variance, ad[0].mask]
+        files = list(model_files)
+        for cal in cals:
+            path = getattr(cal, 'path', None)
+            if path and os.path.exists(path):
+                files.append(path)
+            else:
+                arrays.extend(getattr(cal[0], name, None)
+                              for name in ('data', 'XMOD', 'PIXELMODEL'))
+        # Calibrations are covered by their contents, and the remaining
+        # parameters do not change the extraction
+        key_params = dict(
+            (name, value) for name, value in params.items()
+            if name not in ('suffix', 'write_result', 'n_workers',
+                            'memory_budget', 'slit', 'slitflat', 'flat'))
+        # The extracted object/sky configurations depend on the tags
+        key_params.update(arm=ad.arm(), res_mode=ad.res_mode(),
+                          binning=(ad.detector_x_bin(), ad.detector_y_bin()),
+                          arc='ARC' in ad.tags,
+                          partner_cal='PARTNER_CAL' in ad.tags)
+        return cache_key(arrays, files, key_params)
+
     def _compute_barycentric_correction(self, ad, return_wavl=True,
                                         loc=GEMINI_SOUTH_LOC):
         """